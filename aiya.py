@@ -4,6 +4,8 @@ import os
 import sys
 from core import utility
 from core import settings
+from core import queuejournal
+from core import imagehandler
 from core.logging import get_logger
 from dotenv import load_dotenv
 
@@ -17,8 +19,12 @@ self.logger = get_logger(__name__)
 
 #load extensions
 # check files and global variables
+settings.load_config()
+# the image workers are forked before the webui connections start their threads
+imagehandler.image_handler.setup()
 settings.startup_check()
 settings.files_check()
+queuejournal.queue_journal.setup()
 
 self.load_extension('core.stablecog')
 #self.load_extension('core.drawcog')
@@ -26,6 +32,7 @@ self.load_extension('core.stablecog')
 #self.load_extension('core.identifycog')
 #self.load_extension('core.tipscog')
 #self.load_extension('core.cancelcog')
+self.load_extension('core.queuecog')
 self.load_extension('core.minigamecog')
 self.load_extension('core.fallbackviewcog')
 
@@ -41,6 +48,8 @@ async def on_ready():
     await self.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name='drawing tutorials.'))
     #because guilds are only known when on_ready, run files check for guilds
     settings.guilds_check(self)
+    #queue the dreams that were waiting when the bot stopped
+    await queuejournal.queue_journal.restore(self)
 
 # fallback feature to let reactions still work
 @self.event
@@ -19,7 +19,7 @@ class CancelCog(commands.Cog, description='Cancels all images in queue.'):
             total_cleared: int = queuehandler.dream_queue.clear_user_queue(user.id)
 
             embed=discord.Embed()
-            embed.add_field(name='Items Cleared', value=f'``{total_cleared}`` dreams cleared from queue', inline=False)
+            embed.add_field(name='Items Cleared', value=f'``{total_cleared}`` dreams cancelled', inline=False)
             loop.create_task(ctx.respond(embed=embed, ephemeral=True))
 
         except Exception as e:
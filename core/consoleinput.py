@@ -5,6 +5,9 @@ import threading
 
 from core import settings
 from core import queuehandler
+from core import costmodel
+from core import imagehandler
+from core import imagecache
 
 class ConsoleInput:
     def __init__(self, bot: discord.Bot):
@@ -15,7 +18,8 @@ class ConsoleInput:
                            '  reload - reloads all settings.\n'
                            '  guild list - lists all guilds that Aiya is in.\n'
                            '  guild leave (id) - leaves a guild.\n'
-                           '  status - show web ui online and queue status.')
+                           '  status - show web ui online and queue status.\n'
+                           '  cost - show how well the cost model predicts dream times.')
 
     def run(self):
         if self.input_thread == None:
@@ -110,9 +114,32 @@ class ConsoleInput:
                                 else:
                                     message += f',DISABLED'
                             message += f' - Queue:{dream_instance.get_queue_length()}'
+                            message += f' - Health:{web_ui.health.get_status()}'
+
+                            (connections, requests_sent, logins) = web_ui.get_session_stats()
+                            if requests_sent:
+                                message += f' - Pool:{web_ui.pool_size} Connections:{connections} Requests:{requests_sent} Reused:{max(0.0, 1.0 - connections / requests_sent) * 100.0:.0f}% Logins:{logins}'
                             print(message)
 
                         print(f'Total Queue:{queuehandler.dream_queue.get_queue_length()}')
+                        print(f'Checkpoint Switches:{queuehandler.dream_queue.model_switches} Avoided:{queuehandler.dream_queue.model_switches_avoided} - Dreams Moved To Idle WebUI:{queuehandler.dream_queue.dreams_stolen}')
+                        wait = queuehandler.dream_queue.get_predicted_wait()
+                        wait = f'{int(wait)}s' if wait != None else 'Unknown'
+                        print(f'Predicted Queue Wait:{wait} - Dreams Turned Away:{queuehandler.dream_queue.dreams_shed} - Dreams Past Interaction Deadline:{queuehandler.dream_queue.dreams_expired}')
+                        waits = queuehandler.dream_queue.get_wait_percentiles()
+                        if waits:
+                            print(f'Queue Wait p50:{waits[0]:.1f}s p90:{waits[1]:.1f}s p99:{waits[2]:.1f}s')
+                        for line in imagehandler.image_handler.get_report():
+                            print(line)
+                        print(imagecache.image_cache.get_report())
+                        print(imagecache.image_downloader.get_report())
+
+                    case 'cost':
+                        lines = costmodel.cost_model.get_report()
+                        if not lines:
+                            print('No dreams have been recorded yet.')
+                        for line in lines:
+                            print(line)
 
                     case other:
                         print(self.help_output)
@@ -0,0 +1,224 @@
+import json
+import threading
+import traceback
+
+from core import utility
+from core import settings
+
+# reference dream used to convert seconds into compute cost (512x512, 20 steps, fast sampler), the static cost of this dream is 1.0
+reference_features = [1.0, 20.0, 0.0, 0.0, 0.0]
+
+# recursive least squares fit of the seconds it takes a webui instance to generate one image
+class InstanceCostModel:
+    def __init__(self, data: dict = None):
+        feature_count = len(reference_features)
+        self.weights: list[float] = [0.0] * feature_count
+        self.covariance: list[list[float]] = [[1000.0 if i == j else 0.0 for j in range(feature_count)] for i in range(feature_count)]
+        self.samples = 0
+        self.error = 0.0 # running average of the relative prediction error
+        self.error_static = 0.0 # running average of the relative error of the static cost formula
+        self.seconds_per_cost = 0.0 # running average of seconds taken per unit of static cost
+
+        # other dreams (upscale, identify) are tracked by their average time
+        self.other_seconds: dict[str, float] = {}
+
+        if data:
+            self.weights = data['weights']
+            self.covariance = data['covariance']
+            self.samples = data['samples']
+            self.error = data.get('error', 0.0)
+            self.error_static = data.get('error_static', 0.0)
+            self.seconds_per_cost = data.get('seconds_per_cost', 0.0)
+            self.other_seconds = data.get('other_seconds', {})
+
+    def to_dict(self):
+        return {
+            'weights': self.weights,
+            'covariance': self.covariance,
+            'samples': self.samples,
+            'error': self.error,
+            'error_static': self.error_static,
+            'seconds_per_cost': self.seconds_per_cost,
+            'other_seconds': self.other_seconds
+        }
+
+    def predict(self, features: list[float]):
+        return sum(w * x for (w, x) in zip(self.weights, features))
+
+    def update(self, features: list[float], seconds: float, forget: float = 0.995):
+        # p_x = P * x
+        p_x = [sum(p * x for (p, x) in zip(row, features)) for row in self.covariance]
+        denominator = forget + sum(x * px for (x, px) in zip(features, p_x))
+        gain = [px / denominator for px in p_x]
+
+        error = seconds - self.predict(features)
+        self.weights = [w + k * error for (w, k) in zip(self.weights, gain)]
+
+        # P = (P - k * x^T * P) / forget
+        feature_count = len(features)
+        self.covariance = [[(self.covariance[i][j] - gain[i] * p_x[j]) / forget for j in range(feature_count)] for i in range(feature_count)]
+        self.samples += 1
+
+# learns the real cost of dreams from the time each webui instance takes to finish them
+class CostModel:
+    def __init__(self):
+        self.file_path = 'resources/cost-model.json'
+        self.lock = threading.Lock()
+        self.models: dict[str, InstanceCostModel] = {}
+        self.min_samples = 20
+        self.default_seconds_per_cost = 5.0
+        self.updates = 0
+        self.write_thread = threading.Thread()
+
+    def setup(self):
+        with self.lock:
+            self.models = {}
+            try:
+                with open(self.file_path, 'r') as f:
+                    for (url, data) in json.load(f).items():
+                        self.models[url] = InstanceCostModel(data)
+                print(f'> Cost model loaded for {len(self.models)} WebUI instances')
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f'> Failed to load cost model at {self.file_path}\n{e}\n{traceback.print_exc()}')
+
+    def save(self):
+        def run():
+            with self.lock:
+                data = {url: model.to_dict() for (url, model) in self.models.items()}
+            with open(self.file_path, 'w') as f:
+                json.dump(data, f)
+
+        if self.write_thread.is_alive(): self.write_thread.join()
+        self.write_thread = threading.Thread(target=run)
+        self.write_thread.start()
+
+    # get the number of images in a dream
+    def get_batch(self, queue_object: utility.DrawObject):
+        try:
+            return int(queue_object.payload['n_iter']) * int(queue_object.payload.get('batch_size', 1))
+        except:
+            return int(queue_object.batch)
+
+    # get the features of a single image of a draw object
+    def get_features(self, queue_object: utility.DrawObject):
+        highres_fix = queue_object.highres_fix != None and queue_object.highres_fix != 'None' and queue_object.highres_fix != False
+        controlnet = queue_object.controlnet_model != None and queue_object.controlnet_model != 'None'
+        slow_sampler = queue_object.sampler in settings.global_var.slow_samplers
+
+        pixels = float(queue_object.width * queue_object.height) / float(512 * 512)
+        steps = float(queue_object.steps)
+        if queue_object.init_url: steps *= max(0.2, queue_object.strength)
+
+        highres_steps = 0.0
+        if highres_fix:
+            highres_steps = float(int(steps * queue_object.strength)) * pixels
+            pixels *= 0.25 # the first pass is at half the resolution
+
+        pixel_steps = steps * pixels
+        return [
+            1.0,
+            pixel_steps,
+            pixel_steps if slow_sampler else 0.0,
+            pixel_steps if controlnet else 0.0,
+            highres_steps
+        ]
+
+    # record how long a dream took on a webui instance
+    def record(self, queue_object: utility.DreamObject, web_ui: utility.WebUI, seconds: float, static_cost: float, batch: int = 1):
+        with self.lock:
+            model = self.models.get(web_ui.url)
+            if model == None:
+                model = InstanceCostModel()
+                self.models[web_ui.url] = model
+
+            if type(queue_object) is utility.DrawObject:
+                batch = max(1, batch)
+                features = self.get_features(queue_object)
+                image_seconds = seconds / batch
+
+                # track prediction error before learning from this dream
+                if model.samples >= self.min_samples:
+                    predicted = max(0.05, model.predict(features))
+                    model.error = model.error * 0.95 + abs(predicted - image_seconds) / image_seconds * 0.05
+                if model.seconds_per_cost > 0.0:
+                    predicted = static_cost * model.seconds_per_cost / batch
+                    model.error_static = model.error_static * 0.95 + abs(predicted - image_seconds) / image_seconds * 0.05
+
+                seconds_per_cost = seconds / max(0.01, static_cost)
+                if model.seconds_per_cost == 0.0:
+                    model.seconds_per_cost = seconds_per_cost
+                else:
+                    model.seconds_per_cost = model.seconds_per_cost * 0.95 + seconds_per_cost * 0.05
+
+                model.update(features, image_seconds)
+            else:
+                dream_type = type(queue_object).__name__
+                average = model.other_seconds.get(dream_type)
+                model.other_seconds[dream_type] = seconds if average == None else average * 0.9 + seconds * 0.1
+
+            self.updates += 1
+
+        # write to disk every few dreams
+        if self.updates % 10 == 0:
+            self.save()
+
+    # predict the seconds a dream will take on a webui instance, returns None if there is not enough data yet
+    def predict_seconds(self, queue_object: utility.DreamObject, web_ui: utility.WebUI):
+        model = self.models.get(web_ui.url)
+        if model == None:
+            return None
+
+        if type(queue_object) is utility.DrawObject:
+            if model.samples < self.min_samples:
+                return None
+            return max(0.05, model.predict(self.get_features(queue_object))) * self.get_batch(queue_object)
+        else:
+            return model.other_seconds.get(type(queue_object).__name__)
+
+    # get the seconds a webui instance takes per unit of compute cost
+    def get_seconds_per_cost(self, web_ui: utility.WebUI):
+        model = self.models.get(web_ui.url)
+        if model and model.seconds_per_cost > 0.0:
+            return model.seconds_per_cost
+
+        # fall back to the average of the other instances, or a rough guess
+        seconds_per_cost = [model.seconds_per_cost for model in list(self.models.values()) if model.seconds_per_cost > 0.0]
+        if seconds_per_cost:
+            return sum(seconds_per_cost) / len(seconds_per_cost)
+        return self.default_seconds_per_cost
+
+    # get the compute cost of a draw object from the learned models, returns None if no instance has enough data yet
+    def get_dream_cost(self, queue_object: utility.DrawObject):
+        features = self.get_features(queue_object)
+        costs: list[float] = []
+        for model in list(self.models.values()):
+            if model.samples < self.min_samples:
+                continue
+            reference_seconds = model.predict(reference_features)
+            if reference_seconds <= 0.0:
+                continue
+            costs.append(max(0.05, model.predict(features)) / reference_seconds)
+
+        if not costs:
+            return None
+        return max(0.1, sum(costs) / len(costs)) * self.get_batch(queue_object)
+
+    # get a printable report of the prediction error of each webui instance
+    def get_report(self):
+        lines: list[str] = []
+        for (url, model) in list(self.models.items()):
+            line = f'{url} - Samples:{model.samples}'
+            if model.samples >= self.min_samples:
+                line += f' - Error:{model.error * 100.0:.1f}% - Static Formula Error:{model.error_static * 100.0:.1f}%'
+                line += f' - Reference Dream:{model.predict(reference_features):.2f}s'
+            else:
+                line += f' - Learning ({self.min_samples} samples needed)'
+            for (dream_type, seconds) in model.other_seconds.items():
+                line += f' - {dream_type}:{seconds:.2f}s'
+            lines.append(line)
+        return lines
+
+cost_model = CostModel()
+cost_model.setup()
@@ -1,4 +1,3 @@
-import base64
 import discord
 import traceback
 import requests
@@ -13,6 +12,7 @@ from core import utility
 from core import queuehandler
 from core import viewhandler
 from core import settings
+from core import imagecache
 
 
 class IdentifyCog(commands.Cog, description = 'Describe an image'):
@@ -68,28 +68,25 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                     image_validated = False
                     raise Exception()
 
+                # defer response before downloading
                 try:
-                    # reject URL downloads larger than 10MB
-                    url_head = await loop.run_in_executor(None, requests.head, init_url)
-                    url_size = int(url_head.headers.get('content-length', -1))
-                    if url_size > 10 * 1024 * 1024:
-                        print(f'Dream rejected: Image too large.')
-                        content = 'URL image is too large! Please make the download size smaller.'
-                        ephemeral = True
-                        image_validated = False
-                        raise Exception()
-
-                    # defer response before downloading
-                    try:
-                        loop.create_task(ctx.defer())
-                    except:
-                        pass
+                    loop.create_task(ctx.defer())
+                except:
+                    pass
 
-                    # download and encode the image
-                    image_data = await loop.run_in_executor(None, requests.get, init_url)
-                    image = 'data:image/png;base64,' + base64.b64encode(image_data.content).decode('utf-8')
+                try:
+                    # get the image from the cache or download it
+                    cached_image = await imagecache.image_cache.fetch(init_url)
+                    image = 'data:image/png;base64,' + cached_image.get_base64()
                     image_validated = True
 
+                except imagecache.DownloadTooLargeError:
+                    print(f'Dream rejected: Image too large.')
+                    content = 'URL image is too large! Please make the download size smaller.'
+                    ephemeral = True
+                    image_validated = False
+                    raise Exception()
+
                 except:
                     if content == None:
                         content = 'URL image not found! Please check the image URL.'
@@ -136,6 +133,14 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                 ephemeral = True
                 raise Exception()
 
+            # turn the dream away if the whole queue would take too long to finish
+            admission = queuehandler.dream_queue.check_admission(dream_cost, type(ctx) in (discord.Interaction, utility.RestoredContext))
+            if admission:
+                print(f'Identify rejected: Queue is too long')
+                content = f'<@{user.id}> {admission}'
+                ephemeral = True
+                raise Exception()
+
             priority = int(settings.read(guild)['priority'])
             if queue_cost > 0.0: priority += 1
             if dream_cost + queue_cost > settings.read(guild)['max_compute']:
@@ -150,6 +155,8 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                 ephemeral = True
             else:
                 content = f'<@{user.id}> I\'m identifying the image! Queue: ``{queue_length}``'
+                eta = queuehandler.dream_queue.get_eta_text(identify_object)
+                if eta: content = content + f' - ETA: ``~{eta}``'
 
         except Exception as e:
             if content == None:
@@ -168,6 +175,10 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
             else:
                 loop.create_task(ctx.channel.send(content, delete_after=delete_after))
 
+    # queue an identify from the queue journal again after a restart
+    async def restore_dream(self, ctx: utility.RestoredContext, record: dict):
+        await self.dream_handler(ctx, **record['args'])
+
     def dream(self, queue_object: utility.IdentifyObject, web_ui: utility.WebUI, queue_continue: threading.Event):
         user = utility.get_user(queue_object.ctx)
 
@@ -180,16 +191,11 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                 return
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
+            queuehandler.job_runner.call_later(0.1, queue_continue.set)
 
             if queue_object.model == 'combined':
                 # combined model payload - iterate through all models and put them in the prompt
                 payloads: list[dict] = []
-                threads: list[threading.Thread] = []
-                responses: list[requests.Response | Exception] = []
                 for model in settings.global_var.identify_models:
                     new_payload = {}
                     new_payload.update(queue_object.payload)
@@ -198,23 +204,14 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                     }
                     new_payload.update(model_payload)
                     payloads.append(new_payload)
-                    responses.append(None)
 
-                def interrogate(thread_index, thread_payload):
+                def interrogate(thread_payload):
                     try:
-                        responses[thread_index] = s.post(url=f'{web_ui.url}/sdapi/v1/interrogate', json=thread_payload, timeout=120)
+                        return s.post(url=f'{web_ui.url}/sdapi/v1/interrogate', json=thread_payload, timeout=120)
                     except Exception as e:
-                        responses[thread_index] = e
-
-                for index, payload in enumerate(payloads):
-                    thread = threading.Thread(target=interrogate, args=[index, payload], daemon=True)
-                    threads.append(thread)
-
-                for thread in threads:
-                    thread.start()
+                        return e
 
-                for thread in threads:
-                    thread.join()
+                responses: list[requests.Response | Exception] = queuehandler.job_runner.map(interrogate, payloads)
 
                 for response in responses:
                     if type(response) is not requests.Response:
@@ -247,7 +244,7 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                         print(content + f'\n{traceback.print_exc()}')
                         queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
-                threading.Thread(target=post_dream, daemon=True).start()
+                queuehandler.job_runner.submit(post_dream)
             else:
                 # regular payload - get identify for the model specified
                 response = s.post(url=f'{web_ui.url}/sdapi/v1/interrogate', json=queue_object.payload, timeout=120)
@@ -265,7 +262,7 @@ class IdentifyCog(commands.Cog, description = 'Describe an image'):
                         content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
                         print(content + f'\n{traceback.print_exc()}')
                         queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
-                threading.Thread(target=post_dream, daemon=True).start()
+                queuehandler.job_runner.submit(post_dream)
 
         except requests.exceptions.RequestException as e:
             # connection error, return items to queue
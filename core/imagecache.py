@@ -0,0 +1,318 @@
+import aiohttp
+import asyncio
+import base64
+import collections
+import hashlib
+import io
+import os
+import threading
+import time
+import traceback
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from PIL import Image
+
+from core import settings
+
+# the download failed, or the url is not an image on the discord cdn
+class DownloadError(Exception):
+    pass
+
+# the download was stopped at the size limit
+class DownloadTooLargeError(DownloadError):
+    pass
+
+# downloads input images from the discord cdn in one streamed request, stopping as soon as they are over the size limit
+class ImageDownloader:
+    def __init__(self):
+        self.max_bytes = 10 * 1024 * 1024
+        self.chunk_bytes = 64 * 1024
+        self.timeout = aiohttp.ClientTimeout(total=60, connect=10, sock_read=15)
+        self.session: aiohttp.ClientSession = None
+        self.lock = threading.Lock()
+        self.downloads = 0
+        self.failures = 0
+        self.too_large = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def is_allowed_url(self, url: str):
+        return url.startswith('https://cdn.discordapp.com/') or url.startswith('https://media.discordapp.net/')
+
+    # the session is made on first use, it belongs to the event loop of the bot
+    def get_session(self):
+        if self.session == None or self.session.closed:
+            self.session = aiohttp.ClientSession(timeout=self.timeout)
+        return self.session
+
+    # download an image, raises DownloadTooLargeError once it is over the limit and DownloadError if it fails
+    async def download(self, url: str):
+        if self.is_allowed_url(url) == False:
+            raise DownloadError(f'Not a Discord CDN url: {url}')
+
+        start_time = time.perf_counter()
+        data = bytearray()
+        try:
+            async with self.get_session().get(url) as response:
+                if response.status != 200:
+                    raise DownloadError(f'Image download returned {response.status}: {url}')
+                if response.content_length and response.content_length > self.max_bytes:
+                    raise DownloadTooLargeError(f'Image download is {response.content_length} bytes: {url}')
+                async for chunk in response.content.iter_chunked(self.chunk_bytes):
+                    data += chunk
+                    if len(data) > self.max_bytes:
+                        raise DownloadTooLargeError(f'Image download is over {self.max_bytes} bytes: {url}')
+
+        except DownloadError as e:
+            self.record(e, len(data), start_time)
+            raise e
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.record(e, len(data), start_time)
+            raise DownloadError(f'Image download failed: {url}\n{e!r}')
+
+        self.record(None, len(data), start_time)
+        return bytes(data)
+
+    def record(self, error: Exception, data_bytes: int, start_time: float):
+        with self.lock:
+            self.bytes += data_bytes
+            self.seconds += time.perf_counter() - start_time
+            if error == None:
+                self.downloads += 1
+            elif type(error) is DownloadTooLargeError:
+                self.too_large += 1
+            else:
+                self.failures += 1
+
+    # get a printable report of the downloads
+    def get_report(self):
+        with self.lock:
+            count = max(1, self.downloads + self.failures + self.too_large)
+            return (f'Image Downloads:{self.downloads} - Failed:{self.failures} - Too Large:{self.too_large}'
+                    f' - {self.bytes / 1024 / 1024:.1f}MB - Average:{self.seconds / count * 1000.0:.0f}ms')
+
+# an input image downloaded for a command, shared by every command that uses the same image
+class CachedImage:
+    def __init__(self, image_hash: str, data: bytes, size: tuple[int, int]):
+        self.image_hash = image_hash
+        self.data = data
+        self.size = size
+        self.base64: str = None
+
+    # get the image as base64 for the webui, encoded once and kept with the image
+    def get_base64(self):
+        if self.base64 == None:
+            self.base64 = base64.b64encode(self.data).decode('utf-8')
+        return self.base64
+
+    def get_cost(self):
+        return len(self.data) + (len(self.base64) if self.base64 else 0)
+
+# caches input images by their url and the hash of their content, so variations, rerolls and repeated upscales skip the download
+# images over the memory budget are spilled to disk if a cache directory is set
+class ImageCache:
+    def __init__(self):
+        self.max_bytes = 256 * 1024 * 1024
+        self.max_disk_bytes = 1024 * 1024 * 1024
+        self.dir: str = None
+        self.lock = threading.Lock()
+        self.images: collections.OrderedDict[str, CachedImage] = collections.OrderedDict() # images in memory by hash, least recently used first
+        self.disk_images: collections.OrderedDict[str, tuple[int, tuple[int, int]]] = collections.OrderedDict() # bytes and size of the images on disk by hash
+        self.urls: collections.OrderedDict[str, str] = collections.OrderedDict() # image hash of each url
+        self.fetches: dict[str, asyncio.Task] = {} # downloads in progress by url, commands for the same image share them
+        self.max_urls = 4096
+        self.bytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def setup(self):
+        try:
+            self.max_bytes = int(float(settings.get_env_var('IMAGE_CACHE_SIZE', '256')) * 1024 * 1024)
+        except:
+            print('> - Warning: IMAGE_CACHE_SIZE must be a number')
+        try:
+            self.max_disk_bytes = int(float(settings.get_env_var('IMAGE_CACHE_DISK_SIZE', '1024')) * 1024 * 1024)
+        except:
+            print('> - Warning: IMAGE_CACHE_DISK_SIZE must be a number')
+
+        self.dir = settings.get_env_var('IMAGE_CACHE_DIR', '') or None
+        if self.dir:
+            try:
+                # the urls of the images spilled before a restart are not known, so they can never be used
+                os.makedirs(self.dir, exist_ok=True)
+                with self.lock:
+                    self.disk_images.clear()
+                    self.disk_bytes = 0
+                for file_name in os.listdir(self.dir):
+                    if file_name.endswith('.img'):
+                        os.remove(os.path.join(self.dir, file_name))
+            except Exception as e:
+                print(f'> Image cache directory {self.dir} cannot be used, images are only cached in memory\n{e}')
+                self.dir = None
+
+        with self.lock:
+            self.evict()
+
+    # get the url an image is cached under, discord signs attachment urls with parameters that change over time
+    def get_key(self, url: str):
+        parts = urlsplit(url)
+        query = [(name, value) for (name, value) in parse_qsl(parts.query) if name not in ('ex', 'is', 'hm')]
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, urlencode(query), ''))
+
+    def get_file_path(self, image_hash: str):
+        return os.path.join(self.dir, f'{image_hash}.img')
+
+    # get the cached image of a url, returns None if it has to be downloaded
+    async def get(self, url: str):
+        key = self.get_key(url)
+        with self.lock:
+            image_hash = self.urls.get(key)
+            if image_hash == None:
+                self.misses += 1
+                return None
+            self.urls.move_to_end(key)
+
+            cached_image = self.images.get(image_hash)
+            if cached_image:
+                self.images.move_to_end(image_hash)
+                self.hits += 1
+                return cached_image
+
+            disk_image = self.disk_images.get(image_hash)
+            if disk_image == None:
+                self.urls.pop(key)
+                self.misses += 1
+                return None
+
+        # read spilled images outside of the event loop
+        try:
+            data = await asyncio.get_event_loop().run_in_executor(None, self.read, image_hash)
+        except Exception as e:
+            print(f'Image cache failed to read {image_hash}:\n{e}')
+            with self.lock:
+                self.misses += 1
+            return None
+
+        cached_image = CachedImage(image_hash, data, disk_image[1])
+        with self.lock:
+            self.disk_hits += 1
+            return self.store(cached_image)
+
+    # get the image of a url from the cache or download it, raises DownloadError if the download fails
+    async def fetch(self, url: str):
+        cached_image = await self.get(url)
+        if cached_image:
+            return cached_image
+
+        key = self.get_key(url)
+        task = self.fetches.get(key)
+        if task == None:
+            async def run():
+                try:
+                    data = await image_downloader.download(url)
+                    return self.add(url, data)
+                finally:
+                    self.fetches.pop(key, None)
+            task = asyncio.get_event_loop().create_task(run())
+            self.fetches[key] = task
+        return await asyncio.shield(task)
+
+    # start downloading an image that is needed later, so it downloads alongside other images
+    def prefetch(self, url: str):
+        task = asyncio.get_event_loop().create_task(self.fetch(url))
+        task.add_done_callback(lambda task: task.cancelled() or task.exception()) # fetch reports the error to the command that awaits it
+
+    def read(self, image_hash: str):
+        with open(self.get_file_path(image_hash), 'rb') as f:
+            return f.read()
+
+    # cache a downloaded image, raises an exception if it is not an image
+    def add(self, url: str, data: bytes):
+        image_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            cached_image = self.images.get(image_hash)
+            if cached_image == None:
+                cached_image = CachedImage(image_hash, data, None)
+            else:
+                self.images.move_to_end(image_hash)
+
+        # the same image under another url keeps its size and base64
+        if cached_image.size == None:
+            cached_image.size = Image.open(io.BytesIO(data)).size
+
+        with self.lock:
+            self.urls[self.get_key(url)] = image_hash
+            self.urls.move_to_end(self.get_key(url))
+            while len(self.urls) > self.max_urls:
+                self.urls.popitem(last=False)
+            return self.store(cached_image)
+
+    # keep an image in memory, returns the image kept for its hash
+    def store(self, cached_image: CachedImage):
+        current_image = self.images.get(cached_image.image_hash)
+        if current_image:
+            return current_image
+
+        self.images[cached_image.image_hash] = cached_image
+        self.bytes += cached_image.get_cost()
+        self.evict()
+        return cached_image
+
+    # remove the least recently used images until the cache is within its budget, spilling them to disk if possible
+    def evict(self):
+        # base64 is added to images after they are stored
+        self.bytes = sum(cached_image.get_cost() for cached_image in self.images.values())
+
+        spill_images: list[CachedImage] = []
+        while self.bytes > self.max_bytes and len(self.images) > 1:
+            (image_hash, cached_image) = self.images.popitem(last=False)
+            self.bytes -= cached_image.get_cost()
+            if self.dir and image_hash not in self.disk_images and len(cached_image.data) <= self.max_disk_bytes:
+                self.disk_images[image_hash] = (len(cached_image.data), cached_image.size)
+                self.disk_bytes += len(cached_image.data)
+                spill_images.append(cached_image)
+
+        remove_hashes: list[str] = []
+        while self.disk_bytes > self.max_disk_bytes and self.disk_images:
+            (image_hash, (data_bytes, size)) = self.disk_images.popitem(last=False)
+            self.disk_bytes -= data_bytes
+            remove_hashes.append(image_hash)
+
+        if spill_images or remove_hashes:
+            threading.Thread(target=self.spill, args=[spill_images, remove_hashes], daemon=True).start()
+
+    # write evicted images to disk and delete the images that no longer fit
+    def spill(self, spill_images: list[CachedImage], remove_hashes: list[str]):
+        for cached_image in spill_images:
+            if cached_image.image_hash in remove_hashes:
+                continue
+            try:
+                file_path_temp = self.get_file_path(cached_image.image_hash) + '.tmp'
+                with open(file_path_temp, 'wb') as f:
+                    f.write(cached_image.data)
+                os.replace(file_path_temp, self.get_file_path(cached_image.image_hash))
+            except Exception as e:
+                print(f'Image cache failed to spill {cached_image.image_hash}:\n{e}\n{traceback.format_exc()}')
+                with self.lock:
+                    if self.disk_images.pop(cached_image.image_hash, None):
+                        self.disk_bytes -= len(cached_image.data)
+
+        for image_hash in remove_hashes:
+            try:
+                os.remove(self.get_file_path(image_hash))
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f'Image cache failed to remove {image_hash}:\n{e}')
+
+    # get a printable report of the cache
+    def get_report(self):
+        with self.lock:
+            lookups = max(1, self.hits + self.disk_hits + self.misses)
+            return (f'Image Cache - Images:{len(self.images)} - {self.bytes / 1024 / 1024:.1f}MB/{self.max_bytes / 1024 / 1024:.0f}MB'
+                    f' - Disk:{len(self.disk_images)} - {self.disk_bytes / 1024 / 1024:.1f}MB'
+                    f' - Hits:{(self.hits + self.disk_hits) * 100 // lookups}%')
+
+image_downloader = ImageDownloader()
+image_cache = ImageCache()
@@ -0,0 +1,370 @@
+import asyncio
+import atexit
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+from PIL import features, Image, ImageFilter
+
+from core import settings
+
+# image jobs, these run in the worker processes and take the image data as their first argument
+
+# maps the blurred alpha of an outpaint image to the mask, widening the soft edge around the border
+outpaint_mask_table = [min(255, max(0, (c - 127) * 2)) for c in range(256)]
+
+# get the mask from the alpha channel of an image, outpaint masks are blurred so the border blends in
+def get_mask(image: Image.Image, outpaint: bool = False):
+    mask = image.getchannel('A')
+    if outpaint:
+        mask = mask.filter(ImageFilter.BoxBlur(radius=64.0)).point(outpaint_mask_table)
+    return mask
+
+# encode a png quickly, the images only travel to the webui
+def encode_png(image: Image.Image):
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=1)
+    return buffer.getvalue()
+
+# get the alpha channel of an image as an inpainting mask
+def build_mask(image_data: bytes):
+    image = Image.open(io.BytesIO(image_data))
+    return encode_png(get_mask(image))
+
+# shrink an image and surround it with a transparent border to outpaint in the given direction, returns the image and its mask
+def build_outpaint(image_data: bytes, direction: str):
+    image = Image.open(io.BytesIO(image_data))
+    (width, height) = image.size
+
+    # get border width and height for outpainting
+    border_width = int(float(width) * 0.125)
+    border_height = int(float(height) * 0.125)
+
+    # resize init image to allow room for borders
+    resized_image = image.resize((width - border_width * 2, height - border_height * 2))
+
+    # create a new image of the original size and paste the resized image into it
+    new_image = Image.new('RGBA', (width, height), (127, 127, 127, 0))
+    match direction:
+        case 'center':
+            posX = border_width
+            posY = border_height
+        case 'up':
+            posX = border_width
+            posY = min(border_height * 2, height - resized_image.height)
+        case 'down':
+            posX = border_width
+            posY = 1
+        case 'left':
+            posX = min(border_width * 2, width - resized_image.width)
+            posY = border_height
+        case 'right':
+            posX = 1
+            posY = border_height
+        case other:
+            raise Exception(f'Unknown outpaint direction: {direction}')
+
+    new_image.paste(resized_image, (posX, posY, posX + resized_image.width, posY + resized_image.height))
+
+    # the mask is built from the new image directly, rather than decoding it again
+    return (encode_png(new_image), encode_png(get_mask(new_image, True)))
+
+# shrink an image to a small jpeg preview
+def build_preview(image_data: bytes, size: int):
+    image = Image.open(io.BytesIO(image_data))
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, 'JPEG', quality=70)
+    return buffer.getvalue()
+
+# encode an image again to fit in a number of bytes, returns the new data and its file extension
+# tries lossless webp first when it may fit, then searches the quality of lossy webp or jpeg, shrinking the image as a last resort
+def encode_for_upload(image_data: bytes, budget: int):
+    if len(image_data) <= budget:
+        return (image_data, None)
+
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    webp = features.check('webp')
+
+    def encode(image: Image.Image, format: str, **options):
+        buffer = io.BytesIO()
+        image.save(buffer, format=format, **options)
+        return buffer.getvalue()
+
+    # lossless webp is usually a quarter smaller than png, only worth the time when that is enough
+    if webp and len(image_data) * 0.8 <= budget:
+        data = encode(image, 'WEBP', lossless=True, quality=0, method=0)
+        if len(data) <= budget:
+            return (data, 'webp')
+
+    if webp:
+        format, extension, options = 'WEBP', 'webp', {'method': 2}
+    else:
+        format, extension, options = 'JPEG', 'jpeg', {'optimize': True}
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+    # search for the best quality that fits, starting high since most images only need a little off
+    while True:
+        low, high = 5, 95
+        quality = 85
+        best = None
+        for _ in range(6):
+            data = encode(image, format, quality=quality, **options)
+            if len(data) <= budget:
+                best = data
+                low = quality + 1
+            else:
+                high = quality - 1
+            if low > high:
+                break
+            quality = (low + high) // 2
+        if best:
+            return (best, extension)
+
+        # even the lowest quality is too large, shrink the image by the size it missed by
+        scale = max(0.25, min(0.9, (budget / len(data)) ** 0.5))
+        if image.width * scale < 64 or image.height * scale < 64:
+            return (data, extension)
+        image = image.resize((int(image.width * scale), int(image.height * scale)), Image.LANCZOS)
+
+# read the image data from shared memory and run a job, returns the result and the seconds it took
+def run_job(function, memory_name: str, size: int, args: tuple, kwargs: dict):
+    start_time = time.perf_counter()
+    memory = shared_memory.SharedMemory(name=memory_name)
+    try:
+        image_data = bytes(memory.buf[:size])
+    finally:
+        memory.close()
+    return (function(image_data, *args, **kwargs), time.perf_counter() - start_time)
+
+def warm_up():
+    return None
+
+# runs image decoding, encoding and editing in a bounded pool of processes, so it does not hold the GIL of the discord event loop
+# the image data is passed to the workers through shared memory, without worker processes the jobs run in a pool of threads
+class ImageHandler:
+    def __init__(self):
+        self.workers = 2
+        self.pool: concurrent.futures.ProcessPoolExecutor = None
+        self.pool_workers = None # workers the pool was started with, the pool is only started once
+        self.thread_pool: concurrent.futures.ThreadPoolExecutor = None
+        self.thread_workers = min(4, os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        self.queue_depth = 0
+        self.stats: dict[str, list[float]] = {} # jobs done, seconds waiting and seconds working for each job
+        self.upload_limits = [10, 10, 50, 100] # megabytes discord accepts in a message for each server boost tier
+        self.upload_margin = 256 * 1024 # bytes left for the message content and request overhead
+
+    def setup(self):
+        try:
+            self.workers = max(0, int(settings.get_env_var('IMAGE_WORKERS', str(min(4, os.cpu_count() or 1)))))
+        except:
+            print('> - Warning: IMAGE_WORKERS must be a whole number')
+        try:
+            upload_limits = [float(limit) for limit in settings.get_env_var('UPLOAD_LIMITS', '10,10,50,100').split(',')]
+            if len(upload_limits) != 4:
+                raise ValueError
+            self.upload_limits = upload_limits
+        except:
+            print('> - Warning: UPLOAD_LIMITS must be four numbers separated by commas')
+        self.start_pool()
+
+    # start the worker processes, this is done once at startup before any other threads are running
+    # the workers are forked from this process, a fork made later could copy locks held by the other threads
+    def start_pool(self):
+        with self.lock:
+            if self.pool_workers != None:
+                if self.pool_workers != self.workers:
+                    print(f'> - Warning: IMAGE_WORKERS changes need a restart, using {self.pool_workers} image workers')
+                    self.workers = self.pool_workers
+                return
+            self.pool_workers = self.workers
+            if self.workers == 0:
+                return
+            try:
+                # the workers share the resource tracker of this process, so shared memory is only tracked once
+                # they are forked rather than spawned, spawned workers would run aiya.py again
+                resource_tracker.ensure_running()
+                self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'))
+                self.pool.submit(warm_up)
+            except Exception as e:
+                print(f'> Image worker processes could not be started, images are processed in threads\n{e}')
+                self.pool = None
+
+    # get the pool of threads that runs the jobs without worker processes
+    def get_thread_pool(self):
+        with self.lock:
+            if self.thread_pool == None:
+                self.thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.thread_workers, thread_name_prefix='image')
+            return self.thread_pool
+
+    # stop the worker processes, the pool is released before python shuts down its modules
+    def shutdown(self):
+        with self.lock:
+            pool = self.pool
+            self.pool = None
+            thread_pool = self.thread_pool
+            self.thread_pool = None
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+        if thread_pool:
+            thread_pool.shutdown(wait=False, cancel_futures=True)
+
+    # run an image job, returns a future with the result
+    def submit(self, function, image_data: bytes, *args, **kwargs):
+        submit_time = time.perf_counter()
+        with self.lock:
+            self.queue_depth += 1
+            pool = self.pool
+
+        # without worker processes the job runs in a thread, never in the calling thread which may be the event loop
+        if pool == None:
+            try:
+                return self.get_thread_pool().submit(self.run_thread_job, function, submit_time, image_data, args, kwargs)
+            except Exception as e:
+                self.record(function, submit_time, None)
+                raise e
+
+        memory = shared_memory.SharedMemory(create=True, size=max(1, len(image_data)))
+        memory.buf[:len(image_data)] = image_data
+        result_future = concurrent.futures.Future()
+
+        def done(job_future: concurrent.futures.Future):
+            memory.close()
+            memory.unlink()
+            try:
+                (result, work_seconds) = job_future.result()
+                self.record(function, submit_time, work_seconds)
+                result_future.set_result(result)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # the pool is not started again, it would be forked while the other threads are running
+                print(f'Image worker process stopped, images are processed in threads until the bot restarts:\n{e}')
+                self.record(function, submit_time, None)
+                with self.lock:
+                    if self.pool is pool:
+                        self.pool = None
+                result_future.set_exception(e)
+            except Exception as e:
+                self.record(function, submit_time, None)
+                result_future.set_exception(e)
+
+        try:
+            job_future = pool.submit(run_job, function, memory.name, len(image_data), args, kwargs)
+        except Exception as e:
+            memory.close()
+            memory.unlink()
+            self.record(function, submit_time, None)
+            print(f'Image job could not be started:\n{e}\n{traceback.print_exc()}')
+            raise e
+        job_future.add_done_callback(done)
+        return result_future
+
+    # run a job in the thread pool, returns the result
+    def run_thread_job(self, function, submit_time: float, image_data: bytes, args: tuple, kwargs: dict):
+        start_time = time.perf_counter()
+        try:
+            result = function(image_data, *args, **kwargs)
+        except Exception as e:
+            self.record(function, submit_time, None)
+            raise e
+        self.record(function, submit_time, time.perf_counter() - start_time)
+        return result
+
+    # run an image job and wait for the result
+    def run(self, function, image_data: bytes, *args, **kwargs):
+        return self.submit(function, image_data, *args, **kwargs).result()
+
+    # run an image job without blocking the event loop
+    async def run_async(self, function, image_data: bytes, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(function, image_data, *args, **kwargs))
+
+    # get the bytes that can be uploaded in a message in a server with the given boost tier
+    def get_upload_limit(self, premium_tier: int):
+        limit = self.upload_limits[max(0, min(len(self.upload_limits) - 1, premium_tier))]
+        return int(limit * 1024 * 1024) - self.upload_margin
+
+    # fit the images of a message in the upload limit, returns the data and file name to upload for each image
+    # images that already fit are uploaded as they are, the budget left is shared by the images that must be encoded again
+    def fit_upload(self, images: list[tuple[bytes, str]], premium_tier: int):
+        budget = self.get_upload_limit(premium_tier)
+        if sum(len(image_data) for (image_data, file_name) in images) <= budget:
+            return images
+
+        budgets = [0] * len(images)
+        remaining = len(images)
+        for index in sorted(range(len(images)), key=lambda index: len(images[index][0])):
+            budgets[index] = budget // remaining
+            if len(images[index][0]) <= budgets[index]:
+                budgets[index] = len(images[index][0])
+            budget -= budgets[index]
+            remaining -= 1
+
+        futures = [self.submit(encode_for_upload, image_data, image_budget) for ((image_data, file_name), image_budget) in zip(images, budgets)]
+        upload_images: list[tuple[bytes, str]] = []
+        for ((image_data, file_name), future) in zip(images, futures):
+            (upload_data, extension) = future.result()
+            if extension:
+                print(f'Image too large: {len(image_data)} bytes - Converted to {extension.upper()}: {len(upload_data)} bytes')
+                file_name = file_name.rsplit('.', 1)[0] + '.' + extension
+            upload_images.append((upload_data, file_name))
+        return upload_images
+
+    def record(self, function, submit_time: float, work_seconds: float):
+        total_seconds = time.perf_counter() - submit_time
+        with self.lock:
+            self.queue_depth -= 1
+            if work_seconds == None:
+                return
+            stats = self.stats.setdefault(function.__name__, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += max(0.0, total_seconds - work_seconds)
+            stats[2] += work_seconds
+
+    # get a printable report of the image jobs
+    def get_report(self):
+        with self.lock:
+            lines = [f'Image Workers:{self.workers} - Queue Depth:{self.queue_depth}']
+            for (name, (count, wait_seconds, work_seconds)) in self.stats.items():
+                lines.append(f'{name} - Jobs:{count} - Wait:{wait_seconds / count * 1000.0:.1f}ms - Work:{work_seconds / count * 1000.0:.1f}ms')
+        return lines
+
+image_handler = ImageHandler()
+atexit.register(image_handler.shutdown)
+
+# compare the outpaint mask with the per-pixel python loop it replaced: python -m core.imagehandler
+if __name__ == '__main__':
+    def build_outpaint_mask_loop(image_data: bytes):
+        image_a = Image.open(io.BytesIO(image_data)).split()[3]
+        image_a = image_a.filter(ImageFilter.BoxBlur(radius=64.0))
+        image_a.putdata([((c - 127) * 2) for c in image_a.getdata()])
+        mask = Image.new('L', image_a.size, 255)
+        mask.paste(image_a, (0, 0, image_a.width, image_a.height))
+        buffer = io.BytesIO()
+        mask.save(buffer, format='PNG')
+        return buffer.getvalue()
+
+    for size in (512, 1024, 2048):
+        buffer = io.BytesIO()
+        Image.radial_gradient('L').resize((size, size)).convert('RGB').save(buffer, format='PNG')
+        image_data = buffer.getvalue()
+
+        (outpaint_data, mask_data) = build_outpaint(image_data, 'center')
+        outpaint_image = Image.open(io.BytesIO(outpaint_data))
+        outpaint_image.load()
+
+        start_time = time.perf_counter()
+        loop_mask_data = build_outpaint_mask_loop(outpaint_data)
+        loop_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        mask_data = encode_png(get_mask(outpaint_image, True))
+        vector_seconds = time.perf_counter() - start_time
+
+        same = Image.open(io.BytesIO(mask_data)).tobytes() == Image.open(io.BytesIO(loop_mask_data)).tobytes()
+        print(f'{size}x{size} - Loop:{loop_seconds * 1000.0:.1f}ms - Vectorised:{vector_seconds * 1000.0:.1f}ms - Speedup:{loop_seconds / vector_seconds:.1f}x - Same mask:{same}')
@@ -1,7 +1,5 @@
 import os
 import csv
-import base64
-import contextlib
 import discord
 import io
 import re
@@ -13,13 +11,13 @@ import asyncio
 import threading
 from urllib.parse import quote
 from difflib import SequenceMatcher
-from PIL import Image, PngImagePlugin
 from discord import option
 from discord.ui import InputText, Modal, View
 from discord.ext import commands
 from typing import Optional
 
 from core import utility
+from core import imagehandler
 from core import queuehandler
 from core import settings
 from core import viewhandler
@@ -480,52 +478,40 @@ class Minigame:
                 queuehandler.dream_queue.process_dream(queue_object, 0, False)
                 return
 
-            # construct a payload for data model
+            # construct a payload for data model, only sent if it is not already loaded
             if queue_object.data_model:
                 model_payload = {
                     'sd_model_checkpoint': queue_object.data_model
                 }
-                s.post(url=f'{web_ui.url}/sdapi/v1/options', json=model_payload, timeout=120)
+                web_ui.set_options(s, model_payload)
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
+            queuehandler.job_runner.call_later(0.1, queue_continue.set)
+
+            payload = web_ui.remove_set_overrides(queue_object.payload)
 
             if self.adventure and queue_object.init_url:
                 # workaround for batched init_images payload not working correctly on AUTOMATIC1111
-                images: list[str] = queue_object.payload['init_images']
+                images: list[str] = payload['init_images']
                 payloads: list[dict] = []
-                threads: list[threading.Thread] = []
-                responses: list[requests.Response] = []
 
-                queue_object.payload['init_images'] = []
+                payload['init_images'] = []
 
                 for index, image in enumerate(images):
                     new_payload = {}
-                    new_payload.update(queue_object.payload)
+                    new_payload.update(payload)
                     new_payload['init_images'] = [image]
                     new_payload['seed'] = int(new_payload['seed']) + index
                     new_payload['n_iter'] = 1
                     payloads.append(new_payload)
-                    responses.append(None)
 
-                def img2img(thread_index, thread_payload):
+                def img2img(thread_payload):
                     try:
-                        responses[thread_index] = s.post(url=f'{web_ui.url}/sdapi/v1/img2img', json=thread_payload, timeout=120)
+                        return s.post(url=f'{web_ui.url}/sdapi/v1/img2img', json=thread_payload, timeout=120)
                     except Exception as e:
-                        responses[thread_index] = e
-
-                for index, payload in enumerate(payloads):
-                    thread = threading.Thread(target=img2img, args=[index, payload], daemon=True)
-                    threads.append(thread)
-
-                for thread in threads:
-                    thread.start()
+                        return e
 
-                for thread in threads:
-                    thread.join()
+                responses: list[requests.Response] = queuehandler.job_runner.map(img2img, payloads)
 
                 for response in responses:
                     if type(response) is not requests.Response:
@@ -542,7 +528,7 @@ class Minigame:
                 # end of workaround
             else:
                 # do normal batched payload
-                response = s.post(url=f'{web_ui.url}/sdapi/v1/txt2img', json=queue_object.payload, timeout=120)
+                response = s.post(url=f'{web_ui.url}/sdapi/v1/txt2img', json=payload, timeout=120)
                 response_data = response.json()
 
             if self.running == False:
@@ -562,12 +548,12 @@ class Minigame:
                     keep_chars = (' ', '.', '_')
                     file_name = ''.join(c for c in queue_object.prompt if c.isalnum() or c in keep_chars).rstrip()
 
-                    # save local copy of image and prepare PIL images
-                    pil_images: list[Image.Image] = []
+                    # add the metadata to the png sent by the webui, the same data is saved and uploaded
+                    images_data: list[bytes] = []
                     self.images_base64 = []
                     for i, image_base64 in enumerate(response_data['images']):
-                        image = Image.open(io.BytesIO(base64.b64decode(image_base64.split(',',1)[0])))
-                        pil_images.append(image)
+                        image_data = utility.add_png_text(utility.decode_image(image_base64), 'parameters', response_data['info'])
+                        images_data.append(image_data)
 
                         image_base64 = 'data:image/png;base64,' + image_base64
                         self.images_base64.append(image_base64)
@@ -577,10 +563,8 @@ class Minigame:
                             try:
                                 epoch_time = int(time.time())
                                 file_path = f'{settings.global_var.dir}/{epoch_time}-{queue_object.seed}-{file_name[0:120]}-{i}.png'
-
-                                metadata = PngImagePlugin.PngInfo()
-                                metadata.add_text('parameters', response_data['info'])
-                                image.save(file_path, pnginfo=metadata)
+                                with open(file_path, 'wb') as f:
+                                    f.write(image_data)
                                 print(f'Saved image: {file_path}')
                             except Exception as e:
                                 print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
@@ -595,20 +579,15 @@ class Minigame:
                                             f' took me `{generation_time:.2f}` seconds!' +
                                             queue_object.message[command_end_index:])
         
-                    # post to discord
-                    with contextlib.ExitStack() as stack:
-                        buffer_handles = [stack.enter_context(io.BytesIO()) for _ in pil_images]
-
-                        for (pil_image, buffer) in zip(pil_images, buffer_handles):
-                            pil_image.save(buffer, 'PNG')
-                            buffer.seek(0)
-
-                        files = [discord.File(fp=buffer, filename=f'{queue_object.seed}-{i}.png') for (i, buffer) in enumerate(buffer_handles)]
-                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                            content=f'<@{user.id}> {queue_object.message}', files=files, view=queue_object.view
-                        ))
-                        queue_object.view = None
-                        self.image_count += queue_object.batch
+                    # post to discord, images that are too large for the server are encoded again
+                    images = [(image_data, f'{queue_object.seed}-{i}.png') for (i, image_data) in enumerate(images_data)]
+                    images = imagehandler.image_handler.fit_upload(images, utility.get_premium_tier(queue_object.ctx))
+                    files = [discord.File(fp=io.BytesIO(image_data), filename=file_name) for (image_data, file_name) in images]
+                    queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
+                        content=f'<@{user.id}> {queue_object.message}', files=files, view=queue_object.view
+                    ))
+                    queue_object.view = None
+                    self.image_count += queue_object.batch
 
                 except Exception as e:
                     self.view = self.view_last
@@ -616,7 +595,7 @@ class Minigame:
                     print(content + f'\n{traceback.print_exc()}')
                     queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
-            threading.Thread(target=post_dream, daemon=True).start()
+            queuehandler.job_runner.submit(post_dream)
 
         except requests.exceptions.RequestException as e:
             # connection error, return items to queue
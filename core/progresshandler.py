@@ -0,0 +1,226 @@
+import asyncio
+import discord
+import io
+import threading
+import time
+import traceback
+
+from core import utility
+from core import settings
+from core import imagehandler
+
+# limits how often each discord channel is edited, updates over the limit are dropped
+class RateLimiter:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time: dict[int, float] = {}
+
+    def acquire(self, key: int):
+        with self.lock:
+            now = time.time()
+            if now < self.next_time.get(key, 0.0):
+                return False
+            self.next_time[key] = now + self.interval
+            return True
+
+# the acknowledgement message of a command, edited to show the progress of its dreams
+class ProgressMessage:
+    def __init__(self, message: discord.Message | discord.Interaction, content: str, channel_id: int, delete_after: float, queue_objects: list[utility.DreamObject]):
+        self.message = message
+        self.content = content
+        self.channel_id = channel_id
+        self.delete_after = delete_after
+        self.queue_objects = queue_objects
+        self.finished = False
+
+    def get_content(self, queue_object: utility.DreamObject, progress: float, eta: float):
+        content = f'{self.content}\nProgress: ``{int(progress * 100.0)}%``'
+        if len(self.queue_objects) > 1:
+            content += f' - Dream: ``{self.queue_objects.index(queue_object) + 1}/{len(self.queue_objects)}``'
+        if eta > 0.0:
+            content += f' - ETA: ``~{utility.format_duration(eta)}``'
+        return content
+
+    async def edit(self, content: str, file: discord.File = None, clear_files = False):
+        edit_args = {'content': content}
+        if file:
+            edit_args['file'] = file
+            edit_args['attachments'] = []
+        elif clear_files:
+            edit_args['attachments'] = []
+
+        try:
+            if type(self.message) is discord.Interaction:
+                await self.message.edit_original_response(**edit_args)
+            else:
+                await self.message.edit(**edit_args)
+        except discord.NotFound:
+            pass
+        except Exception as e:
+            print(f'Progress update failed:\n{e}')
+
+    # show the original message again and remove it later, like messages without progress
+    async def finish(self):
+        await self.edit(self.content, clear_files=True)
+        try:
+            if type(self.message) is discord.Interaction:
+                await self.message.delete_original_response(delay=self.delete_after)
+            else:
+                await self.message.delete(delay=self.delete_after)
+        except discord.NotFound:
+            pass
+
+# polls the progress of the dream running on a webui instance, one poller is shared by all dreams on the instance
+class ProgressPoller:
+    def __init__(self, web_ui: utility.WebUI):
+        self.web_ui = web_ui
+        self.queue_condition = threading.Condition()
+        self.queue: list[utility.DreamObject] = [] # dreams sent to the webui, in the order they run
+        self.poll_thread = threading.Thread()
+
+    def track(self, queue_object: utility.DreamObject):
+        with self.queue_condition:
+            self.queue.append(queue_object)
+            if self.poll_thread.is_alive() == False:
+                self.poll_thread = threading.Thread(target=self.run, daemon=True)
+                self.poll_thread.start()
+
+    def untrack(self, queue_object: utility.DreamObject):
+        with self.queue_condition:
+            try:
+                self.queue.remove(queue_object)
+            except:
+                pass
+
+    def run(self):
+        while True:
+            with self.queue_condition:
+                # stop polling once the webui is idle, track will start a new thread
+                if not self.queue:
+                    return
+                queue_object = self.queue[0]
+
+            progress_message: ProgressMessage = queue_object.progress_message
+            if progress_message and progress_handler.channel_limiter.acquire(progress_message.channel_id):
+                try:
+                    self.poll(queue_object, progress_message)
+                except Exception as e:
+                    print(f'Progress poll failed on {self.web_ui.url}:\n{e}\n{traceback.print_exc()}')
+
+            time.sleep(progress_handler.interval)
+
+    def poll(self, queue_object: utility.DreamObject, progress_message: ProgressMessage):
+        s = self.web_ui.get_session()
+        if s == None:
+            return
+
+        skip_current_image = 'false' if progress_handler.preview else 'true'
+        response_data = s.get(f'{self.web_ui.url}/sdapi/v1/progress?skip_current_image={skip_current_image}', timeout=5).json()
+        progress = float(response_data.get('progress', 0.0))
+        if progress <= 0.0 or queue_object.progress_done:
+            return
+
+        # shrink the preview so it uploads quickly
+        file = None
+        if progress_handler.preview and response_data.get('current_image'):
+            image_data = utility.decode_image(response_data['current_image'])
+            preview_data = imagehandler.image_handler.run(imagehandler.build_preview, image_data, progress_handler.preview_size)
+            file = discord.File(fp=io.BytesIO(preview_data), filename='preview.jpg')
+
+        content = progress_message.get_content(queue_object, progress, float(response_data.get('eta_relative', 0.0)))
+        asyncio.run_coroutine_threadsafe(progress_message.edit(content, file), progress_handler.event_loop)
+
+# shows the progress of dreams by editing the message that acknowledged the command
+class ProgressHandler:
+    def __init__(self):
+        self.enabled = True
+        self.preview = False
+        self.preview_size = 256
+        self.interval = 2.0
+        self.lock = threading.Lock()
+        self.pollers: dict[str, ProgressPoller] = {}
+        self.channel_limiter = RateLimiter(1.0) # discord allows about 5 edits every 5 seconds in a channel
+        self.event_loop = asyncio.get_event_loop()
+
+    def setup(self):
+        self.enabled = settings.get_env_var('PROGRESS', 'True').lower() in ('true', 'yes', '1')
+        self.preview = settings.get_env_var('PROGRESS_PREVIEW', 'False').lower() in ('true', 'yes', '1')
+        try:
+            self.interval = max(1.0, float(settings.get_env_var('PROGRESS_INTERVAL', '2.0')))
+        except:
+            print('> - Warning: PROGRESS_INTERVAL must be a number')
+
+    # a dream has been sent to a webui instance
+    def start_dream(self, web_ui: utility.WebUI, queue_object: utility.DreamObject):
+        if self.enabled == False or type(queue_object) is not utility.DrawObject:
+            return
+
+        with self.lock:
+            poller = self.pollers.get(web_ui.url)
+            if poller == None:
+                poller = ProgressPoller(web_ui)
+                self.pollers[web_ui.url] = poller
+        poller.track(queue_object)
+
+    # a dream has left its webui instance, it may be returned to the queue
+    def stop_dream(self, web_ui: utility.WebUI, queue_object: utility.DreamObject):
+        with self.lock:
+            poller = self.pollers.get(web_ui.url)
+        if poller:
+            poller.untrack(queue_object)
+
+    # a dream is completed, rejected or cancelled, restore the acknowledgement once all of its dreams are done
+    def finish_dream(self, queue_object: utility.DreamObject):
+        with self.lock:
+            queue_object.progress_done = True
+            progress_message: ProgressMessage = queue_object.progress_message
+            finished = progress_message != None and self.is_finished(progress_message)
+        if finished:
+            asyncio.run_coroutine_threadsafe(progress_message.finish(), self.event_loop)
+
+    # check if all dreams of a message are done, marking it as finished the first time
+    def is_finished(self, progress_message: ProgressMessage):
+        if progress_message.finished:
+            return False
+        for queue_object in progress_message.queue_objects:
+            if queue_object.progress_done == False:
+                return False
+        progress_message.finished = True
+        return True
+
+    # send the acknowledgement of a command and attach it to its dreams so it can show their progress
+    async def send_acknowledgement(self, ctx: discord.ApplicationContext | discord.Interaction | discord.Message, content: str, delete_after: float, queue_objects: list[utility.DreamObject]):
+        if self.enabled == False:
+            delete = delete_after
+        else:
+            delete = None
+
+        if type(ctx) is discord.ApplicationContext:
+            message = await ctx.send_response(content=content, delete_after=delete)
+        elif type(ctx) is discord.Interaction:
+            message = await ctx.response.send_message(content=content, delete_after=delete)
+        elif type(ctx) is discord.Message:
+            message = await ctx.reply(content, delete_after=delete)
+        else:
+            message = await ctx.channel.send(content, delete_after=delete)
+
+        if self.enabled == False:
+            return
+
+        # edit the message itself rather than through the interaction, which expires before long queues are done
+        if type(message) is discord.Interaction:
+            try:
+                message = await message.original_response()
+            except Exception as e:
+                print(f'Progress message not found, updating through the interaction:\n{e}')
+
+        progress_message = ProgressMessage(message, content, ctx.channel.id, delete_after, queue_objects)
+        with self.lock:
+            for queue_object in queue_objects:
+                queue_object.progress_message = progress_message
+            finished = self.is_finished(progress_message)
+        if finished:
+            await progress_message.finish()
+
+progress_handler = ProgressHandler()
@@ -0,0 +1,56 @@
+import discord
+import asyncio
+import traceback
+from discord.ext import commands
+
+from core import utility
+from core import settings
+from core import queuehandler
+
+class QueueCog(commands.Cog, description='Shows your images in queue.'):
+    def __init__(self, bot: discord.Bot):
+        self.bot = bot
+
+    @commands.slash_command(name = 'queue', description = 'Shows your images in queue and when they should be done.')
+    async def queue(self, ctx: discord.ApplicationContext):
+        loop = asyncio.get_running_loop()
+        user = utility.get_user(ctx)
+
+        try:
+            user_dreams = queuehandler.dream_queue.get_user_dreams(user.id)
+
+            embed = discord.Embed(color=settings.global_var.embed_color)
+            if not user_dreams:
+                embed.add_field(name='Queue', value='You have no dreams in queue.', inline=False)
+            else:
+                lines: list[str] = []
+                for (position, queue_object) in user_dreams[:20]:
+                    if position == 0:
+                        line = 'In progress'
+                    else:
+                        line = f'Position ``{position}``'
+
+                    eta = queuehandler.dream_queue.get_eta_text(queue_object)
+                    if eta: line += f' - ETA: ``~{eta}``'
+
+                    if type(queue_object) is utility.DrawObject:
+                        line += f' - ``{queue_object.prompt[:40]}``'
+                    else:
+                        line += f' - {type(queue_object).__name__.replace("Object", "")}'
+                    lines.append(line)
+
+                if len(user_dreams) > 20:
+                    lines.append(f'...and {len(user_dreams) - 20} more')
+
+                embed.add_field(name=f'Your Dreams ({len(user_dreams)})', value='\n'.join(lines), inline=False)
+                embed.add_field(name='Total Queue', value=f'``{queuehandler.dream_queue.get_queue_length()}``', inline=False)
+
+            loop.create_task(ctx.respond(embed=embed, ephemeral=True))
+
+        except Exception as e:
+            content = f'<@{user.id}> Something went wrong.\n{e}'
+            print(content + f'\n{traceback.print_exc()}')
+            loop.create_task(ctx.respond(content=content, ephemeral=True, delete_after=30))
+
+def setup(bot: discord.Bot):
+    bot.add_cog(QueueCog(bot))
@@ -1,24 +1,217 @@
 import time
+import heapq
+import itertools
 import asyncio
 import discord
 import traceback
 import threading
 import requests
+import concurrent.futures
+import collections
 
 from core import utility
 from core import settings
+from core import costmodel
+from core import progresshandler
+from core import queuejournal
+from core import imagehandler
+from core import imagecache
 
 
+# priority queue of dreams, indexed so a dream can be removed without searching the queue
+class DreamHeap:
+    def __init__(self):
+        self.heap: list[list] = []
+        self.entries: dict[int, list] = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, queue_object: utility.DreamObject):
+        return id(queue_object) in self.entries
+
+    def push(self, queue_object: utility.DreamObject, key):
+        # the counter keeps dreams with the same key in the order they were added
+        entry = [key, next(self.counter), queue_object]
+        self.entries[id(queue_object)] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, queue_object: utility.DreamObject):
+        entry = self.entries.pop(id(queue_object), None)
+        if entry == None:
+            return False
+
+        # leave a tombstone in the heap, it gets discarded once it reaches the top
+        entry[-1] = None
+        while self.heap and self.heap[0][-1] == None:
+            heapq.heappop(self.heap)
+
+        # rebuild the heap if it is mostly tombstones
+        if len(self.heap) > 64 and len(self.heap) > len(self.entries) * 2:
+            self.heap = [entry for entry in self.heap if entry[-1] != None]
+            heapq.heapify(self.heap)
+        return True
+
+    # take the next dream off the heap without removing it from the queue, skipping tombstones, returns None if there are no more
+    # taken entries must be put back, the dreams removed while they were taken are dropped then
+    def take(self):
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry[-1] != None:
+                return entry
+        return None
+
+    def put_back(self, entries: list[list]):
+        for entry in entries:
+            if entry[-1] != None:
+                heapq.heappush(self.heap, entry)
+
+    # get all dreams in the order they should be started
+    def ordered(self):
+        return [entry[-1] for entry in self.ordered_entries()]
+
+    def ordered_entries(self):
+        return sorted(entry for entry in self.heap if entry[-1] != None)
+
+    def get_entry(self, queue_object: utility.DreamObject):
+        return self.entries.get(id(queue_object))
+
+    # update the keys of all dreams, dreams with the same key keep their order, returns the number of keys changed
+    def rekey(self, get_key):
+        changed = 0
+        for entry in self.entries.values():
+            key = get_key(entry[-1])
+            if key != entry[0]:
+                entry[0] = key
+                changed += 1
+
+        if changed:
+            self.heap = list(self.entries.values())
+            heapq.heapify(self.heap)
+        return changed
+
+# running totals of the queued compute cost and dream count for each user, and the users queued in each guild
+class DreamAccounting:
+    def __init__(self):
+        self.total_cost = 0.0
+        self.total_count = 0
+        self.user_cost: dict[int, float] = {}
+        self.user_count: dict[int, int] = {}
+        self.guild_users: dict[str, dict[int, int]] = {}
+        self.user_dreams: dict[int, dict[int, utility.DreamObject]] = {}
+
+    def add(self, queue_object: utility.DreamObject, dream_cost: float):
+        if queue_object.accounted:
+            return
+        queue_object.accounted = True
+
+        user = utility.get_user(queue_object.ctx)
+        queue_object.user_id = user.id if user else None
+        queue_object.guild_id = utility.get_guild(queue_object.ctx)
+        queue_object.dream_cost = dream_cost
+
+        self.total_cost += dream_cost
+        self.total_count += 1
+        self.user_cost[queue_object.user_id] = self.user_cost.get(queue_object.user_id, 0.0) + dream_cost
+        self.user_count[queue_object.user_id] = self.user_count.get(queue_object.user_id, 0) + 1
+        guild_users = self.guild_users.setdefault(queue_object.guild_id, {})
+        guild_users[queue_object.user_id] = guild_users.get(queue_object.user_id, 0) + 1
+        self.user_dreams.setdefault(queue_object.user_id, {})[id(queue_object)] = queue_object
+
+    def remove(self, queue_object: utility.DreamObject):
+        if not queue_object.accounted:
+            return
+        queue_object.accounted = False
+
+        dream_cost = queue_object.dream_cost
+        self.total_cost = max(0.0, self.total_cost - dream_cost)
+        self.total_count -= 1
+
+        def subtract(totals: dict, key, value):
+            totals[key] -= value
+            if totals[key] <= 1e-9:
+                del totals[key]
+        subtract(self.user_cost, queue_object.user_id, dream_cost)
+        subtract(self.user_count, queue_object.user_id, 1)
+        subtract(self.guild_users[queue_object.guild_id], queue_object.user_id, 1)
+        if not self.guild_users[queue_object.guild_id]:
+            del self.guild_users[queue_object.guild_id]
+
+        user_dreams = self.user_dreams.get(queue_object.user_id)
+        if user_dreams != None:
+            user_dreams.pop(id(queue_object), None)
+            if not user_dreams:
+                del self.user_dreams[queue_object.user_id]
+
+# runs the blocking work of dreams on bounded thread pools, with one timer loop for delayed calls
+# the work itself stays synchronous and uses requests, the loop thread only fires the timers
+# dreams get their own pool so they never wait behind the post processing they start
+class JobRunner:
+    def __init__(self):
+        self.timer_loop = asyncio.new_event_loop()
+        self.timer_thread = threading.Thread(target=self.timer_loop.run_forever, daemon=True)
+        self.dream_workers = 0
+        self.dream_executor: concurrent.futures.ThreadPoolExecutor = None
+        self.job_workers = 0
+        self.job_executor: concurrent.futures.ThreadPoolExecutor = None
+
+    def setup(self, instance_count: int):
+        if self.timer_thread.is_alive() == False:
+            self.timer_thread.start()
+
+        # each webui instance runs at most an active and a buffered dream
+        dream_workers = max(2, instance_count * 2)
+        if dream_workers != self.dream_workers:
+            if self.dream_executor: self.dream_executor.shutdown(wait=False)
+            self.dream_executor = concurrent.futures.ThreadPoolExecutor(max_workers=dream_workers, thread_name_prefix='dream')
+            self.dream_workers = dream_workers
+
+        try:
+            job_workers = max(1, int(settings.get_env_var('JOB_WORKERS', '8')))
+        except:
+            print('> - Warning: JOB_WORKERS must be a whole number')
+            job_workers = 8
+        if job_workers != self.job_workers:
+            if self.job_executor: self.job_executor.shutdown(wait=False)
+            self.job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=job_workers, thread_name_prefix='job')
+            self.job_workers = job_workers
+
+    # run a dream in a cog
+    def run_dream(self, function, *args):
+        return self.dream_executor.submit(function, *args)
+
+    # run other blocking work, such as post processing or extra webui requests
+    def submit(self, function, *args):
+        return self.job_executor.submit(function, *args)
+
+    # run blocking work for each item in parallel and return the results in order
+    def map(self, function, items: list):
+        return list(self.job_executor.map(function, items))
+
+    # call a function on the timer thread after a delay, it must not block
+    def call_later(self, delay: float, function, *args):
+        self.timer_loop.call_soon_threadsafe(self.timer_loop.call_later, delay, function, *args)
+
+    # run blocking work after a delay
+    def submit_later(self, delay: float, function, *args):
+        self.call_later(delay, self.submit, function, *args)
+
 # any command that needs to wait on processing should use the dream thread
 class DreamQueueInstance:
     def __init__(self, web_ui: utility.WebUI):
         self.web_ui = web_ui
 
         self.dream_thread = threading.Thread()
+        self.queue_condition = threading.Condition()
         self.queue_inprogress: list[utility.DreamObject] = []
         self.queue: list[utility.DreamObject] = []
 
         self.last_data_model: str = None
+        self.last_finish_time = 0.0
+        self.buffer_lead = 2.0 # seconds before the active dream finishes that the buffered dream is sent to the webui
+        self.interrupt_delay = 1.0 # the webui ignores an interrupt sent before the dream has started
+        self.stopped = False
 
         self.no_dream = False
         self.no_identify = False
@@ -34,86 +227,214 @@ class DreamQueueInstance:
             except: self.wait_for = web_ui.flags['--wait-for']
 
     def process_dream(self, queue_object: utility.DreamObject):
-        # append dream to queue
-        self.queue.append(queue_object)
+        with self.queue_condition:
+            # append dream to queue
+            self.queue.append(queue_object)
 
-        if type(queue_object) is utility.DrawObject:
-            self.last_data_model = queue_object.data_model
+            if type(queue_object) is utility.DrawObject:
+                self.last_data_model = queue_object.data_model
+
+            # start dream queue thread
+            if self.dream_thread.is_alive() == False:
+                self.dream_thread = threading.Thread(target=self.process_queue, daemon=True)
+                self.dream_thread.start()
 
-        # start dream queue thread
-        if self.dream_thread.is_alive() == False:
-            self.dream_thread = threading.Thread(target=self.process_queue, daemon=True)
-            self.dream_thread.start()
+            # wake up the dream queue thread
+            self.queue_condition.notify()
+
+    # let the dream queue thread exit once it has sent the dreams it was given, the instance is replaced when settings are reloaded
+    def stop(self):
+        with self.queue_condition:
+            self.stopped = True
+            self.queue_condition.notify()
 
     def process_queue(self):
-        active_thread = threading.Thread()
-        buffer_thread = threading.Thread()
-
-        while self.queue or self.queue_inprogress:
-            if len(self.queue) == 0:
-                # potential fix for rare case where queue gets stuck
-                if active_thread.is_alive():
-                    active_thread.join()
-                if buffer_thread.is_alive():
-                    buffer_thread.join()
-                continue
+        active_future: concurrent.futures.Future = None
+        buffer_future: concurrent.futures.Future = None
 
-            queue_object = self.queue.pop(0)
-            try:
-                # start next dream (older non-buffered queue)
-                # queue_object.cog.dream(queue_object)
+        while True:
+            with self.queue_condition:
+                # sleep until a dream is handed to this instance and the webui is almost ready for it
+                # the buffered dream stays in the local queue until then, so an idle instance can take it
+                while True:
+                    if self.stopped and not self.queue:
+                        return
+                    buffer_wait = self.get_buffer_wait()
+                    if buffer_wait == 0.0:
+                        break
+                    self.queue_condition.wait(buffer_wait)
 
                 # append queue object to in progress list
+                queue_object = self.queue.pop(0)
                 self.queue_inprogress.append(queue_object)
 
-                # queue up dream while the active thread is still running
-                if active_thread.is_alive() and buffer_thread.is_alive():
-                    active_thread.join()
-                    active_thread = buffer_thread
-                    buffer_thread = threading.Thread()
-                if active_thread.is_alive():
-                    buffer_thread = active_thread
-
+            try:
+                # queue up dream while the active dream is still running
+                if active_future and not active_future.done() and buffer_future and not buffer_future.done():
+                    concurrent.futures.wait([active_future])
+                    active_future = buffer_future
+                    buffer_future = None
+                if active_future and not active_future.done():
+                    buffer_future = active_future
+
+                # wait for active dream to complete, or event to activate (indicating it is safe to continue)
                 active_thread_event = threading.Event()
-                active_thread = threading.Thread(target=queue_object.cog.dream, args=[queue_object, self.web_ui, active_thread_event], daemon=True)
-                active_thread.start()
-
-                # wait for active thread to complete, or event to activate (indicating it is safe to continue)
-                def wait_for_join():
-                    active_thread.join()
-                    active_thread_event.set()
-                    try:
-                        self.queue_inprogress.pop(0) # remove in progress object after completion
-                    except:
-                        pass
-                wait_thread_join = threading.Thread(target=wait_for_join, daemon=True)
-                wait_thread_join.start()
+                active_future = job_runner.run_dream(self.run_dream, queue_object, active_thread_event)
                 active_thread_event.wait()
 
             except Exception as e:
                 print(f'Dream failure:\n{queue_object}\n{e}\n{traceback.print_exc()}')
                 # reset inprogress list in case of failure
-                if self.queue_inprogress: self.queue_inprogress = []
+                with self.queue_condition:
+                    if self.queue_inprogress: self.queue_inprogress = []
+                dream_queue.notify()
+
+    # run the dream in the cog, then let the dream queue know this instance has room
+    def run_dream(self, queue_object: utility.DreamObject, queue_continue: threading.Event):
+        dream_attempts = queue_object.dream_attempts
+        start_time = time.time()
+        queue_object.start_time = start_time
+        static_cost = dream_queue.get_static_dream_cost(queue_object)
+        batch = 1
+        if type(queue_object) is utility.DrawObject:
+            batch = costmodel.cost_model.get_batch(queue_object) # the payload is cleared once the webui has responded
 
-    def clear_user_queue(self, user_id: int):
-        total_cleared: int = 0
-        index = len(self.queue)
-        while index > 0:
-            index -= 1
-            user_compare = utility.get_user(self.queue[index].ctx)
-            if user_id == user_compare.id:
-                self.queue.pop()
-                total_cleared += 1
-        return total_cleared
+        # dreams that load a new checkpoint are not used to learn the cost of a dream
+        model_switch = False
+        if type(queue_object) is utility.DrawObject and queue_object.data_model:
+            with self.web_ui.options_lock:
+                model_switch = not self.web_ui.is_option_set('sd_model_checkpoint', queue_object.data_model)
+        predicted_seconds = None if model_switch else costmodel.cost_model.predict_seconds(queue_object, self.web_ui)
 
-    def get_user_queue_length(self, user_id):
-        queue_length = 0
-        queue = self.queue + self.queue_inprogress
-        for dream_object in queue:
-            user_compare = utility.get_user(dream_object.ctx)
-            if user_id == user_compare.id:
-                queue_length += 1
-        return queue_length
+        try:
+            # the dream was cancelled before it was sent to the webui
+            if queue_object.cancelled:
+                return
+            progresshandler.progress_handler.start_dream(self.web_ui, queue_object)
+            self.web_ui.pop_response_status()
+            queue_object.cog.dream(queue_object, self.web_ui, queue_continue)
+        finally:
+            queue_continue.set()
+            progresshandler.progress_handler.stop_dream(self.web_ui, queue_object)
+
+            # record the time this dream had the webui to itself, the payload is cleared once the webui has responded
+            end_time = time.time()
+            run_seconds = end_time - max(start_time, self.last_finish_time)
+            if queue_object.dream_attempts == dream_attempts and queue_object.payload == None and model_switch == False and queue_object.cancelled == False:
+                try:
+                    costmodel.cost_model.record(queue_object, self.web_ui, run_seconds, static_cost, batch)
+                except Exception as e:
+                    print(f'Cost model update failed:\n{e}\n{traceback.print_exc()}')
+            self.last_finish_time = end_time
+
+            with self.queue_condition:
+                try:
+                    self.queue_inprogress.remove(queue_object) # remove in progress object after completion
+                except:
+                    pass
+                self.queue_condition.notify()
+
+                # a cancelled dream that was already waiting on the webui starts now, stop it once it is running
+                if self.queue_inprogress and self.queue_inprogress[0].cancelled:
+                    job_runner.submit_later(self.interrupt_delay, self.interrupt_dream, self.queue_inprogress[0])
+
+            # a dream returned to the queue by the cog failed on this instance, otherwise the response to the dream decides
+            # client errors are the fault of the dream rather than the instance, so they are not recorded
+            response_status = self.web_ui.pop_response_status()
+            if queue_object.cancelled == False:
+                if queue_object.dream_attempts != dream_attempts or (response_status != None and response_status >= 500):
+                    self.web_ui.health.record(False)
+                elif response_status != None and response_status < 400:
+                    slowdown = run_seconds / predicted_seconds if predicted_seconds else None
+                    self.web_ui.health.record(True, slowdown)
+
+            # the dream is finished unless the cog returned it to the queue
+            if queue_object.dream_attempts == dream_attempts:
+                dream_queue.finish_dream(queue_object, self)
+            else:
+                dream_queue.notify()
+
+    # get the predicted seconds left on the active dream, negative if it is taking longer than predicted
+    def get_active_remaining(self):
+        if not self.queue_inprogress or self.queue_inprogress[0].start_time == None:
+            return None
+        active_object = self.queue_inprogress[0]
+        return active_object.start_time + dream_queue.estimator.get_seconds(active_object, self) - time.time()
+
+    # get the seconds until the next local dream should be started, 0.0 to start it now or None to wait for a change
+    def get_buffer_wait(self):
+        if not self.queue:
+            return None
+        if not self.queue_inprogress:
+            return 0.0
+        if len(self.queue_inprogress) > 1:
+            return None
+
+        # keep the dream back while the active dream is running late, it is likely a checkpoint load or a large dream
+        remaining = self.get_active_remaining()
+        if remaining == None or remaining < 0.0:
+            return None
+        return max(0.0, remaining - self.buffer_lead)
+
+    # give up a dream that has not been sent to the webui yet, so an idle instance can run it instead
+    def steal_dream(self, dream_instance: 'DreamQueueInstance', steal_wait: float):
+        with self.queue_condition:
+            if not self.queue or not self.queue_inprogress:
+                return None
+
+            # prefer a dream that uses the checkpoint already loaded on the idle instance
+            queue_object: utility.DreamObject = None
+            for local_object in self.queue:
+                if not dream_instance.is_valid(local_object):
+                    continue
+                if type(local_object) is not utility.DrawObject or local_object.data_model == dream_instance.last_data_model:
+                    queue_object = local_object
+                    break
+                if queue_object == None:
+                    queue_object = local_object
+            if queue_object == None:
+                return None
+
+            # only load a different checkpoint on the idle instance if the dream would wait long here
+            if type(queue_object) is utility.DrawObject and queue_object.data_model != dream_instance.last_data_model:
+                remaining = self.get_active_remaining()
+                if remaining != None and 0.0 <= remaining < steal_wait:
+                    return None
+
+            self.queue.remove(queue_object)
+            self.last_data_model = None
+            for local_object in reversed(self.queue_inprogress + self.queue):
+                if type(local_object) is utility.DrawObject:
+                    self.last_data_model = local_object.data_model
+                    break
+            return queue_object
+
+    def clear_user_queue(self, user_id: int):
+        cleared: list[utility.DreamObject] = []
+        with self.queue_condition:
+            for queue_object in list(self.queue):
+                if queue_object.user_id == user_id:
+                    self.queue.remove(queue_object)
+                    cleared.append(queue_object)
+        return cleared
+
+    # stop a cancelled dream if it is still the one running on the webui
+    def interrupt_dream(self, queue_object: utility.DreamObject):
+        with self.queue_condition:
+            if not self.queue_inprogress or self.queue_inprogress[0] is not queue_object:
+                return
+        self.web_ui.interrupt()
+
+    # stop the dreams of a user that were already sent to the webui, returns the stopped dreams
+    def interrupt_user_queue(self, user_id: int):
+        with self.queue_condition:
+            interrupted = [queue_object for queue_object in self.queue_inprogress if queue_object.user_id == user_id and queue_object.cancelled == False]
+            interrupt_active = bool(interrupted) and self.queue_inprogress[0] is interrupted[0]
+
+        # dreams behind the active dream are stopped when they start, see run_dream
+        if interrupt_active:
+            job_runner.submit(self.web_ui.interrupt)
+        return interrupted
 
     def get_queue_length(self):
         return len(self.queue_inprogress) + len(self.queue)
@@ -144,6 +465,17 @@ class DreamQueueInstance:
 
         return True
 
+    # check if the health check allows dreams to be sent to this instance
+    def is_healthy(self):
+        state = self.web_ui.health.state
+        if state == 'closed':
+            return True
+
+        # a half-open instance gets a single trial dream
+        if state == 'half-open':
+            return self.get_queue_length() == 0
+        return False
+
     def is_ready(self, buffer_limit: int = 2):
         # check if too many items are queued up
         if self.get_queue_length() >= buffer_limit:
@@ -156,13 +488,13 @@ class DreamQueueInstance:
         # check if we need to wait for any webui instances to finish
         if type(self.wait_for) is DreamQueueInstance:
             dream_instance = self.wait_for
-            if dream_instance.dream_thread.is_alive() or dream_instance.get_queue_length() > 0:
+            if dream_instance.get_queue_length() > 0:
                 return False
 
         # convert URL_ID to dream queue instance using index
         elif type(self.wait_for) is int and self.wait_for >= 0 and self.wait_for <= len(dream_queue.dream_instances) - 1:
             self.wait_for = dream_queue.dream_instances[self.wait_for] # convert wait_for to a direct reference of a dream queue instance
-            if self.wait_for.dream_thread.is_alive() or self.wait_for.get_queue_length() > 0:
+            if self.wait_for.get_queue_length() > 0:
                 return False
 
         # convert URL_ID to dream queue instance using URL string
@@ -170,30 +502,188 @@ class DreamQueueInstance:
             for dream_instance in dream_queue.dream_instances:
                 if dream_instance.web_ui.url == self.wait_for:
                     self.wait_for = dream_instance # convert wait_for to a direct reference of a dream queue instance
-                    if self.wait_for.dream_thread.is_alive() or self.wait_for.get_queue_length() > 0:
+                    if self.wait_for.get_queue_length() > 0:
                         return False
                     break
 
         return True
 
+# predicts when each dream will start and finish by simulating the queue on the dream instances
+class QueueEstimator:
+    def __init__(self):
+        self.dirty = True
+        self.instance_free_time: dict[int, float] = {} # time each dream instance is free after the last estimated dream
+        self.instance_dreams: dict[int, list[utility.DreamObject]] = {} # dreams estimated on each dream instance, in order
+        self.last_entry: list = None # position in the queue of the last estimated dream
+
+    # the queue changed in a way that needs a new simulation
+    def invalidate(self):
+        self.dirty = True
+
+    def get_seconds(self, queue_object: utility.DreamObject, dream_instance: DreamQueueInstance):
+        seconds = costmodel.cost_model.predict_seconds(queue_object, dream_instance.web_ui)
+        if seconds == None:
+            seconds = queue_object.dream_cost * costmodel.cost_model.get_seconds_per_cost(dream_instance.web_ui)
+        return seconds
+
+    # simulate the whole queue, dream_queue.queue_condition must be held
+    def estimate(self, dream_queue: 'DreamQueue'):
+        now = time.time()
+
+        # dreams already handed to an instance run in order on that instance
+        self.instance_free_time = {}
+        self.instance_dreams = {}
+        for dream_instance in dream_queue.dream_instances:
+            free_time = now
+            instance_dreams = list(dream_instance.queue_inprogress) + list(dream_instance.queue)
+            self.instance_dreams[id(dream_instance)] = instance_dreams
+            for index, queue_object in enumerate(instance_dreams):
+                if index == 0 and queue_object.start_time:
+                    start_time = queue_object.start_time
+                else:
+                    start_time = free_time
+                queue_object.eta_start = start_time
+                queue_object.eta_finish = max(now, start_time + self.get_seconds(queue_object, dream_instance))
+                free_time = queue_object.eta_finish
+            self.instance_free_time[id(dream_instance)] = free_time
+
+        # queued dreams go to whichever valid instance finishes them first
+        self.last_entry = None
+        for entry in dream_queue.queue_heap.ordered_entries():
+            self.estimate_queued(dream_queue, entry[-1])
+            self.last_entry = entry[:2]
+        self.dirty = False
+
+    def estimate_queued(self, dream_queue: 'DreamQueue', queue_object: utility.DreamObject):
+        now = time.time()
+        best_instance: DreamQueueInstance = None
+        for dream_instance in dream_queue.dream_instances:
+            if not dream_instance.is_valid(queue_object):
+                continue
+            start_time = max(now, self.instance_free_time.get(id(dream_instance), now))
+            finish_time = start_time + self.get_seconds(queue_object, dream_instance)
+            if best_instance == None or finish_time < queue_object.eta_finish:
+                best_instance = dream_instance
+                queue_object.eta_start = start_time
+                queue_object.eta_finish = finish_time
+
+        if best_instance == None:
+            queue_object.eta_start = None
+            queue_object.eta_finish = None
+        else:
+            self.instance_free_time[id(best_instance)] = queue_object.eta_finish
+            self.instance_dreams[id(best_instance)].append(queue_object)
+
+    # a dream finished on an instance, move the dreams estimated after it on that instance by how far off its prediction was
+    # the other instances are left as they are, so finishing a dream does not simulate the whole queue again
+    def finish(self, dream_instance: DreamQueueInstance, queue_object: utility.DreamObject):
+        if self.dirty:
+            return
+
+        instance_dreams = self.instance_dreams.get(id(dream_instance))
+        if instance_dreams == None or queue_object not in instance_dreams or queue_object.eta_finish == None:
+            self.dirty = True
+            return
+
+        shift = time.time() - queue_object.eta_finish
+        instance_dreams.remove(queue_object)
+        for instance_object in instance_dreams:
+            instance_object.eta_start += shift
+            instance_object.eta_finish += shift
+        self.instance_free_time[id(dream_instance)] += shift
+
+    # extend the simulation with a newly queued dream, the whole queue is only simulated again if it was not added to the end
+    def append(self, dream_queue: 'DreamQueue', queue_object: utility.DreamObject):
+        if self.dirty:
+            return
+
+        entry = dream_queue.queue_heap.get_entry(queue_object)
+        if entry == None or (self.last_entry != None and entry[:2] < self.last_entry):
+            self.dirty = True
+            return
+
+        self.estimate_queued(dream_queue, queue_object)
+        self.last_entry = entry[:2]
+
 # queue handler for dreams
 class DreamQueue:
     def __init__(self):
         self.dream_instances: list[DreamQueueInstance] = []
         self.dream_thread = threading.Thread()
-
-        # a separate list of queues sorted by their priority, ranging from 0 to 9
-        self.queues: list[list[utility.DreamObject]] = []
-        for i in range(10):
-            self.queues.append([])
+        self.queue_condition = threading.Condition()
+        self.queue_updated = False
+
+        # a single queue sorted by priority, ranging from 0 to 9
+        self.queue_heap = DreamHeap()
+        self.priority_counts: list[int] = [0] * 10
+        self.accounting = DreamAccounting()
+        self.estimator = QueueEstimator()
+
+        # fair queueing - dreams within a priority are ordered by the compute each user has already been given
+        self.fair_queue = False
+        self.virtual_time = 0.0
+        self.finish_tags: dict[int, float] = {}
+
+        # checkpoint affinity - look ahead in the queue for dreams that use the checkpoint already loaded
+        self.affinity_window = 0
+        self.affinity_skips = 4
+        self.model_switches = 0
+        self.model_switches_avoided = 0
+
+        # work stealing - idle instances take dreams buffered on busy instances
+        self.steal_wait = 10.0 # seconds a buffered dream must be expected to wait before an idle instance loads another checkpoint for it
+        self.steal_interval = 1.0
+        self.dreams_stolen = 0
+
+        # admission control - new dreams are turned away while the queue would take too long to finish
+        self.max_wait = 900.0 # seconds, 0 to accept every dream
+        self.interactive_wait_factor = 2.0 # buttons and restored dreams may wait longer than new commands
+        self.dreams_shed = 0
+
+        # priority aging - queued dreams move up one priority for every aging period they wait
+        self.aging = 120.0 # seconds, 0 to keep the priority dreams were queued with
+        self.aging_interval = 5.0
+        self.next_aging_time = 0.0
+        self.queue_waits: collections.deque[float] = collections.deque(maxlen=1000) # seconds recent dreams waited in the queue
+
+        # deadlines - results are sent to the channel, so only the dreams that started after their interaction expired are counted
+        self.dreams_expired = 0
 
     def setup(self):
+        self.fair_queue = settings.get_env_var('QUEUE_FAIR', 'False').lower() in ('true', 'yes', '1')
+        progresshandler.progress_handler.setup()
+        imagehandler.image_handler.setup()
+        imagecache.image_cache.setup()
+        job_runner.setup(len(settings.global_var.web_ui))
+        try:
+            self.affinity_window = max(0, int(settings.get_env_var('QUEUE_AFFINITY', '0')))
+            self.affinity_skips = max(0, int(settings.get_env_var('QUEUE_AFFINITY_SKIPS', '4')))
+        except:
+            print('> - Warning: QUEUE_AFFINITY and QUEUE_AFFINITY_SKIPS must be whole numbers')
+        try:
+            self.max_wait = max(0.0, float(settings.get_env_var('MAX_QUEUE_WAIT', '900')))
+        except:
+            print('> - Warning: MAX_QUEUE_WAIT must be a number')
+        try:
+            self.aging = max(0.0, float(settings.get_env_var('QUEUE_AGING', '120')))
+        except:
+            print('> - Warning: QUEUE_AGING must be a number')
+
+        for dream_instance in self.dream_instances:
+            dream_instance.stop()
         self.dream_instances = []
         for web_ui in settings.global_var.web_ui:
+            web_ui.status_callback = self.notify
             self.dream_instances.append(DreamQueueInstance(web_ui))
+        self.notify()
 
     def process_dream(self, queue_object: utility.DreamObject, priority: int = 4, extended = True):
-        priority = max(0, min(len(self.queues) - 1, priority))
+        # dreams returned to the queue after being cancelled are dropped
+        if queue_object.cancelled:
+            self.finish_dream(queue_object)
+            return None
+
+        priority = max(0, min(len(self.priority_counts) - 1, priority))
 
         # reject dream if it has been through the dream process too many times
         queue_object.dream_attempts += 1
@@ -201,9 +691,11 @@ class DreamQueue:
             user = utility.get_user(queue_object.ctx)
             content = f'<@{user.id}> Something went wrong.'
             upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
+            self.finish_dream(queue_object)
+            return None
 
         if extended:
-            valid_instances = self.get_valid_instances(queue_object)
+            valid_instances = self.get_valid_instances(queue_object, False)
             if len(valid_instances) == 0:
                 print(f'Dream Rejected: No valid instances.')
                 return None
@@ -213,121 +705,320 @@ class DreamQueue:
 
             print(f'Dream Priority: {priority} - Queue: {queue_length}')
 
-        # append dream to queue
-        if type(priority) is int:
-            self.queues[priority].append(queue_object)
-
-        # start dream queue thread
-        if self.dream_thread.is_alive() == False:
-            self.dream_thread = threading.Thread(target=self.process_queue, daemon=True)
-            self.dream_thread.start()
+        # journal the dream before it is queued, so it can be queued again after a restart
+        queuejournal.queue_journal.add(queue_object)
+
+        with self.queue_condition:
+            # append dream to queue
+            self.accounting.add(queue_object, self.get_dream_cost(queue_object))
+            if queue_object not in self.queue_heap:
+                queue_object.priority = priority
+                if queue_object.queue_time == None:
+                    queue_object.queue_time = time.time()
+                    queue_object.deadline = utility.get_deadline(queue_object.ctx)
+                self.queue_heap.push(queue_object, self.get_queue_key(queue_object, priority))
+                self.priority_counts[priority] += 1
+                self.estimator.append(self, queue_object)
+
+            # start dream queue thread
+            if self.dream_thread.is_alive() == False:
+                self.dream_thread = threading.Thread(target=self.process_queue, daemon=True)
+                self.dream_thread.start()
+
+            # wake up the dream queue thread
+            self.queue_updated = True
+            self.queue_condition.notify()
 
         if extended:
             return queue_length
 
+    # find a dream within the look ahead window that uses the checkpoint loaded on the dream instance
+    def get_affinity_dream(self, dream_instance: DreamQueueInstance, get_dream, queue_index: int):
+        if self.affinity_window == 0 or dream_instance.last_data_model == None:
+            return None
+
+        for index in range(queue_index, queue_index + self.affinity_window):
+            queue_object = get_dream(index)
+            if queue_object == None:
+                break
+            if type(queue_object) is not utility.DrawObject:
+                continue
+            if queue_object.data_model == dream_instance.last_data_model and dream_instance.is_valid(queue_object):
+                return queue_object
+        return None
+
+    # get the key used to sort a dream in the queue
+    def get_queue_key(self, queue_object: utility.DreamObject, priority: int):
+        priority = self.get_aged_priority(queue_object, priority)
+        if self.fair_queue == False:
+            return (priority,)
+
+        # start-time fair queueing - charge the user the compute cost of the dream, scaled by the weight of their guild
+        # dreams returned to the queue keep the start tag they were charged with
+        if queue_object.start_tag == None:
+            queue_weight = self.get_queue_weight(queue_object.guild_id)
+            queue_object.start_tag = max(self.virtual_time, self.finish_tags.get(queue_object.user_id, 0.0))
+            self.finish_tags[queue_object.user_id] = queue_object.start_tag + queue_object.dream_cost / queue_weight
+        return (priority, queue_object.start_tag)
+
+    # get the priority of a dream after it has gained a level for every aging period it waited
+    def get_aged_priority(self, queue_object: utility.DreamObject, priority: int):
+        if self.aging <= 0.0 or queue_object.queue_time == None:
+            return priority
+        return max(0, priority - int((time.time() - queue_object.queue_time) / self.aging))
+
+    # sort the queue again as dreams age, dream_queue.queue_condition must be held
+    def age_dreams(self):
+        if self.aging <= 0.0 or time.time() < self.next_aging_time:
+            return
+        self.next_aging_time = time.time() + self.aging_interval
+        if self.queue_heap.rekey(lambda queue_object: self.get_queue_key(queue_object, queue_object.priority)):
+            self.estimator.invalidate()
+
+    # get the percentiles of the seconds recent dreams waited in the queue before starting
+    def get_wait_percentiles(self, percentiles: list[float] = [0.5, 0.9, 0.99]):
+        waits = sorted(self.queue_waits)
+        if not waits:
+            return None
+        return [waits[min(len(waits) - 1, int(len(waits) * percentile))] for percentile in percentiles]
+
+    # get the share of compute for each user in a guild, the guild weight is split between its queued users
+    def get_queue_weight(self, guild_id: str):
+        try:
+            queue_weight = max(0.01, float(settings.read(guild_id)['queue_weight']))
+        except:
+            queue_weight = 1.0
+        guild_users = max(1, len(self.accounting.guild_users.get(guild_id, {})))
+        return queue_weight / guild_users
+
+    # take a dream out of the queue, returns False if it was not queued
+    def remove_dream(self, queue_object: utility.DreamObject):
+        if self.queue_heap.remove(queue_object):
+            self.estimator.invalidate()
+            self.priority_counts[queue_object.priority] -= 1
+            return True
+        return False
+
+    # stop counting a dream against its user once it is completed, rejected or cancelled
+    # dreams that are rejected were already taken out of the estimate when they left the queue or their instance
+    def finish_dream(self, queue_object: utility.DreamObject, dream_instance: DreamQueueInstance = None):
+        progresshandler.progress_handler.finish_dream(queue_object)
+        with self.queue_condition:
+            self.accounting.remove(queue_object)
+            if dream_instance:
+                self.estimator.finish(dream_instance, queue_object)
+            if queue_object.user_id not in self.accounting.user_count:
+                self.finish_tags.pop(queue_object.user_id, None)
+            self.queue_updated = True
+            self.queue_condition.notify()
+
+    # wake up the dream queue thread after a dream finishes or a webui changes state
+    def notify(self):
+        with self.queue_condition:
+            self.estimator.invalidate()
+            self.queue_updated = True
+            self.queue_condition.notify()
+
     def process_queue(self):
-        priority_index = 0
-        queue_index = 0
-        items_skipped = 0
+        while True:
+            with self.queue_condition:
+                # sleep until a dream is queued, a dream finishes, or a webui changes state
+                # check back regularly while a dream is buffered on a busy instance next to an idle one
+                while self.queue_updated == False:
+                    if self.queue_condition.wait(self.get_wait_timeout()) == False:
+                        break
+                self.queue_updated = False
+
+                # move up dreams that have waited long, so low priority dreams are not starved
+                self.age_dreams()
+
+                # hand out dreams until no more dreams can be placed, then move buffered dreams to idle instances
+                while self.dispatch_dream():
+                    pass
+                while self.steal_dream():
+                    pass
+
+    # seconds until idle instances should look for buffered dreams again or queued dreams should age, None if there is nothing to do
+    def get_wait_timeout(self):
+        timeout = None
+        if any(dream_instance.queue for dream_instance in self.dream_instances):
+            if any(dream_instance.get_queue_length() == 0 for dream_instance in self.dream_instances):
+                timeout = self.steal_interval
+        if self.aging > 0.0 and len(self.queue_heap) > 0:
+            aging_timeout = max(0.0, self.next_aging_time - time.time())
+            if timeout == None or aging_timeout < timeout:
+                timeout = aging_timeout
+        return timeout
+
+    # move a dream buffered on a busy instance to an idle instance, returns False if nothing was moved
+    def steal_dream(self):
+        for dream_instance in self.dream_instances:
+            if dream_instance.get_queue_length() > 0 or not dream_instance.is_ready(1) or not dream_instance.is_healthy():
+                continue
+
+            for busy_instance in self.dream_instances:
+                if busy_instance is dream_instance:
+                    continue
+                queue_object = busy_instance.steal_dream(dream_instance, self.steal_wait)
+                if queue_object:
+                    self.dreams_stolen += 1
+                    self.estimator.invalidate()
+                    dream_instance.process_dream(queue_object)
+                    return True
+        return False
+
+    # start the first dream in line that has a ready webui instance, returns False if nothing could be started
+    def dispatch_dream(self):
+        # skip scanning the queue if every instance is already busy
+        if not any(dream_instance.is_ready(2) for dream_instance in self.dream_instances):
+            return False
 
+        # take dreams off the heap in order until one can be started, only the dreams passed over are put back
+        taken_entries: list[list] = []
+        def get_dream(index: int):
+            while len(taken_entries) <= index:
+                entry = self.queue_heap.take()
+                if entry == None:
+                    return None
+                taken_entries.append(entry)
+            return taken_entries[index][-1]
+
+        try:
+            return self.dispatch_next_dream(get_dream)
+        finally:
+            self.queue_heap.put_back(taken_entries)
+
+    # start the first dream that can be placed on an instance, get_dream returns the queued dreams in order
+    def dispatch_next_dream(self, get_dream):
+        queue_index = 0
         while True:
-            if priority_index >= len(self.queues):
-                if items_skipped:
-                    priority_index = 0
-                    items_skipped = 0
-                else:
-                    break
+            queue_object = get_dream(queue_index)
+            if queue_object == None:
+                return False
+            queue_index += 1
 
-            queue = self.queues[priority_index]
-            if queue:
-                if queue_index >= len(queue):
-                    time.sleep(0.1)
-                    queue_index = 0
-                queue_object = queue[queue_index]
-                try:
-                    # Pick appropiate dream instance
-                    target_dream_instance: DreamQueueInstance = None
-
-                    # check if any instance is valid for queue
-                    valid_instances: list[DreamQueueInstance] = self.get_valid_instances(queue_object)
-                    if len(valid_instances) == 0:
-                        # no available instance - remove the object from queue
-                        queue.pop(queue_index)
-                        queue_index = 0
-                        user = utility.get_user(queue_object.ctx)
-                        content = f'<@{user.id}> ``{queue_object.message}``\nSorry, I cannot handle this request right now.'
-                        upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, ephemeral=True, delete_after=30))
-
-                    else:
-                        # start dream on any available optimal webui instance
-                        if type(queue_object) is utility.DrawObject:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(1) and queue_object.data_model == dream_instance.last_data_model:
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        # all optimal instances busy, buffer dream on current optimal instances
-                        if type(queue_object) is utility.DrawObject and target_dream_instance == None:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(2) and queue_object.data_model == dream_instance.last_data_model:
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        # start dream on any available webui instance
-                        if target_dream_instance == None:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(1):
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        # all instances busy, buffer dream on current instances
-                        if target_dream_instance == None:
-                            for dream_instance in valid_instances:
-                                if dream_instance.is_ready(2):
-                                    target_dream_instance = dream_instance
-                                    break
-
-                        if target_dream_instance == None:
-                            # no instance is suitable, try next item in line
-                            queue_index += 1
-                            items_skipped += 1
-                        else:
-                            # start the dream in the instance
-                            queue.pop(queue_index)
-                            queue_index = 0
-                            target_dream_instance.process_dream(queue_object)
+            try:
+                # check if any instance is valid for queue
+                valid_instances: list[DreamQueueInstance] = self.get_valid_instances(queue_object, False)
+                if len(valid_instances) == 0:
+                    # no available instance - remove the object from queue
+                    self.remove_dream(queue_object)
+                    self.finish_dream(queue_object)
+                    user = utility.get_user(queue_object.ctx)
+                    content = f'<@{user.id}> ``{queue_object.message}``\nSorry, I cannot handle this request right now.'
+                    upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, ephemeral=True, delete_after=30))
+                    return True
+
+                # wait for unhealthy instances to recover
+                valid_instances = self.get_valid_instances(queue_object)
+                if len(valid_instances) == 0:
+                    continue
 
-                except Exception as e:
-                    print(f'Dream failure:\n{queue_object}\n{e}\n{traceback.print_exc()}')
+                # no instance is suitable, try next item in line
+                target_dream_instance = self.get_target_instance(queue_object, valid_instances)
+                if target_dream_instance == None:
+                    continue
 
-                priority_index = 0
-            else:
-                priority_index += 1
+                # start a dream that can use the loaded checkpoint instead, unless this dream has been passed over too often
+                if type(queue_object) is utility.DrawObject and queue_object.data_model != target_dream_instance.last_data_model:
+                    affinity_object = self.get_affinity_dream(target_dream_instance, get_dream, queue_index)
+                    if affinity_object and queue_object.affinity_skips < self.affinity_skips:
+                        queue_object.affinity_skips += 1
+                        self.model_switches_avoided += 1
+                        queue_object = affinity_object
+                    elif target_dream_instance.last_data_model:
+                        self.model_switches += 1
+
+                # start the dream in the instance
+                self.remove_dream(queue_object)
+                if queue_object.dream_attempts == 1 and queue_object.queue_time != None:
+                    self.queue_waits.append(time.time() - queue_object.queue_time)
+                if utility.is_expired(queue_object.deadline):
+                    self.dreams_expired += 1
+                if queue_object.start_tag != None:
+                    self.virtual_time = max(self.virtual_time, queue_object.start_tag)
+                target_dream_instance.process_dream(queue_object)
+                return True
+
+            except Exception as e:
+                print(f'Dream failure:\n{queue_object}\n{e}\n{traceback.print_exc()}')
+                self.remove_dream(queue_object)
+                self.finish_dream(queue_object)
+                queuejournal.queue_journal.complete(queue_object, True)
+                return True
+
+    # pick appropiate dream instance
+    def get_target_instance(self, queue_object: utility.DreamObject, valid_instances: list[DreamQueueInstance]):
+        # start dream on any available optimal webui instance
+        if type(queue_object) is utility.DrawObject:
+            for dream_instance in valid_instances:
+                if dream_instance.is_ready(1) and queue_object.data_model == dream_instance.last_data_model:
+                    return dream_instance
+
+        # all optimal instances busy, buffer dream on current optimal instances
+        if type(queue_object) is utility.DrawObject:
+            for dream_instance in valid_instances:
+                if dream_instance.is_ready(2) and queue_object.data_model == dream_instance.last_data_model:
+                    return dream_instance
+
+        # start dream on any available webui instance
+        for dream_instance in valid_instances:
+            if dream_instance.is_ready(1):
+                return dream_instance
+
+        # all instances busy, buffer dream on current instances
+        for dream_instance in valid_instances:
+            if dream_instance.is_ready(2):
+                return dream_instance
+
+        return None
 
     def clear_user_queue(self, user_id: int):
         total_cleared: int = 0
 
-        # clear from global dream queue
-        for queue in self.queues:
-            index = len(queue)
-            while index > 0:
-                index -= 1
-                user_compare = utility.get_user(queue[index].ctx)
-                if user_id == user_compare.id:
-                    queue.pop()
+        with self.queue_condition:
+            # clear from global dream queue
+            for queue_object in list(self.accounting.user_dreams.get(user_id, {}).values()):
+                if self.remove_dream(queue_object):
+                    self.cancel_dream(queue_object)
                     total_cleared += 1
 
-        # clear from all dream queue instances
-        for dream_instance in self.dream_instances:
-            total_cleared += dream_instance.clear_user_queue(user_id)
+            # clear from all dream queue instances, and stop the dreams already running
+            for dream_instance in self.dream_instances:
+                for queue_object in dream_instance.clear_user_queue(user_id) + dream_instance.interrupt_user_queue(user_id):
+                    self.cancel_dream(queue_object)
+                    total_cleared += 1
+
+            if user_id not in self.accounting.user_count:
+                self.finish_tags.pop(user_id, None)
+            self.estimator.invalidate()
+            self.queue_updated = True
+            self.queue_condition.notify()
 
         return total_cleared
 
-    def get_valid_instances(self, queue_object: utility.DreamObject):
+    # mark a dream as cancelled so it is not started or uploaded, and release anything waiting on it
+    def cancel_dream(self, queue_object: utility.DreamObject):
+        self.accounting.remove(queue_object)
+        for cancel_object in [queue_object] + getattr(queue_object, 'batch_objects', []):
+            cancel_object.cancelled = True
+            cancel_object.uploaded = True
+        progresshandler.progress_handler.finish_dream(queue_object)
+        queuejournal.queue_journal.complete(queue_object, True)
+
+    # get the instances that can run a dream, leaving out instances the health check is steering dreams away from
+    # degraded instances are placed last, so they are only used when the healthy instances are busy
+    def get_valid_instances(self, queue_object: utility.DreamObject, check_health: bool = True):
         valid_instances: list[DreamQueueInstance] = []
         for dream_instance in self.dream_instances:
-            if dream_instance.is_valid(queue_object):
-                valid_instances.append(dream_instance)
+            if not dream_instance.is_valid(queue_object):
+                continue
+            if check_health and not dream_instance.is_healthy():
+                continue
+            valid_instances.append(dream_instance)
+
+        if check_health:
+            valid_instances.sort(key=lambda dream_instance: dream_instance.web_ui.health.is_degraded())
         return valid_instances
 
     def get_fast_instances(self, queue_object: utility.DreamObject):
@@ -341,18 +1032,13 @@ class DreamQueue:
         return valid_instances
 
     def get_queue_length(self, priority: int = None):
-        queue_index = 0
-        queue_length = 0
-
         if priority == None:
-            priority = len(self.queues) - 1
+            priority = len(self.priority_counts) - 1
         else:
-            priority = max(0, min(len(self.queues) - 1, priority))
+            priority = max(0, min(len(self.priority_counts) - 1, priority))
 
         # get length of global dream queue
-        while queue_index <= priority:
-            queue_length += len(self.queues[queue_index])
-            queue_index += 1
+        queue_length = sum(self.priority_counts[:priority + 1])
 
         # get length of all dream isntances
         for dream_instance in self.dream_instances:
@@ -360,28 +1046,87 @@ class DreamQueue:
 
         return queue_length
 
-    def get_user_queue_cost(self, user_id: int):
-        queue_cost = 0.0
-
-        # collect queues of global dream queue
-        for index, queue in enumerate(self.queues):
-            for queue_object in queue:
-                user = utility.get_user(queue_object.ctx)
-                if user and user.id == user_id and queue_object.payload:
-                    queue_cost += self.get_dream_cost(queue_object)
-
-        # collect queues of all dream isntances
+    # get the predicted start and finish time of a dream, returns None if it is not queued or cannot be estimated
+    def get_eta(self, queue_object: utility.DreamObject):
+        with self.queue_condition:
+            if not queue_object.accounted:
+                return None
+            if self.estimator.dirty:
+                self.estimator.estimate(self)
+            if queue_object.eta_finish == None:
+                return None
+            return (queue_object.eta_start, queue_object.eta_finish)
+
+    # get the predicted time until a dream is finished as text
+    def get_eta_text(self, queue_object: utility.DreamObject):
+        eta = self.get_eta(queue_object)
+        if eta == None:
+            return None
+        return utility.format_duration(eta[1] - time.time())
+
+    # get the queued dreams of a user in order, with their position in the queue (0 if they are already on a webui instance)
+    def get_user_dreams(self, user_id: int):
+        with self.queue_condition:
+            user_dreams: list[tuple[int, utility.DreamObject]] = []
+            for (position, queue_object) in enumerate(self.queue_heap.ordered()):
+                if queue_object.user_id == user_id:
+                    user_dreams.append((position + 1, queue_object))
+            for dream_instance in self.dream_instances:
+                for queue_object in list(dream_instance.queue_inprogress) + list(dream_instance.queue):
+                    if queue_object.user_id == user_id:
+                        user_dreams.insert(0, (0, queue_object))
+            return user_dreams
+
+    # get the compute cost the webui instances can finish per second, learned from how long previous dreams took
+    def get_throughput(self):
+        throughput = 0.0
         for dream_instance in self.dream_instances:
-            queue = dream_instance.queue + dream_instance.queue_inprogress
-            for queue_object in queue:
-                user = utility.get_user(queue_object.ctx)
-                if user and user.id == user_id and queue_object.payload:
-                    queue_cost += self.get_dream_cost(queue_object)
+            if dream_instance.web_ui.online and dream_instance.web_ui.health.state != 'open':
+                throughput += 1.0 / costmodel.cost_model.get_seconds_per_cost(dream_instance.web_ui)
+        return throughput
+
+    # get the predicted seconds until the whole queue is finished, including a new dream
+    def get_predicted_wait(self, dream_cost: float = 0.0):
+        throughput = self.get_throughput()
+        if throughput <= 0.0:
+            return None
+        return (self.accounting.total_cost + dream_cost) / throughput
+
+    # check if a new dream should be accepted, returns the reason it is turned away or None
+    # interactive dreams (buttons, restored dreams) get more room so bulk commands cannot starve them
+    def check_admission(self, dream_cost: float, interactive = False):
+        if self.max_wait <= 0.0:
+            return None
+
+        wait = self.get_predicted_wait(dream_cost)
+        max_wait = self.max_wait * self.interactive_wait_factor if interactive else self.max_wait
+        if wait == None or wait <= max_wait:
+            return None
+
+        self.dreams_shed += 1
+        print(f'Dream Shed: Predicted wait {int(wait)}s is over {int(max_wait)}s')
+        return f'I\'m too busy right now! New dreams would wait about ``{utility.format_duration(wait)}``. Please try again later.'
+
+    # check if the queue is over half of its limit, large batches are queued behind other dreams until it clears
+    def is_congested(self):
+        if self.max_wait <= 0.0:
+            return False
+        wait = self.get_predicted_wait()
+        return wait != None and wait > self.max_wait * 0.5
 
-        return queue_cost
+    def get_user_queue_cost(self, user_id: int):
+        return self.accounting.user_cost.get(user_id, 0.0)
 
-    # get estimate of the compute cost of a dream
+    # get estimate of the compute cost of a dream, learned from how long previous dreams took when possible
     def get_dream_cost(self, queue_object: utility.DreamObject):
+        if type(queue_object) is utility.DrawObject:
+            dream_compute_cost = costmodel.cost_model.get_dream_cost(queue_object)
+            if dream_compute_cost != None:
+                return dream_compute_cost
+        return self.get_static_dream_cost(queue_object)
+
+    # get estimate of the compute cost of a dream from a fixed formula
+    def get_static_dream_cost(self, queue_object: utility.DreamObject):
         if type(queue_object) is utility.DrawObject:
             dream_compute_cost_add = 0.0
             dream_compute_cost = float(queue_object.steps) / 20.0
@@ -396,7 +1141,7 @@ class DreamQueue:
             # use actual batch size from payload
             batch = queue_object.batch
             try:
-                batch = queue_object.payload['n_iter']
+                batch = queue_object.payload['n_iter'] * queue_object.payload.get('batch_size', 1)
             except:
                 pass
 
@@ -420,6 +1165,10 @@ class UploadQueue:
 
     # upload the image
     def process_upload(self, queue_object: utility.UploadObject):
+        # drop uploads of cancelled dreams
+        if queue_object.queue_object.cancelled:
+            return
+
         # append upload to queue
         self.queue.append(queue_object)
 
@@ -452,10 +1201,16 @@ class UploadQueue:
                     index += 1
                     continue
 
+                # drop the upload if the dream was cancelled after it finished
+                if upload_object.queue_object.cancelled:
+                    self.queue.remove(upload_object)
+                    continue
+
                 # reject upload if it has been through the upload process too many times
                 upload_object.upload_attempts += 1
                 if upload_object.upload_attempts > 3:
                     upload_object.queue_object.uploaded = True
+                    queuejournal.queue_journal.complete(upload_object.queue_object)
                     self.queue.remove(upload_object)
                     continue
 
@@ -470,6 +1225,7 @@ class UploadQueue:
             except Exception as e:
                 print(f'Upload failure:\n{e}\n{traceback.print_exc()}')
                 upload_object.queue_object.uploaded = True
+                queuejournal.queue_journal.complete(upload_object.queue_object)
                 try:
                     self.queue.remove(upload_object)
                 except:
@@ -480,9 +1236,15 @@ class UploadQueue:
 
     # send message
     async def send_message(self, upload_object: utility.UploadObject):
+        ctx = upload_object.queue_object.ctx
         try:
-            ctx = upload_object.queue_object.ctx
-            if upload_object.ephemeral:
+            # ephemeral messages are never sent to the channel, once the interaction expired they go to the user directly
+            if upload_object.ephemeral and utility.is_expired(utility.get_deadline(ctx)):
+                upload_object.direct = True
+
+            if upload_object.direct:
+                message = await self.send_direct_message(upload_object)
+            elif upload_object.ephemeral:
                 if type(ctx) is discord.ApplicationContext:
                     try:
                         message = await ctx.send_response(
@@ -513,6 +1275,7 @@ class UploadQueue:
 
             # mark as uploaded
             upload_object.queue_object.uploaded = True
+            queuejournal.queue_journal.complete(upload_object.queue_object)
 
             # cache command
             if type(upload_object.queue_object) is utility.DrawObject and upload_object.queue_object.write_to_cache:
@@ -527,15 +1290,33 @@ class UploadQueue:
             await asyncio.sleep(5.0)
 
         except Exception as e:
-            print(f'Upload failure:\n{e}\n{traceback.print_exc()}')
-            upload_object.queue_object.uploaded = True
-            try:
-                self.queue.remove(upload_object)
-            except:
-                pass
+            # the interaction could not be used, try again as a direct message
+            if upload_object.ephemeral and upload_object.direct == False and isinstance(e, discord.HTTPException) and type(ctx) in (discord.ApplicationContext, discord.Interaction):
+                print(f'Upload through interaction failed, sending to user instead:\n{e}')
+                upload_object.direct = True
+            else:
+                if upload_object.direct and isinstance(e, discord.HTTPException):
+                    # the user does not accept direct messages, the message is dropped rather than made public
+                    print(f'Upload to user failed, dropping message:\n{e}')
+                else:
+                    print(f'Upload failure:\n{e}\n{traceback.print_exc()}')
+                upload_object.queue_object.uploaded = True
+                queuejournal.queue_journal.complete(upload_object.queue_object)
+                try:
+                    self.queue.remove(upload_object)
+                except:
+                    pass
 
         upload_object.is_uploading = False
 
+    # send an ephemeral message to the user directly, without the view since its buttons are meant for the channel
+    async def send_direct_message(self, upload_object: utility.UploadObject):
+        user = utility.get_user(upload_object.queue_object.ctx)
+        for file in upload_object.files or []:
+            file.reset()
+        return await user.send(content=upload_object.content, embed=upload_object.embed, files=upload_object.files, delete_after=upload_object.delete_after)
+
+job_runner = JobRunner()
 dream_queue = DreamQueue()
 upload_queue = UploadQueue()
 
@@ -0,0 +1,227 @@
+import asyncio
+import discord
+import json
+import os
+import threading
+import time
+import traceback
+
+from core import utility
+from core import settings
+
+# write-ahead journal of queued dreams, so dreams that were waiting or running survive a crash or restart
+# each queued dream appends an add record with the command that created it, and a done record once it is uploaded or cancelled
+class QueueJournal:
+    def __init__(self):
+        self.enabled = True
+        self.file_path = 'resources/queue-journal.jsonl'
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.pending: dict[int, dict] = {} # add records of dreams that are not done yet
+        self.pending_count: dict[int, int] = {} # dreams left in each record, a combined batch shares one record
+        self.restore_records: list[dict] = [] # records loaded at startup, queued again once the bot is ready and a webui is online
+        self.restored_ids: set[int] = set() # records of restored dreams that were queued again
+        self.restore_interval = 5.0 # seconds between checks for an online webui before restoring
+        self.lines: list[str] = []
+        self.compact_interval = 100 # done records written before the journal is rewritten with only the pending dreams
+        self.done_count = 0
+        self.writing = False
+
+    def setup(self):
+        self.enabled = settings.get_env_var('QUEUE_JOURNAL', 'True').lower() in ('true', 'yes', '1')
+        if self.enabled == False:
+            return
+
+        # replay the journal, the records without a done record are the dreams that were lost
+        records: dict[int, dict] = {}
+        try:
+            with open(self.file_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except:
+                        continue # the last line may be incomplete after a crash
+                    if record.get('op') == 'add':
+                        records[record['id']] = record
+                    elif record.get('op') == 'done':
+                        records.pop(record['id'], None)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f'> Failed to load queue journal at {self.file_path}\n{e}\n{traceback.print_exc()}')
+
+        with self.lock:
+            self.restore_records = sorted(records.values(), key=lambda record: record['id'])
+            self.pending = {record['id']: record for record in self.restore_records}
+            self.pending_count = {record['id']: 1 for record in self.restore_records}
+            if records:
+                self.next_id = max(records.keys()) + 1
+                print(f'> Queue journal has {len(records)} unfinished dreams to restore')
+            self.done_count = self.compact_interval # start with a compacted journal
+        self.write()
+
+    # get the journal record of a dream, returns None if its cog cannot queue it again
+    def get_record(self, queue_object: utility.DreamObject):
+        if hasattr(queue_object.cog, 'restore_dream') == False:
+            return None
+
+        user = utility.get_user(queue_object.ctx)
+        record = {
+            'op': 'add',
+            'cog': type(queue_object.cog).__name__,
+            'type': type(queue_object).__name__,
+            'command': queue_object.get_command(),
+            'channel_id': queue_object.ctx.channel.id,
+            'user_id': user.id,
+            'guild_id': utility.get_guild(queue_object.ctx),
+            'args': queue_object.get_args(),
+            'time': time.time()
+        }
+        return record
+
+    # record a dream that was added to the queue, dreams returned to the queue keep their record
+    def add(self, queue_object: utility.DreamObject):
+        if self.enabled == False or queue_object.journal_id != None:
+            return
+        journal_objects = [queue_object] + getattr(queue_object, 'batch_objects', [])
+
+        # restored dreams keep the record they were restored from, it is done once all of them are
+        if type(queue_object.ctx) is utility.RestoredContext and queue_object.ctx.journal_id != None:
+            journal_id = queue_object.ctx.journal_id
+            with self.lock:
+                if journal_id in self.pending:
+                    if journal_id not in self.restored_ids:
+                        self.restored_ids.add(journal_id)
+                        self.pending_count[journal_id] = 0
+                    self.pending_count[journal_id] += len(journal_objects)
+                    for journal_object in journal_objects:
+                        journal_object.journal_id = journal_id
+                    return
+
+        try:
+            record = self.get_record(queue_object)
+        except Exception as e:
+            print(f'Queue journal failed to record dream:\n{e}\n{traceback.print_exc()}')
+            return
+        if record == None:
+            return
+
+        with self.lock:
+            record['id'] = self.next_id
+            self.next_id += 1
+            self.pending[record['id']] = record
+            self.pending_count[record['id']] = len(journal_objects)
+            for journal_object in journal_objects:
+                journal_object.journal_id = record['id']
+            self.lines.append(json.dumps(record))
+        self.write()
+
+    # record a dream that was uploaded or cancelled, the record is done once all dreams that share it are
+    def complete(self, queue_object: utility.DreamObject, cancelled = False):
+        journal_id = queue_object.journal_id
+        if self.enabled == False or journal_id == None:
+            return
+
+        with self.lock:
+            if journal_id not in self.pending:
+                return
+            if cancelled:
+                self.pending_count[journal_id] = 0
+            else:
+                self.pending_count[journal_id] -= 1
+            if self.pending_count[journal_id] > 0:
+                return
+        self.finish(journal_id)
+
+    # write the done record of a record
+    def finish(self, journal_id: int):
+        with self.lock:
+            if self.pending.pop(journal_id, None) == None:
+                return
+            self.pending_count.pop(journal_id, None)
+            self.lines.append(json.dumps({'op': 'done', 'id': journal_id}))
+            self.done_count += 1
+        self.write()
+
+    # append new records in a background thread, rewriting the journal with only the pending dreams every so often
+    def write(self):
+        def run():
+            while True:
+                with self.lock:
+                    if not self.lines and self.done_count < self.compact_interval:
+                        self.writing = False
+                        return
+                    lines = self.lines
+                    self.lines = []
+                    if self.done_count >= self.compact_interval:
+                        self.done_count = 0
+                        lines = [json.dumps(record) for record in self.pending.values()]
+                        compact = True
+                    else:
+                        compact = False
+
+                try:
+                    if compact:
+                        file_path_temp = self.file_path + '.tmp'
+                        with open(file_path_temp, 'w') as f:
+                            f.writelines(line + '\n' for line in lines)
+                            f.flush()
+                            os.fsync(f.fileno())
+                        os.replace(file_path_temp, self.file_path)
+                    else:
+                        with open(self.file_path, 'a') as f:
+                            f.writelines(line + '\n' for line in lines)
+                            f.flush()
+                            os.fsync(f.fileno())
+                except Exception as e:
+                    print(f'Queue journal write failed:\n{e}\n{traceback.print_exc()}')
+
+        with self.lock:
+            if self.writing:
+                return # the running thread picks up the new records
+            self.writing = True
+        threading.Thread(target=run, daemon=True).start()
+
+    # queue the dreams from the journal again, posting them to the channels they were requested in
+    async def restore(self, bot: discord.Bot):
+        with self.lock:
+            restore_records = self.restore_records
+            self.restore_records = []
+        if not restore_records:
+            return
+
+        # dreams can only be queued once a webui is online, until then they stay in the journal
+        if not any(web_ui.online for web_ui in settings.global_var.web_ui):
+            print(f'> Waiting for a WebUI to come online to restore {len(restore_records)} dreams')
+            while not any(web_ui.online for web_ui in settings.global_var.web_ui):
+                await asyncio.sleep(self.restore_interval)
+
+        for record in restore_records:
+            try:
+                cog = bot.get_cog(record['cog'])
+                if cog == None:
+                    print(f'Queue journal cannot restore dream, {record["cog"]} is not loaded: {record["command"]}')
+                    continue
+
+                channel = bot.get_channel(record['channel_id'])
+                if channel == None:
+                    channel = await bot.fetch_channel(record['channel_id'])
+                user = bot.get_user(record['user_id'])
+                if user == None:
+                    user = await bot.fetch_user(record['user_id'])
+
+                print(f'Restoring dream -- {user.name}#{user.discriminator} -- {record["command"]}')
+                ctx = utility.RestoredContext(channel, user, record['guild_id'], record['id'])
+                await cog.restore_dream(ctx, record)
+
+            except Exception as e:
+                print(f'Queue journal failed to restore dream: {record.get("command")}\n{e}\n{traceback.print_exc()}')
+
+            finally:
+                # the record stays until the queued dreams are done, a dream that was turned away is not restored again
+                with self.lock:
+                    queued = record['id'] in self.restored_ids
+                if queued == False:
+                    self.finish(record['id'])
+
+queue_journal = QueueJournal()
@@ -27,7 +27,8 @@ template = {
     'priority': 3, # lower priority gets placed in front of the queue
     'max_compute': 6.0,
     'max_compute_batch': 16.0,
-    'max_compute_queue': 16.0
+    'max_compute_queue': 16.0,
+    'queue_weight': 1.0 # share of compute given to this guild when fair queueing is enabled
 }
 
 # initialize global variables here
@@ -130,8 +131,8 @@ def get_config(file_path: str):
         print(f'> Failed to load config at {file_path}\n{e}\n{traceback.print_exc()}')
         return None
 
-def startup_check():
-    # load config file as an alternative to using .env vars
+# load config file as an alternative to using .env vars
+def load_config():
     config_path = get_env_var('CONFIG', 'resources/config.cfg')
     if config_path:
         if os.path.isfile(config_path):
@@ -174,8 +175,60 @@ def startup_check():
                     '# URL4 = 192.168.1.123:7861 --no-upscale --no-identify --wait-for http://192.168.1.123:7860\n'
                     '# URL5 = https://abcdef.gradio.app --gradio-auth username:password\n'
                     '# URL6 = http://example.com:7860 --api-auth username:password\n'
+                    '\n'
+                    '# Share the WebUI instances fairly between users, based on the compute cost of their dreams.\n'
+                    '# Each guild can set its share with queue_weight in its settings file.\n'
+                    '# QUEUE_FAIR = True\n'
+                    '\n'
+                    '# Look ahead this many dreams in the queue for one that uses the checkpoint already loaded on a WebUI instance.\n'
+                    '# A dream can be passed over QUEUE_AFFINITY_SKIPS times before it has to be started.\n'
+                    '# QUEUE_AFFINITY = 8\n'
+                    '# QUEUE_AFFINITY_SKIPS = 4\n'
+                    '\n'
+                    '# Batches that only change the seed are generated in a single WebUI request, with up to this many images at the same time.\n'
+                    '# Lower this if the WebUI runs out of memory, or set it to 0 to send each image in a batch as its own request.\n'
+                    '# BATCH_SIZE = 4\n'
+                    '\n'
+                    '# Edit the reply to a command to show the progress of its dreams, checking each WebUI every PROGRESS_INTERVAL seconds.\n'
+                    '# PROGRESS_PREVIEW adds a small preview of the image being generated, which requires live previews to be enabled in the WebUI.\n'
+                    '# PROGRESS = True\n'
+                    '# PROGRESS_INTERVAL = 2.0\n'
+                    '# PROGRESS_PREVIEW = False\n'
+                    '\n'
+                    '# Number of worker threads for saving and uploading images and for extra WebUI requests.\n'
+                    '# JOB_WORKERS = 8\n'
+                    '\n'
+                    '# Number of connections kept open to each WebUI instance.\n'
+                    '# WEBUI_POOL_SIZE = 10\n'
+                    '\n'
+                    '# Keep a journal of queued dreams so they are queued again after a crash or restart.\n'
+                    '# QUEUE_JOURNAL = True\n'
+                    '\n'
+                    '# Turn new dreams away while the queue would take longer than this many seconds to finish, 0 to accept every dream.\n'
+                    '# Buttons may wait twice as long, so large batches cannot starve them.\n'
+                    '# MAX_QUEUE_WAIT = 900\n'
+                    '\n'
+                    '# Seconds a queued dream waits before it moves up one priority, so busy users are not starved. 0 to disable.\n'
+                    '# QUEUE_AGING = 120\n'
+                    '\n'
+                    '# Number of processes that build masks and convert images, 0 to use threads instead. Defaults to the CPU count, up to 4.\n'
+                    '# The processes are started once when the bot starts, changes need a restart.\n'
+                    '# IMAGE_WORKERS = 4\n'
+                    '\n'
+                    '# Megabytes discord accepts in a message for server boost tiers 0 to 3, larger images are converted to WebP or JPEG to fit.\n'
+                    '# UPLOAD_LIMITS = 10,10,50,100\n'
+                    '\n'
+                    '# Megabytes of downloaded input images kept in memory, so repeated commands on the same image skip the download.\n'
+                    '# IMAGE_CACHE_SIZE = 256\n'
+                    '\n'
+                    '# Directory input images are moved to when they no longer fit in memory, and the megabytes it may use. Unset to only cache in memory.\n'
+                    '# IMAGE_CACHE_DIR = resources/image-cache\n'
+                    '# IMAGE_CACHE_DISK_SIZE = 1024\n'
                 )
 
+def startup_check():
+    load_config()
+
     # connect to WebUI URL access points
     web_ui_list = []
     index = 0
@@ -194,17 +247,24 @@ def startup_check():
             api_user = get_env_var(f'APIUSER{suffix}')
             api_pass = get_env_var(f'APIPASS{suffix}')
 
-            web_ui = utility.WebUI(url, username, password, api_user, api_pass)
+            try:
+                pool_size = max(1, int(get_env_var('WEBUI_POOL_SIZE', '10')))
+            except:
+                print('> - Warning: WEBUI_POOL_SIZE must be a whole number')
+                pool_size = 10
+            web_ui = utility.WebUI(url, username, password, api_user, api_pass, pool_size)
 
-            # check if Web UI is running
-            if index == 0:
-                web_ui.connect_blocking()
-            else:
-                web_ui.connect()
+            # check if Web UI is running, all instances connect at the same time
+            web_ui.load_snapshot()
+            web_ui.connect()
 
             web_ui_list.append(web_ui)
         index += 1
 
+    # the main instance provides the command options, wait for it unless they are known from the last run
+    if web_ui_list and web_ui_list[0].snapshot_loaded == False:
+        web_ui_list[0].connect_blocking()
+
     # cleanup current web ui array (only needed when reloading)
     for web_ui in global_var.web_ui:
         web_ui.stop()
@@ -1,7 +1,7 @@
 import base64
-import contextlib
 import discord
 import io
+import json
 import random
 import requests
 import time
@@ -9,7 +9,6 @@ import traceback
 import asyncio
 import threading
 from urllib.parse import quote
-from PIL import Image, ImageFilter, ImageEnhance, PngImagePlugin
 from discord import option
 from discord.ext import commands
 from typing import Optional
@@ -18,6 +17,9 @@ from core import utility
 from core import queuehandler
 from core import viewhandler
 from core import settings
+from core import progresshandler
+from core import imagehandler
+from core import imagecache
 
 # a list of parameters, used to sanatize text
 dream_params = [
@@ -412,6 +414,20 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                 ephemeral = True
                 raise Exception()
 
+            # turn the dream away if the whole queue would take too long to finish
+            admission = queuehandler.dream_queue.check_admission(dream_cost, type(ctx) in (discord.Interaction, utility.RestoredContext))
+            if admission:
+                print(f'Dream rejected: Queue is too long')
+                content = f'<@{user.id}> {admission}'
+                ephemeral = True
+                raise Exception()
+
+            # start downloading the controlnet image, so it downloads alongside the input image
+            if controlnet_url and controlnet_url != 'None':
+                imagecache.image_cache.prefetch(controlnet_url)
+            elif controlnet_image:
+                imagecache.image_cache.prefetch(controlnet_image.url)
+
             # get input image
             image: str = None
             mask: str = None
@@ -426,44 +442,25 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                     ephemeral = True
                     raise Exception()
 
+                # defer response before getting the image
                 try:
-                    # reject URL downloads larger than 10MB
-                    url_head = await loop.run_in_executor(None, requests.head, init_url)
-                    url_size = int(url_head.headers.get('content-length', -1))
+                    loop.create_task(ctx.defer())
                 except:
-                    content = 'Image not found! Please check the image URL.'
-                    ephemeral = True
-                    raise Exception()
+                    pass
 
-                # check image download size
-                if url_size > 10 * 1024 * 1024:
+                # get the image from the cache or download it
+                try:
+                    cached_image = await imagecache.image_cache.fetch(init_url)
+                except imagecache.DownloadTooLargeError:
                     print(f'Dream rejected: Image download too large.')
                     content = 'Image download is too large! Please make the download size smaller.'
                     ephemeral = True
                     raise Exception()
-
-                # defer response before downloading
-                try:
-                    loop.create_task(ctx.defer())
-                except:
-                    pass
-
-                # download and encode the image
-                try:
-                    image_response = await loop.run_in_executor(None, requests.get, init_url)
-                    image_data = image_response.content
-                    image_string = base64.b64encode(image_data).decode('utf-8')
-                except:
-                    print(f'Dream rejected: Image download failed.')
+                except imagecache.DownloadError as e:
+                    print(f'Dream rejected: Image download failed.\n{e}')
                     content = 'Image download failed! Please check the image URL.'
                     ephemeral = True
                     raise Exception()
-
-                # check if image can open
-                try:
-                    image_bytes = io.BytesIO(image_data)
-                    image_pil = Image.open(image_bytes)
-                    image_pil_width, image_pil_height = image_pil.size
                 except Exception as e:
                     print(f'Dream rejected: Image is corrupted.')
                     print(f'\n{traceback.print_exc()}')
@@ -471,6 +468,10 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                     ephemeral = True
                     raise Exception()
 
+                image_data = cached_image.data
+                image_string = cached_image.get_base64()
+                image_pil_width, image_pil_height = cached_image.size
+
                 # limit image width/height
                 if image_pil_width * image_pil_height > 4096 * 4096:
                     print(f'Dream rejected: Image size is too large.')
@@ -498,25 +499,13 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                     script_setting = script_parts[0]
                     script_param = script_parts[1]
 
-                    def setup_inpaint_mask(outpaint: bool = False):
-                        # get mask from alpha channel
-                        image_r, image_g, image_b, image_a = image_pil.split()
-                        if outpaint:
-                            image_a = image_a.filter(ImageFilter.BoxBlur(radius=64.0))
-                            pixels = image_a.getdata()
-                            modified_pixels = [((c - 127) * 2) for c in pixels]
-                            image_a.putdata(modified_pixels)
-                        mask_pil = Image.new('L', (image_pil_width, image_pil_height), 255)
-                        mask_pil.paste(image_a, (0, 0, image_pil_width, image_pil_height))
-                        buffer = io.BytesIO()
-                        mask_pil.save(buffer, format='PNG')
-                        mask_data = buffer.getvalue()
-                        mask_string = base64.b64encode(mask_data).decode('utf-8')
-                        return 'data:image/png;base64,' + mask_string
+                    # masks and outpaint images are built in the image worker processes
+                    def get_data_url(data: bytes):
+                        return 'data:image/png;base64,' + base64.b64encode(data).decode('utf-8')
 
                     if script_setting == 'inpaint' and script_param == 'alphamask':
                         try:
-                            mask = await loop.run_in_executor(None, setup_inpaint_mask)
+                            mask = get_data_url(await imagehandler.image_handler.run_async(imagehandler.build_mask, image_data))
                         except:
                             print(f'Dream rejected: Alpha mask separation failed.')
                             content = ('Could not separate alpha mask! Please check the image you uploaded.\n'
@@ -525,47 +514,10 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                             raise Exception()
 
                     elif script_setting == 'outpaint':
-                        def setup_outpaint():
-                            # get border width and height for outpainting
-                            border_width = int(float(image_pil_width) * 0.125)
-                            border_height = int(float(image_pil_height) * 0.125)
-
-                            # resize init image to allow room for borders
-                            resized_image = image_pil.resize((image_pil_width - border_width * 2, image_pil_height - border_height * 2))
-
-                            # create a new image of the original size and paste the resized image into it
-                            new_image_pil = Image.new('RGBA', (image_pil_width, image_pil_height), (127, 127, 127, 0))
-                            match script_param:
-                                case 'center':
-                                    posX = border_width
-                                    posY = border_height
-                                case 'up':
-                                    posX = border_width
-                                    posY = min(border_height * 2, image_pil_height - resized_image.height)
-                                case 'down':
-                                    posX = border_width
-                                    posY = 1
-                                case 'left':
-                                    posX = min(border_width * 2, image_pil_width - resized_image.width)
-                                    posY = border_height
-                                case 'right':
-                                    posX = 1
-                                    posY = border_height
-                                case other:
-                                    raise Exception()
-
-                            new_image_pil.paste(resized_image, (posX, posY, posX + resized_image.width, posY + resized_image.height))
-
-                            # generate output image
-                            buffer = io.BytesIO()
-                            new_image_pil.save(buffer, format='PNG')
-                            new_image_data = buffer.getvalue()
-                            new_image_string = base64.b64encode(new_image_data).decode('utf-8')
-
-                            return new_image_pil, 'data:image/png;base64,' + new_image_string
                         try:
-                            image_pil, image = await loop.run_in_executor(None, setup_outpaint)
-                            mask = await loop.run_in_executor(None, setup_inpaint_mask, True)
+                            (image_data, mask_data) = await imagehandler.image_handler.run_async(imagehandler.build_outpaint, image_data, script_param)
+                            image = get_data_url(image_data)
+                            mask = get_data_url(mask_data)
                         except Exception as e:
                             print(f'Dream rejected: Alpha mask separation failed.')
                             content = 'Could not setup outpaint image! Please check the image you uploaded'
@@ -632,38 +584,19 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                         ephemeral = True
                         raise Exception()
 
+                    # get the image from the cache or download it
                     try:
-                        # reject URL downloads larger than 10MB
-                        url_head = await loop.run_in_executor(None, requests.head, controlnet_url)
-                        url_size = int(url_head.headers.get('content-length', -1))
-                    except:
-                        content = 'Controlnet image not found! Please check the image URL.'
-                        ephemeral = True
-                        raise Exception()
-
-                    # check image download size
-                    if url_size > 10 * 1024 * 1024:
+                        cached_image = await imagecache.image_cache.fetch(controlnet_url)
+                    except imagecache.DownloadTooLargeError:
                         print(f'Dream rejected: Controlnet image download too large.')
                         content = 'Controlnet image download is too large! Please make the download size smaller.'
                         ephemeral = True
                         raise Exception()
-
-                    # download and encode the image
-                    try:
-                        image_response = await loop.run_in_executor(None, requests.get, controlnet_url)
-                        image_data = image_response.content
-                        image_string = base64.b64encode(image_data).decode('utf-8')
-                    except:
-                        print(f'Dream rejected: Controlnet image download failed.')
+                    except imagecache.DownloadError as e:
+                        print(f'Dream rejected: Controlnet image download failed.\n{e}')
                         content = 'Controlnet image download failed! Please check the image URL.'
                         ephemeral = True
                         raise Exception()
-
-                    # check if image can open
-                    try:
-                        image_bytes = io.BytesIO(image_data)
-                        image_pil = Image.open(image_bytes)
-                        image_pil_width, image_pil_height = image_pil.size
                     except Exception as e:
                         print(f'Dream rejected: Controlnet image is corrupted.')
                         print(f'\n{traceback.print_exc()}')
@@ -671,6 +604,10 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                         ephemeral = True
                         raise Exception()
 
+                    image_data = cached_image.data
+                    image_string = cached_image.get_base64()
+                    image_pil_width, image_pil_height = cached_image.size
+
                     # limit image width/height
                     if image_pil_width * image_pil_height > 4096 * 4096:
                         print(f'Dream rejected: Controlnet image size is too large.')
@@ -892,38 +829,56 @@ class StableCog(commands.Cog, description='Create images from natural language.'
             elif queue_cost > 0.0:
                 priority += 1
 
-            if batch == 1:
-                queue_length = queuehandler.dream_queue.process_dream(get_draw_object(), priority)
-            else:
-                last_draw_object = get_draw_object()
-                queue_length = queuehandler.dream_queue.process_dream(last_draw_object, priority)
+            # large batches wait behind other dreams while the queue is congested
+            if batch > 1 and queuehandler.dream_queue.is_congested():
+                priority += 1
+
+            draw_objects: list[utility.DrawObject] = [get_draw_object()]
+            progress_objects = draw_objects
+            batch_count = 1
+            while batch_count < batch:
+                batch_count += 1
+                message = f'#{batch_count}`` ``'
 
+                if increment_seed:
+                    seed += increment_seed
+                    message += f'seed:{seed}'
+
+                if increment_steps:
+                    steps += increment_steps
+                    message += f'steps:{steps}'
+
+                if increment_guidance_scale:
+                    guidance_scale += increment_guidance_scale
+                    guidance_scale = round(guidance_scale, 4)
+                    message += f'guidance_scale:{guidance_scale}'
+
+                if increment_clip_skip:
+                    clip_skip += increment_clip_skip
+                    message += f'clip_skip:{clip_skip}'
+
+                draw_object = get_draw_object(message)
+                draw_object.wait_for_dream = draw_objects[-1]
+                draw_objects.append(draw_object)
+            last_draw_object = draw_objects[-1]
+
+            # batches that only increment the seed are generated by the webui in a single request
+            # the webui gives each image in the batch the next seed, so the results match the separate dreams
+            batch_size = self.get_batch_size(batch)
+            if batch > 1 and batch_size > 0 and increment_seed == 1 and not (increment_steps or increment_guidance_scale or increment_clip_skip):
+                queue_object = draw_objects[0]
+                queue_object.batch_objects = draw_objects[1:]
+                queue_object.payload.update({
+                    'batch_size': batch_size,
+                    'n_iter': batch // batch_size
+                })
+                queue_length = queuehandler.dream_queue.process_dream(queue_object, priority)
+                last_draw_object = queue_object
+                progress_objects = [queue_object]
+            else:
+                queue_length = queuehandler.dream_queue.process_dream(draw_objects[0], priority)
                 if queue_length != None:
-                    batch_count = 1
-                    while batch_count < batch:
-                        batch_count += 1
-                        message = f'#{batch_count}`` ``'
-
-                        if increment_seed:
-                            seed += increment_seed
-                            message += f'seed:{seed}'
-
-                        if increment_steps:
-                            steps += increment_steps
-                            message += f'steps:{steps}'
-
-                        if increment_guidance_scale:
-                            guidance_scale += increment_guidance_scale
-                            guidance_scale = round(guidance_scale, 4)
-                            message += f'guidance_scale:{guidance_scale}'
-
-                        if increment_clip_skip:
-                            clip_skip += increment_clip_skip
-                            message += f'clip_skip:{clip_skip}'
-
-                        draw_object = get_draw_object(message)
-                        draw_object.wait_for_dream = last_draw_object
-                        last_draw_object = draw_object
+                    for draw_object in draw_objects[1:]:
                         queuehandler.dream_queue.process_dream(draw_object, priority, False)
 
             if queue_length == None:
@@ -932,8 +887,14 @@ class StableCog(commands.Cog, description='Create images from natural language.'
             else:
                 content = f'<@{user.id}> {settings.global_var.messages[random.randrange(0, len(settings.global_var.messages))]} Queue: ``{queue_length}``'
                 if batch > 1: content = content + f' - Batch: ``{batch}``'
+                eta = queuehandler.dream_queue.get_eta_text(last_draw_object)
+                if eta: content = content + f' - ETA: ``~{eta}``'
                 content = content + append_options
 
+                # the acknowledgement shows the progress of the dreams until they are done
+                loop.create_task(progresshandler.progress_handler.send_acknowledgement(ctx, content, 120, progress_objects))
+                content = None
+
         except Exception as e:
             if content == None:
                 content = f'<@{user.id}> Something went wrong.\n{e}'
@@ -955,6 +916,21 @@ class StableCog(commands.Cog, description='Create images from natural language.'
             else:
                 loop.create_task(ctx.channel.send(content, delete_after=delete_after))
 
+    # get the number of images the webui should generate at the same time for a batch, 0 if batches should not be combined
+    def get_batch_size(self, batch: int):
+        try:
+            max_batch_size = int(settings.get_env_var('BATCH_SIZE', '4'))
+        except:
+            max_batch_size = 4
+        if max_batch_size <= 0:
+            return 0
+
+        # batch_size * n_iter must be the batch count exactly, larger batches are split into iterations
+        batch_size = min(batch, max_batch_size)
+        while batch % batch_size:
+            batch_size -= 1
+        return batch_size
+
     # generate the image
     def dream(self, queue_object: utility.DrawObject, web_ui: utility.WebUI, queue_continue: threading.Event):
         user = utility.get_user(queue_object.ctx)
@@ -967,18 +943,15 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                 queuehandler.dream_queue.process_dream(queue_object, 0, False)
                 return
 
-            # only send model payload if one is defined
+            # only send model payload if one is defined and it is not already loaded
             if queue_object.data_model:
                 model_payload = {
                     'sd_model_checkpoint': queue_object.data_model,
                 }
-                s.post(url=f'{web_ui.url}/sdapi/v1/options', json=model_payload, timeout=120)
+                web_ui.set_options(s, model_payload)
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
+            queuehandler.job_runner.call_later(0.1, queue_continue.set)
 
             if queue_object.init_url:
                 url = f'{web_ui.url}/sdapi/v1/img2img'
@@ -986,7 +959,7 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                 url = f'{web_ui.url}/sdapi/v1/txt2img'
             # if queue_object.controlnet_model != None and queue_object.controlnet_model != 'None':
             #     url = url.replace('/sdapi/v1/', '/controlnet/')
-            response = s.post(url=url, json=queue_object.payload, timeout=120)
+            response = s.post(url=url, json=web_ui.remove_set_overrides(queue_object.payload), timeout=120)
             queue_object.payload = None
 
             def post_dream():
@@ -996,47 +969,54 @@ class StableCog(commands.Cog, description='Create images from natural language.'
                     keep_chars = (' ', '.', '_')
                     file_name = ''.join(c for c in queue_object.prompt if c.isalnum() or c in keep_chars).rstrip()
 
-                    # save local copy of image and prepare PIL images
-                    pil_images: list[Image.Image] = []
-                    for i, image_base64 in enumerate(response_data['images']):
-                        image = Image.open(io.BytesIO(base64.b64decode(image_base64.split(',',1)[0])))
-                        pil_images.append(image)
-
-                        # save png with metadata
-                        if settings.global_var.dir != '--no-output':
-                            try:
-                                epoch_time = int(time.time())
-                                file_path = f'{settings.global_var.dir}/{epoch_time}-{queue_object.seed}-{file_name[0:120]}-{i}.png'
-
-                                metadata = PngImagePlugin.PngInfo()
-                                metadata.add_text('parameters', response_data['info'])
-                                image.save(file_path, pnginfo=metadata)
-                                print(f'Saved image: {file_path}')
-                            except Exception as e:
-                                print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
-                        else:
-                            print(f'Received image: {int(time.time())}-{queue_object.seed}-{file_name[0:120]}-{i}.png')
-
-                    # post to discord
-                    with contextlib.ExitStack() as stack:
-                        buffer_handles = [stack.enter_context(io.BytesIO()) for _ in pil_images]
-
-                        for (pil_image, buffer) in zip(pil_images, buffer_handles):
-                            pil_image.save(buffer, 'PNG')
-                            buffer.seek(0)
-
-                        files = [discord.File(fp=buffer, filename=f'{queue_object.seed}-{i}.png') for (i, buffer) in enumerate(buffer_handles)]
-                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                           content=f'<@{user.id}> ``{queue_object.message}``', files=files, view=queue_object.view
+                    # split a combined batch back into the images of each dream, skipping the grid the webui may add
+                    batch_objects: list[utility.DrawObject] = [queue_object] + queue_object.batch_objects
+                    if queue_object.batch_objects:
+                        first_image = json.loads(response_data['info']).get('index_of_first_image', 0)
+                        dream_images = [[image_base64] for image_base64 in response_data['images'][first_image:first_image + len(batch_objects)]]
+                    else:
+                        dream_images = [response_data['images']]
+
+                    for (batch_object, images_base64) in zip(batch_objects, dream_images):
+                        # add the metadata to the png sent by the webui, the same data is saved and uploaded
+                        images_data: list[bytes] = []
+                        for i, image_base64 in enumerate(images_base64):
+                            image_data = utility.add_png_text(utility.decode_image(image_base64), 'parameters', response_data['info'])
+                            images_data.append(image_data)
+
+                            # save png with metadata
+                            if settings.global_var.dir != '--no-output':
+                                try:
+                                    epoch_time = int(time.time())
+                                    file_path = f'{settings.global_var.dir}/{epoch_time}-{batch_object.seed}-{file_name[0:120]}-{i}.png'
+                                    with open(file_path, 'wb') as f:
+                                        f.write(image_data)
+                                    print(f'Saved image: {file_path}')
+                                except Exception as e:
+                                    print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
+                            else:
+                                print(f'Received image: {int(time.time())}-{batch_object.seed}-{file_name[0:120]}-{i}.png')
+
+                        # post to discord, images that are too large for the server are encoded again
+                        images = [(image_data, f'{batch_object.seed}-{i}.png') for (i, image_data) in enumerate(images_data)]
+                        images = imagehandler.image_handler.fit_upload(images, utility.get_premium_tier(batch_object.ctx))
+                        files = [discord.File(fp=io.BytesIO(image_data), filename=file_name) for (image_data, file_name) in images]
+                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=batch_object,
+                           content=f'<@{user.id}> ``{batch_object.message}``', files=files, view=batch_object.view
                         ))
-                        queue_object.view = None
+                        batch_object.view = None
+
+                    # let the rest of the batch know the webui did not return enough images
+                    for batch_object in batch_objects[len(dream_images):]:
+                        content = f'<@{user.id}> ``{batch_object.message}``\nSomething went wrong.\nNo image was returned.'
+                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=batch_object, content=content, delete_after=30))
 
                 except Exception as e:
                     content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
                     print(content + f'\n{traceback.print_exc()}')
                     queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
-            threading.Thread(target=post_dream, daemon=True).start()
+            queuehandler.job_runner.submit(post_dream)
 
         except requests.exceptions.RequestException as e:
             # connection error, return items to queue
@@ -1090,6 +1070,10 @@ class StableCog(commands.Cog, description='Create images from natural language.'
         loop = asyncio.get_event_loop()
         loop.create_task(self.dream_object(queue_object))
 
+    # queue a dream from the queue journal again after a restart
+    async def restore_dream(self, ctx: utility.RestoredContext, record: dict):
+        await self.dream_handler(ctx, **record['args'])
+
     # get draw object from a command string
     def get_draw_object_from_command(self, command: str):
         # format command for easier processing
@@ -10,7 +10,6 @@ import threading
 from discord import option
 from discord.ext import commands
 from os.path import splitext, basename
-from PIL import Image
 from typing import Optional
 from urllib.parse import urlparse
 
@@ -18,6 +17,8 @@ from core import utility
 from core import queuehandler
 from core import viewhandler
 from core import settings
+from core import imagehandler
+from core import imagecache
 
 
 class UpscaleCog(commands.Cog):
@@ -144,44 +145,25 @@ class UpscaleCog(commands.Cog):
                     ephemeral = True
                     raise Exception()
 
+                # defer response before getting the image
                 try:
-                    # reject URL downloads larger than 10MB
-                    url_head = await loop.run_in_executor(None, requests.head, init_url)
-                    url_size = int(url_head.headers.get('content-length', -1))
+                    loop.create_task(ctx.defer())
                 except:
-                    content = 'Image not found! Please check the image URL.'
-                    ephemeral = True
-                    raise Exception()
+                    pass
 
-                # check image download size
-                if url_size > 10 * 1024 * 1024:
+                # get the image from the cache or download it
+                try:
+                    cached_image = await imagecache.image_cache.fetch(init_url)
+                except imagecache.DownloadTooLargeError:
                     print(f'Upscale rejected: Image download too large.')
                     content = 'Image download is too large! Please make the download size smaller.'
                     ephemeral = True
                     raise Exception()
-
-                # defer response before downloading
-                try:
-                    loop.create_task(ctx.defer())
-                except:
-                    pass
-
-                # download and encode the image
-                try:
-                    image_response = await loop.run_in_executor(None, requests.get, init_url)
-                    image_data = image_response.content
-                    image_string = base64.b64encode(image_data).decode('utf-8')
-                except:
-                    print(f'Upscale rejected: Image download failed.')
+                except imagecache.DownloadError as e:
+                    print(f'Upscale rejected: Image download failed.\n{e}')
                     content = 'Image download failed! Please check the image URL.'
                     ephemeral = True
                     raise Exception()
-
-                # check if image can open
-                try:
-                    image_bytes = io.BytesIO(image_data)
-                    image_pil = Image.open(image_bytes)
-                    image_pil_width, image_pil_height = image_pil.size
                 except Exception as e:
                     print(f'Upscale rejected: Image is corrupted.')
                     print(f'\n{traceback.print_exc()}')
@@ -189,6 +171,10 @@ class UpscaleCog(commands.Cog):
                     ephemeral = True
                     raise Exception()
 
+                image_data = cached_image.data
+                image_string = cached_image.get_base64()
+                image_pil_width, image_pil_height = cached_image.size
+
                 # limit image width/height
                 if image_pil_width * image_pil_height > 512 * 512 * settings.read(guild)['max_compute']:
                     print(f'Upscale rejected: Image size is too large.')
@@ -254,6 +240,14 @@ class UpscaleCog(commands.Cog):
                 ephemeral = True
                 raise Exception()
 
+            # turn the dream away if the whole queue would take too long to finish
+            admission = queuehandler.dream_queue.check_admission(dream_cost, type(ctx) in (discord.Interaction, utility.RestoredContext))
+            if admission:
+                print(f'Upscale rejected: Queue is too long')
+                content = f'<@{user.id}> {admission}'
+                ephemeral = True
+                raise Exception()
+
             priority = int(settings.read(guild)['priority'])
             if dream_cost + queue_cost > settings.read(guild)['max_compute']:
                 priority += 2
@@ -267,6 +261,8 @@ class UpscaleCog(commands.Cog):
                 ephemeral = True
             else:
                 content = f'<@{user.id}> {settings.global_var.messages[random.randrange(0, len(settings.global_var.messages))]} Queue: ``{queue_length}``'
+                eta = queuehandler.dream_queue.get_eta_text(upscale_object)
+                if eta: content = content + f' - ETA: ``~{eta}``'
 
         except Exception as e:
             if content == None:
@@ -287,6 +283,10 @@ class UpscaleCog(commands.Cog):
             else:
                 loop.create_task(ctx.channel.send(content, delete_after=delete_after))
 
+    # queue an upscale from the queue journal again after a restart
+    async def restore_dream(self, ctx: utility.RestoredContext, record: dict):
+        await self.dream_handler(ctx, **record['args'])
+
     # generate the image
     def dream(self, queue_object: utility.UpscaleObject, web_ui: utility.WebUI, queue_continue: threading.Event):
         user = utility.get_user(queue_object.ctx)
@@ -300,10 +300,7 @@ class UpscaleCog(commands.Cog):
                 return
 
             # safe for global queue to continue
-            def continue_queue():
-                time.sleep(0.1)
-                queue_continue.set()
-            threading.Thread(target=continue_queue, daemon=True).start()
+            queuehandler.job_runner.call_later(0.1, queue_continue.set)
 
             response = s.post(url=f'{web_ui.url}/sdapi/v1/extra-single-image', json=queue_object.payload, timeout=120)
             queue_object.payload = None
@@ -311,7 +308,7 @@ class UpscaleCog(commands.Cog):
             def post_dream():
                 try:
                     response_data = response.json()
-                    image_data = response_data['image']
+                    image_bytes = base64.b64decode(response_data['image'])
 
                     #create safe/sanitized filename
                     epoch_time = int(time.time())
@@ -321,7 +318,7 @@ class UpscaleCog(commands.Cog):
                         file_path = f'{settings.global_var.dir}/{epoch_time}-x{queue_object.resize}-{self.file_name[0:120]}.png'
                         try:
                             with open(file_path, 'wb') as fh:
-                                fh.write(base64.b64decode(image_data))
+                                fh.write(image_bytes)
                             print(f'Saved image: {file_path}')
                         except Exception as e:
                             print(f'Unable to save image: {file_path}\n{traceback.print_exc()}')
@@ -329,36 +326,20 @@ class UpscaleCog(commands.Cog):
                         file_path = f'{epoch_time}-x{queue_object.resize}-{self.file_name[0:120]}.png'
                         print(f'Received image: {file_path}')
 
-                    # open image
-                    image = Image.open(io.BytesIO(base64.b64decode(image_data)))
-
-                    # post to discord
-                    with io.BytesIO() as buffer:
-                        image = Image.open(io.BytesIO(base64.b64decode(image_data)))
-                        image.save(buffer, 'PNG')
-                        size = buffer.getbuffer().nbytes
-                        if buffer.getbuffer().nbytes > 8 * 1000 * 1000:
-                            print(f'Image too large: {size} bytes - Converting image to JPEG')
-                            buffer.truncate(0)
-                            buffer.seek(0)
-                            quality = int(max(5, min(95, ((8 * 1000 * 1000) / size) * 350.0)))
-                            image.save(buffer, format='JPEG', optimize=True, quality=quality)
-                            file_path = file_path.rstrip('.png') + '.jpeg'
-                            print(f'New image size: {buffer.getbuffer().nbytes} bytes - Quality: {quality}')
-                        buffer.seek(0)
-
-                        files = [discord.File(fp=buffer, filename=file_path)]
-                        queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
-                            content=f'<@{user.id}> ``{queue_object.message}``', files=files, view=queue_object.view
-                        ))
-                        queue_object.view = None
+                    # post to discord, images that are too large for the server are encoded again in the image worker processes
+                    images = imagehandler.image_handler.fit_upload([(image_bytes, file_path)], utility.get_premium_tier(queue_object.ctx))
+                    files = [discord.File(fp=io.BytesIO(image_data), filename=file_name) for (image_data, file_name) in images]
+                    queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object,
+                        content=f'<@{user.id}> ``{queue_object.message}``', files=files, view=queue_object.view
+                    ))
+                    queue_object.view = None
 
                 except Exception as e:
                     content = f'<@{user.id}> ``{queue_object.message}``\nSomething went wrong.\n{e}'
                     print(content + f'\n{traceback.print_exc()}')
                     queuehandler.upload_queue.process_upload(utility.UploadObject(queue_object=queue_object, content=content, delete_after=30))
 
-            threading.Thread(target=post_dream, daemon=True).start()
+            queuehandler.job_runner.submit(post_dream)
 
         except requests.exceptions.RequestException as e:
             # connection error, return items to queue
@@ -1,8 +1,136 @@
 import time
+import json
+import os
+import concurrent.futures
 import requests
+import requests.adapters
 import threading
 import discord
 import traceback
+import collections
+import base64
+import io
+import zlib
+from PIL import Image, PngImagePlugin
+
+# rolling health of a webui instance with a circuit breaker
+# closed - dreams are sent normally, open - no dreams are sent until a probe succeeds, half-open - a single trial dream is sent
+class WebUIHealth:
+    def __init__(self, web_ui: 'WebUI'):
+        self.web_ui = web_ui
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.samples: collections.deque[tuple[float, bool, float]] = collections.deque(maxlen=20) # time, success, seconds taken relative to the prediction
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.cooldown = 30.0
+        self.open_until = 0.0
+        self.probe_timer: threading.Timer = None
+
+        self.failure_limit = 3 # consecutive failures that open the circuit
+        self.error_rate_limit = 0.5 # error rate in the window that opens the circuit
+        self.degraded_error_rate = 0.2
+        self.degraded_slowdown = 2.0 # median time taken relative to the prediction that counts as degraded
+        self.min_cooldown = 30.0
+        self.max_cooldown = 300.0
+        self.window = 300.0 # seconds a sample counts towards the health of the instance
+
+    def get_window(self):
+        now = time.time()
+        while self.samples and self.samples[0][0] < now - self.window:
+            self.samples.popleft()
+        return list(self.samples)
+
+    def get_error_rate(self, samples: list[tuple[float, bool, float]]):
+        if not samples:
+            return 0.0
+        return sum(1 for sample in samples if sample[1] == False) / len(samples)
+
+    # record a finished request or dream, slowdown is the time taken relative to the prediction if known
+    def record(self, success: bool, slowdown: float = None):
+        tripped = False
+        recovered = False
+        with self.lock:
+            self.samples.append((time.time(), success, slowdown))
+            if success:
+                self.consecutive_failures = 0
+                if self.state == 'half-open':
+                    self.state = 'closed'
+                    self.cooldown = self.min_cooldown
+                    recovered = True
+            else:
+                self.consecutive_failures += 1
+                samples = self.get_window()
+                if self.state == 'half-open':
+                    tripped = True
+                elif self.state == 'closed':
+                    if self.consecutive_failures >= self.failure_limit:
+                        tripped = True
+                    elif len(samples) >= 6 and self.get_error_rate(samples) >= self.error_rate_limit:
+                        tripped = True
+
+        if tripped:
+            self.trip()
+        elif recovered:
+            print(f'> WebUI at {self.web_ui.url} recovered')
+            self.notify()
+
+    # stop sending dreams to the instance, and probe it again after a cooldown that grows each time
+    def trip(self):
+        with self.lock:
+            self.state = 'open'
+            self.trips += 1
+            cooldown = self.cooldown
+            self.open_until = time.time() + cooldown
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2.0)
+            if self.probe_timer: self.probe_timer.cancel()
+            self.probe_timer = threading.Timer(cooldown, self.probe)
+            self.probe_timer.daemon = True
+            self.probe_timer.start()
+        print(f'> WebUI at {self.web_ui.url} is failing, pausing dreams for {int(cooldown)}s')
+        self.notify()
+
+    # send a cheap request to an open instance, allowing a trial dream if it responds
+    def probe(self):
+        if self.web_ui.stopped: return
+        try:
+            s = self.web_ui.get_session()
+            if s == None:
+                raise Exception('No session')
+            response = s.get(self.web_ui.url + '/sdapi/v1/progress?skip_current_image=true', timeout=10)
+            response.raise_for_status()
+        except Exception as e:
+            self.trip()
+            return
+
+        with self.lock:
+            self.state = 'half-open'
+        self.notify()
+
+    # check if the instance is healthy but slow or unreliable, it is only used when the others are busy
+    def is_degraded(self):
+        with self.lock:
+            if self.state != 'closed':
+                return True
+            samples = self.get_window()
+        if self.get_error_rate(samples) >= self.degraded_error_rate:
+            return True
+        slowdowns = sorted(sample[2] for sample in samples if sample[2] != None)
+        if len(slowdowns) >= 3 and slowdowns[len(slowdowns) // 2] >= self.degraded_slowdown:
+            return True
+        return False
+
+    def get_status(self):
+        with self.lock:
+            samples = self.get_window()
+            status = self.state.upper()
+            if self.state == 'open':
+                status += f' {max(0, int(self.open_until - time.time()))}s'
+        return f'{status} Errors:{self.get_error_rate(samples) * 100.0:.0f}% Trips:{self.trips}'
+
+    def notify(self):
+        if self.web_ui.status_callback:
+            self.web_ui.status_callback()
 
 # WebUI access point
 class WebUI:
@@ -15,8 +143,9 @@ class WebUI:
         '--api-auth'
     ]
 
-    def __init__(self, url: str, username: str = None, password: str = None, api_user: str = None, api_pass: str = None):
-        self.online = False
+    def __init__(self, url: str, username: str = None, password: str = None, api_user: str = None, api_pass: str = None, pool_size: int = 10):
+        self.status_callback = None # called whenever the online state changes
+        self._online = False
         self.stopped = False
         self.auth_rejected = 0
         self.online_last = None
@@ -88,6 +217,18 @@ class WebUI:
         self.hypernet_names: list[str] = []
         self.embedding_names: list[str] = []
         self.messages: list[str] = []
+        self.snapshot_loaded = False
+        self.options = {} # options currently set on the webui, empty when unknown
+        self.options_lock = threading.Lock()
+
+        # a logged in session with a keep-alive connection pool, shared by all requests to this webui
+        self.session: requests.Session = None
+        self.session_lock = threading.Lock()
+        self.pool_size = pool_size
+        self.session_logins = 0
+        self.session_requests = 0
+        self.response_status = threading.local() # status of the last response in each thread, run_dream reads it after the cog sends a dream
+        self.health = WebUIHealth(self)
         # self.controlnet_preprocessors: list[str] = []
         # self.controlnet_models: list[str] = []
 
@@ -109,6 +250,18 @@ class WebUI:
             except:
                 print('> - Warning: Invalid args for --gradio-auth username:password')
 
+    @property
+    def online(self):
+        return self._online
+
+    # let the dream queue know when this instance goes online or offline
+    @online.setter
+    def online(self, online: bool):
+        changed = self._online != online
+        self._online = online
+        if changed and self.status_callback:
+            self.status_callback()
+
     # check connection to WebUI and authentication
     def check_status(self):
         if self.stopped: return False
@@ -140,9 +293,7 @@ class WebUI:
         # check gradio authentication
         if self.stopped: return False
         try:
-            s = requests.Session()
-            if self.api_auth:
-                s.auth = (self.api_user, self.api_pass)
+            s = self.create_session()
 
             response_data = s.get(self.url + '/sdapi/v1/cmd-flags', timeout=30).json()
             if response_data['gradio_auth']:
@@ -150,105 +301,124 @@ class WebUI:
             else:
                 self.gradio_auth = False
 
-            if self.gradio_auth:
-                login_payload = {
-                    'username': self.username,
-                    'password': self.password
-                }
-                s.post(self.url + '/login', data=login_payload, timeout=30)
-            else:
-                s.post(self.url + '/login', timeout=30)
+            self.login(s, 30)
         except Exception as e:
             print(f'> Gradio Authentication failed for WebUI at {self.url}')
             self.online = False
             return False
 
+        # start serving from the last snapshot while the configuration is retrieved again
+        if self.snapshot_loaded:
+            self.set_session(s)
+            self.online = True
+
         # retrieve instance configuration
         if self.stopped: return False
         try:
+            # request every endpoint at the same time, they do not depend on each other
+            endpoints = {
+                'options': '/sdapi/v1/options',
+                'sd-models': '/sdapi/v1/sd-models',
+                'samplers': '/sdapi/v1/samplers',
+                'prompt-styles': '/sdapi/v1/prompt-styles',
+                'face-restorers': '/sdapi/v1/face-restorers',
+                'config': '/config',
+                'upscalers': '/sdapi/v1/upscalers',
+                'hypernetworks': '/sdapi/v1/hypernetworks',
+                'embeddings': '/sdapi/v1/embeddings'
+            }
+            futures = {name: discovery_executor.submit(s.get, self.url + path, timeout=30) for (name, path) in endpoints.items()}
+            responses = {name: future.result().json() for (name, future) in futures.items()}
+
+            # get current options, used to skip sending options that are already set
+            response_data = responses['options']
+            with self.options_lock:
+                self.options = response_data
+
             # get stable diffusion models
             # print('Retrieving stable diffusion models...')
-            response_data = s.get(self.url + '/sdapi/v1/sd-models', timeout=30).json()
-            self.data_models = []
-            for sd_model in response_data:
-                self.data_models.append(remove_hash(sd_model['title']))
+            response_data = responses['sd-models']
+            self.data_models[:] = [remove_hash(sd_model['title']) for sd_model in response_data]
             # print(f'- Stable diffusion models: {len(self.data_models)}')
 
             # get samplers
             # print('Retrieving samplers...')
-            response_data = s.get(self.url + '/sdapi/v1/samplers', timeout=30).json()
-            self.sampler_names = []
+            response_data = responses['samplers']
+            sampler_names = []
             for sampler in response_data:
-                self.sampler_names.append(sampler['name'])
+                sampler_names.append(sampler['name'])
 
             # remove samplers that seem to have some issues under certain cases
-            if 'DPM adaptive' in self.sampler_names: self.sampler_names.remove('DPM adaptive')
-            if 'PLMS' in self.sampler_names: self.sampler_names.remove('PLMS')
-            if 'UniPC' in self.sampler_names: self.sampler_names.remove('UniPC')
+            if 'DPM adaptive' in sampler_names: sampler_names.remove('DPM adaptive')
+            if 'PLMS' in sampler_names: sampler_names.remove('PLMS')
+            if 'UniPC' in sampler_names: sampler_names.remove('UniPC')
+            self.sampler_names[:] = sampler_names
             # print(f'- Samplers count: {len(self.sampler_names)}')
 
             # get styles
             # print('Retrieving styles...')
-            response_data = s.get(self.url + '/sdapi/v1/prompt-styles', timeout=30).json()
-            self.style_names = {}
+            response_data = responses['prompt-styles']
+            style_names = {}
             for style in response_data:
-                self.style_names[style['name']] = style['prompt'] + '\n' + style['negative_prompt']
+                style_names[style['name']] = style['prompt'] + '\n' + style['negative_prompt']
+            self.style_names.clear()
+            self.style_names.update(style_names)
             # print(f'- Styles count: {len(self.style_names)}')
 
             # get face fix models
             # print('Retrieving face fix models...')
-            response_data = s.get(self.url + '/sdapi/v1/face-restorers', timeout=30).json()
-            self.facefix_models = []
-            for facefix_model in response_data:
-                self.facefix_models.append(facefix_model['name'])
+            response_data = responses['face-restorers']
+            self.facefix_models[:] = [facefix_model['name'] for facefix_model in response_data]
             # print(f'- Face fix models count: {len(self.facefix_models)}')
 
             # get settings from config workaround - if AUTOMATIC1111 provides a better way, this should be updated
             # print('Retrieving config models...')
-            config = s.get(self.url + '/config', timeout=30).json()
-            self.lora_names = []
-            self.highres_upscaler_names = []
+            config = responses['config']
+            lora_names = []
+            highres_upscaler_names = []
             try:
                 for item in config['components']:
                     try:
                         if item['props']:
                             if item['props']['elem_id'] == 'setting_sd_lora':
-                                self.lora_names = item['props']['choices']
+                                lora_names = list(item['props']['choices'])
                             if item['props']['elem_id'] == 'txt2img_hr_upscaler':
-                                self.highres_upscaler_names = item['props']['choices']
+                                highres_upscaler_names = list(item['props']['choices'])
                     except:
                         pass
             except:
                 print('Warning: Could not read config. LORA or High-res upscalers will be missing.')
-            if '' in self.lora_names: self.lora_names.remove('')
-            if 'None' not in self.lora_names: self.lora_names.insert(0, 'None')
-            if 'None' not in self.highres_upscaler_names: self.highres_upscaler_names.insert(0, 'None')
+            if '' in lora_names: lora_names.remove('')
+            if 'None' not in lora_names: lora_names.insert(0, 'None')
+            if 'None' not in highres_upscaler_names: highres_upscaler_names.insert(0, 'None')
+            self.lora_names[:] = lora_names
+            self.highres_upscaler_names[:] = highres_upscaler_names
 
             # get upscaler models
-            response_data = s.get(self.url + '/sdapi/v1/upscalers', timeout=30).json()
-            self.upscaler_names = []
+            response_data = responses['upscalers']
+            upscaler_names = []
             for upscaler in response_data:
-                self.upscaler_names.append(upscaler['name'])
+                upscaler_names.append(upscaler['name'])
 
             # remove upscalers that seem to have some issues
-            if 'LSDR' in self.upscaler_names: self.upscaler_names.remove('LSDR')
+            if 'LSDR' in upscaler_names: upscaler_names.remove('LSDR')
+            self.upscaler_names[:] = upscaler_names
             # print(f'- Upscalers count: {len(self.upscaler_names)}')
 
             # get hypernet models
             # print('Retrieving hyper network models...')
-            response_data = s.get(self.url + '/sdapi/v1/hypernetworks', timeout=30).json()
-            self.hypernet_names = []
-            for hypernet_model in response_data:
-                self.hypernet_names.append(hypernet_model['name'])
+            response_data = responses['hypernetworks']
+            self.hypernet_names[:] = [hypernet_model['name'] for hypernet_model in response_data]
             # print(f'- Hyper network models count: {len(self.hypernet_names)}')
 
             # get embedding models
             # print('Retrieving embedding models...')
-            response_data = s.get(self.url + '/sdapi/v1/embeddings', timeout=30).json()
-            self.embedding_names = []
+            response_data = responses['embeddings']
+            embedding_names = []
             for (item, embedding_list) in response_data.items():
                 for (embedding_model, value) in embedding_list.items():
-                    self.embedding_names.append(embedding_model)
+                    embedding_names.append(embedding_model)
+            self.embedding_names[:] = embedding_names
             # print(f'- Embedding models count: {len(self.embedding_names)}')
 
             # get controlnet preprocessors
@@ -286,44 +456,200 @@ class WebUI:
             return False
 
         if self.stopped: return False
+        self.set_session(s)
+        webui_snapshot.save(self)
         self.online_last = time.time()
         self.auth_rejected = 0
         self.online = True
         return True
 
-    # return a request session
+    # get the configuration retrieved from the webui, used to start quickly next time
+    def get_snapshot(self):
+        return {
+            'data_models': self.data_models,
+            'sampler_names': self.sampler_names,
+            'style_names': self.style_names,
+            'facefix_models': self.facefix_models,
+            'highres_upscaler_names': self.highres_upscaler_names,
+            'upscaler_names': self.upscaler_names,
+            'lora_names': self.lora_names,
+            'hypernet_names': self.hypernet_names,
+            'embedding_names': self.embedding_names
+        }
+
+    # use the configuration from the last time the webui was online, until it is retrieved again
+    def load_snapshot(self):
+        data = webui_snapshot.get(self.url)
+        if data == None:
+            return False
+        self.data_models[:] = data.get('data_models', [])
+        self.sampler_names[:] = data.get('sampler_names', [])
+        self.style_names.update(data.get('style_names', {}))
+        self.facefix_models[:] = data.get('facefix_models', [])
+        self.highres_upscaler_names[:] = data.get('highres_upscaler_names', [])
+        self.upscaler_names[:] = data.get('upscaler_names', [])
+        self.lora_names[:] = data.get('lora_names', [])
+        self.hypernet_names[:] = data.get('hypernet_names', [])
+        self.embedding_names[:] = data.get('embedding_names', [])
+        self.snapshot_loaded = True
+        return True
+
+    # create a session with a keep-alive connection pool, it logs in again if the webui rejects a request
+    def create_session(self):
+        s = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        s.mount('http://', adapter)
+        s.mount('https://', adapter)
+        if self.api_auth:
+            s.auth = (self.api_user, self.api_pass)
+        s.hooks['response'].append(self.on_response)
+        return s
+
+    # replace the shared session, closing the connections of the old one
+    def set_session(self, s: requests.Session):
+        with self.session_lock:
+            old_session = self.session
+            self.session = s
+        if old_session and old_session is not s:
+            old_session.close()
+
+    # send login payload to webui
+    def login(self, s: requests.Session, timeout: float = 5):
+        if self.gradio_auth:
+            login_payload = {
+                'username': self.username,
+                'password': self.password
+            }
+            s.post(self.url + '/login', data=login_payload, timeout=timeout)
+        else:
+            s.post(self.url + '/login', timeout=timeout)
+        self.session_logins += 1
+
+    # count requests, and retry a request once after logging in again if the webui rejected it
+    def on_response(self, response: requests.Response, *args, **kwargs):
+        with self.session_lock:
+            self.session_requests += 1
+        self.response_status.code = response.status_code
+        if response.status_code != 401 or response.request.headers.get('X-Aiya-Retry') or response.request.path_url == '/login':
+            return response
+
+        s = self.session
+        if s == None:
+            return response
+        self.login(s)
+
+        request = response.request.copy()
+        request.headers['X-Aiya-Retry'] = '1'
+        request.headers.pop('Cookie', None)
+        request.prepare_cookies(s.cookies)
+        return s.send(request, **kwargs)
+
+    # get the number of connections opened and requests sent through the shared session
+    def get_session_stats(self):
+        connections = 0
+        with self.session_lock:
+            s = self.session
+        if s:
+            for adapter in set(s.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool: connections += pool.num_connections
+        return (connections, self.session_requests, self.session_logins)
+
+    # get and clear the status of the last response received by this thread, None if there was none
+    def pop_response_status(self):
+        status_code = getattr(self.response_status, 'code', None)
+        self.response_status.code = None
+        return status_code
+
+    # return the shared request session
     def get_session(self):
         if self.stopped: return None
         try:
-            s = requests.Session()
-            if self.api_auth:
-                s.auth = (self.api_user, self.api_pass)
-
-                # send login payload to webui
-                if self.gradio_auth:
-                    login_payload = {
-                        'username': self.username,
-                        'password': self.password
-                    }
-                    s.post(self.url + '/login', data=login_payload, timeout=5)
-                else:
-                    s.post(self.url + '/login', timeout=5)
-
-            # if it's been a while since the last check for being online, do one now
-            elif time.time() > self.online_last + 60:
-                s.get(self.url + '/sdapi/v1/cmd-flags', timeout=5)
-            self.online_last = time.time()
-            self.auth_rejected = 0
-            self.online = True
+            with self.session_lock:
+                s = self.session
+            if s == None:
+                s = self.create_session()
+                self.login(s)
+                self.set_session(s)
             return s
 
         except Exception as e:
             if self.online == True:
                 print(f'> Connection failed to WebUI at {self.url}')
             self.online = False
+            self.clear_options()
             self.connect() # attempt to reconnect
             return None
 
+    # stop the dream the webui is currently generating, it will return the images it has so far
+    def interrupt(self):
+        s = self.get_session()
+        if s == None:
+            return False
+        try:
+            s.post(f'{self.url}/sdapi/v1/interrupt', timeout=10)
+            return True
+        except Exception as e:
+            print(f'> Failed to interrupt WebUI at {self.url}\n{e}')
+            return False
+
+    # send options to the webui, skipping any that are already set
+    def set_options(self, s: requests.Session, options: dict):
+        with self.options_lock:
+            changed_options = {}
+            for (key, value) in options.items():
+                if not self.is_option_set(key, value):
+                    changed_options[key] = value
+        if not changed_options:
+            return False
+
+        try:
+            response = s.post(url=f'{self.url}/sdapi/v1/options', json=changed_options, timeout=120)
+        except:
+            self.clear_options()
+            raise
+
+        with self.options_lock:
+            if response.ok:
+                self.options.update(changed_options)
+            else:
+                for key in changed_options:
+                    self.options.pop(key, None)
+        return True
+
+    # get a payload without the override settings that are already set on the webui
+    def remove_set_overrides(self, payload: dict):
+        override_settings: dict = payload.get('override_settings')
+        if not override_settings:
+            return payload
+
+        with self.options_lock:
+            new_override_settings = {}
+            for (key, value) in override_settings.items():
+                if not self.is_option_set(key, value):
+                    new_override_settings[key] = value
+        if len(new_override_settings) == len(override_settings):
+            return payload
+
+        new_payload = dict(payload)
+        new_payload['override_settings'] = new_override_settings
+        return new_payload
+
+    # check an option against the known webui options, options_lock must be held
+    def is_option_set(self, key: str, value):
+        if key not in self.options:
+            return False
+        if key == 'sd_model_checkpoint':
+            return remove_hash(str(self.options[key])) == remove_hash(str(value))
+        return self.options[key] == value
+
+    # forget the known webui options, they will be read again on the next connection
+    def clear_options(self):
+        with self.options_lock:
+            self.options = {}
+
     # continually retry a connection to the webui
     def connect(self):
         def run():
@@ -355,6 +681,8 @@ class WebUI:
         if self.stopped: return None
         if self.reconnect_thread.is_alive() == False:
             self.online = False
+            self.clear_options()
+            self.set_session(None)
             self.connect()
 
     # stop all further connections on this WebUI
@@ -363,6 +691,49 @@ class WebUI:
         self.stopped = True
 
 
+# configuration of each webui saved to disk, so the bot can start without waiting for every webui to respond
+class WebUISnapshot:
+    def __init__(self):
+        self.file_path = 'resources/webui-cache.json'
+        self.lock = threading.Lock()
+        self.data: dict[str, dict] = None
+        self.write_thread = threading.Thread()
+
+    def load(self):
+        self.data = {}
+        try:
+            with open(self.file_path, 'r') as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f'> Failed to load WebUI cache at {self.file_path}\n{e}')
+
+    def get(self, url: str):
+        with self.lock:
+            if self.data == None: self.load()
+            return self.data.get(url)
+
+    def save(self, web_ui: WebUI):
+        with self.lock:
+            if self.data == None: self.load()
+            self.data[web_ui.url] = json.loads(json.dumps(web_ui.get_snapshot()))
+
+        def run():
+            with self.lock:
+                data = json.dumps(self.data)
+            file_path_temp = self.file_path + '.tmp'
+            with open(file_path_temp, 'w') as f:
+                f.write(data)
+            os.replace(file_path_temp, self.file_path)
+
+        if self.write_thread.is_alive(): self.write_thread.join()
+        self.write_thread = threading.Thread(target=run)
+        self.write_thread.start()
+
+webui_snapshot = WebUISnapshot()
+discovery_executor = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix='discovery')
+
 # base queue object from dreams
 class DreamObject:
     def __init__(self, cog, ctx, view = None, message = None, write_to_cache = False, wait_for_dream = None, payload = None):
@@ -374,7 +745,25 @@ class DreamObject:
         self.wait_for_dream = wait_for_dream
         self.payload = payload
         self.uploaded = False
+        self.cancelled = False
         self.dream_attempts = 0
+        self.progress_message = None # acknowledgement message that shows the progress of this dream, see progresshandler
+        self.progress_done = False
+        self.journal_id: int = None # record of this dream in the queue journal, see queuejournal
+
+        # queue bookkeeping, filled in by the dream queue
+        self.priority: int = None
+        self.accounted = False
+        self.dream_cost = 0.0
+        self.user_id: int = None
+        self.guild_id: str = None
+        self.start_tag: float = None
+        self.affinity_skips = 0
+        self.start_time: float = None
+        self.eta_start: float = None
+        self.eta_finish: float = None
+        self.queue_time: float = None # first time the dream was queued, used for priority aging
+        self.deadline: float = None # time the interaction of the command expires, None if it does not
 
 # the queue object for txt2image and img2img
 class DrawObject(DreamObject):
@@ -409,6 +798,7 @@ class DrawObject(DreamObject):
         self.controlnet_url: str = controlnet_url
         self.controlnet_weight: float = controlnet_weight
         self.script: str = script
+        self.batch_objects: list[DrawObject] = [] # dreams of the same batch that are generated in the same webui request
 
     def get_command(self):
         command = f'/dream prompt:{self.prompt}'
@@ -447,6 +837,38 @@ class DrawObject(DreamObject):
             command += f' script:{self.script}'
         return command
 
+    # get the arguments that queue this dream again on its own
+    # scripts that sweep a setting are left out, the dream already has the seed, steps, guidance scale and clip skip the sweep gave it
+    def get_args(self):
+        script = self.script
+        if script != None and not (script.startswith('inpaint') or script.startswith('outpaint')):
+            script = None
+        return {
+            'prompt': self.prompt,
+            'negative': self.negative,
+            'checkpoint': self.model_name,
+            'width': self.width,
+            'height': self.height,
+            'guidance_scale': self.guidance_scale,
+            'steps': self.steps,
+            'sampler': self.sampler,
+            'seed': self.seed,
+            'init_url': self.init_url,
+            'strength': self.strength,
+            'batch': 1 + len(self.batch_objects), # the other dreams of a split batch have their own records
+            'style': self.style,
+            'facefix': self.facefix,
+            'tiling': self.tiling,
+            'highres_fix': self.highres_fix,
+            'highres_fix_prompt': self.highres_fix_prompt,
+            'highres_fix_negative': self.highres_fix_negative,
+            'clip_skip': self.clip_skip,
+            'controlnet_model': self.controlnet_model,
+            'controlnet_url': self.controlnet_url,
+            'controlnet_weight': self.controlnet_weight,
+            'script': script
+        }
+
 # the queue object for extras - upscale
 class UpscaleObject(DreamObject):
     def __init__(self, cog, ctx, resize, init_url, upscaler_1, upscaler_2, upscaler_2_strength,
@@ -477,6 +899,19 @@ class UpscaleObject(DreamObject):
             command += f' script:{self.script}'
         return command
 
+    def get_args(self):
+        return {
+            'init_url': self.init_url,
+            'resize': self.resize,
+            'upscaler_1': self.upscaler_1,
+            'upscaler_2': self.upscaler_2,
+            'upscaler_2_strength': self.upscaler_2_strength,
+            'gfpgan': self.gfpgan,
+            'codeformer': self.codeformer,
+            'upscale_first': self.upscale_first,
+            'script': self.script
+        }
+
 # the queue object for identify (interrogate)
 class IdentifyObject(DreamObject):
     def __init__(self, cog, ctx, init_url, model,
@@ -489,6 +924,12 @@ class IdentifyObject(DreamObject):
         command = f'/identify init_url:{self.init_url} model:{self.model}'
         return command
 
+    def get_args(self):
+        return {
+            'init_url': self.init_url,
+            'model': self.model
+        }
+
 # the queue object for discord uploads
 class UploadObject:
     def __init__(self, queue_object, content, embed = None, ephemeral = None, files = None, view = None, delete_after = None):
@@ -499,9 +940,38 @@ class UploadObject:
         self.files: list[discord.File] = files
         self.view: discord.ui.View = view
         self.delete_after: float = delete_after
+        self.direct = False # ephemeral messages whose interaction expired are sent to the user instead
         self.is_uploading = False
         self.upload_attempts = 0
 
+# stands in for the context of a command that was restored from the queue journal after a restart
+# replies are sent to the channel the command was used in
+class RestoredContext:
+    def __init__(self, channel: discord.abc.Messageable, author: discord.User, guild_id: str, journal_id: int = None):
+        self.channel = channel
+        self.author = author
+        self.guild_id = guild_id
+        self.journal_id = journal_id # the journal record the restored dreams keep
+
+# seconds discord accepts responses and followups to an interaction
+interaction_lifetime = 15 * 60
+
+# get the time the interaction of a command expires, returns None for contexts that do not expire
+def get_deadline(ctx: discord.ApplicationContext | discord.Interaction | discord.Message):
+    try:
+        if type(ctx) is discord.ApplicationContext:
+            return ctx.interaction.created_at.timestamp() + interaction_lifetime
+        elif type(ctx) is discord.Interaction:
+            return ctx.created_at.timestamp() + interaction_lifetime
+        else:
+            return None
+    except:
+        return None
+
+# check if the interaction of a command has expired, responses must be sent to the channel instead
+def is_expired(deadline: float, margin: float = 0.0):
+    return deadline != None and time.time() + margin >= deadline
+
 def get_guild(ctx: discord.ApplicationContext | discord.Interaction | discord.Message):
     try:
         if type(ctx) is discord.ApplicationContext:
@@ -513,11 +983,27 @@ def get_guild(ctx: discord.ApplicationContext | discord.Interaction | discord.Me
             return '% s' % ctx.guild.id
         elif type(ctx) is discord.Message:
             return '% s' % ctx.guild.id
+        elif type(ctx) is RestoredContext:
+            return ctx.guild_id
         else:
             return 'private'
     except:
         return 'private'
 
+# get the server boost tier of the guild a command was sent in, which sets how large uploads can be
+def get_premium_tier(ctx: discord.ApplicationContext | discord.Interaction | discord.Message):
+    try:
+        if type(ctx) is RestoredContext:
+            guild = ctx.channel.guild
+        else:
+            guild = ctx.guild
+        if guild:
+            return guild.premium_tier
+        else:
+            return 0
+    except:
+        return 0
+
 def get_user(ctx: discord.ApplicationContext | discord.Interaction | discord.Message):
     try:
         if type(ctx) is discord.ApplicationContext:
@@ -531,6 +1017,60 @@ def get_user(ctx: discord.ApplicationContext | discord.Interaction | discord.Mes
     except:
         return None
 
+# format a number of seconds as a short duration, such as 1h 5m or 2m 30s
+def format_duration(seconds: float):
+    seconds = max(0, int(round(seconds)))
+    if seconds >= 3600:
+        return f'{seconds // 3600}h {(seconds % 3600) // 60}m'
+    if seconds >= 60:
+        return f'{seconds // 60}m {seconds % 60}s'
+    return f'{seconds}s'
+
+# decode an image sent by the webui, the string is only split if it is a data url
+def decode_image(image_base64: str):
+    if image_base64.startswith('data:'):
+        image_base64 = image_base64.split(',', 1)[1]
+    return base64.b64decode(image_base64)
+
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+# add a text chunk to png data without encoding the image again, replacing any text chunk with the same keyword
+# images in other formats are converted to png
+def add_png_text(image_data: bytes, keyword: str, text: str):
+    if image_data[:8] != png_signature:
+        metadata = PngImagePlugin.PngInfo()
+        metadata.add_text(keyword, text)
+        buffer = io.BytesIO()
+        Image.open(io.BytesIO(image_data)).save(buffer, 'PNG', pnginfo=metadata)
+        return buffer.getvalue()
+
+    # text that is not latin-1 needs an international text chunk, like PIL does
+    keyword_data = keyword.encode('latin-1') + b'\0'
+    try:
+        chunk_type = b'tEXt'
+        chunk_data = keyword_data + text.encode('latin-1')
+    except UnicodeEncodeError:
+        chunk_type = b'iTXt'
+        chunk_data = keyword_data + b'\0\0\0\0' + text.encode('utf-8')
+    text_chunk = len(chunk_data).to_bytes(4, 'big') + chunk_type + chunk_data + zlib.crc32(chunk_data, zlib.crc32(chunk_type)).to_bytes(4, 'big')
+
+    # copy the chunks as they are, the text goes right after the header
+    view = memoryview(image_data)
+    parts = [view[:8]]
+    position = 8
+    while position + 8 <= len(view):
+        length = int.from_bytes(view[position:position + 4], 'big')
+        end = position + length + 12
+        current_type = bytes(view[position + 4:position + 8])
+        if current_type in (b'tEXt', b'iTXt', b'zTXt') and view[position + 8:position + 8 + len(keyword_data)] == keyword_data:
+            pass # replaced by the new text chunk
+        else:
+            parts.append(view[position:end])
+        if current_type == b'IHDR':
+            parts.append(text_chunk)
+        position = end
+    return b''.join(parts)
+
 def find_between(s: str, first: str, last: str):
     try:
         start = s.index(first) + len(first)
@@ -0,0 +1,137 @@
+import os
+import resource
+import threading
+import time
+
+os.environ.setdefault('IMAGE_WORKERS', '0')
+
+from core import utility
+from core import settings
+from core import queuehandler
+from core import queuejournal
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f'user{user_id}'
+
+class FakeContext:
+    def __init__(self, user_id: int):
+        self.author = FakeUser(user_id)
+        self.guild_id = None
+
+# a cog that pretends to run each dream on the webui for a while
+class FakeCog:
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.done: list[utility.DreamObject] = []
+
+    def dream(self, queue_object: utility.DreamObject, web_ui: utility.WebUI, queue_continue: threading.Event):
+        queue_continue.set()
+        time.sleep(self.seconds)
+        with self.lock:
+            self.done.append(queue_object)
+
+def get_draw_object(cog: FakeCog, user_id: int):
+    draw_object = utility.DrawObject(cog, FakeContext(user_id), 'prompt', '', 'model', 'model', 20, 512, 512, 7.0, 'Euler a', 1, 0.75, None, 1,
+        None, None, False, None, '', '', 1, None)
+    draw_object.payload = {}
+    draw_object.message = 'prompt'
+    return draw_object
+
+def setup_instances(count: int):
+    queuejournal.queue_journal.enabled = False
+    queuehandler.upload_queue.process_upload = lambda upload_object: None
+    web_uis = []
+    for index in range(count):
+        web_ui = utility.WebUI(f'http://webui{index}')
+        web_ui.data_models = ['model']
+        web_uis.append(web_ui)
+    settings.global_var.web_ui = web_uis
+    queuehandler.dream_queue.setup()
+    for web_ui in web_uis:
+        web_ui.online = True
+    return web_uis
+
+def wait_until(check, timeout: float):
+    end_time = time.time() + timeout
+    while check() == False and time.time() < end_time:
+        time.sleep(0.01)
+    return check()
+
+def get_cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+# the queue threads sleep on their conditions once every dream is done
+def test_idle_cpu_is_near_zero():
+    setup_instances(2)
+    cog = FakeCog(0.1)
+    for user_id in range(6):
+        queuehandler.dream_queue.process_dream(get_draw_object(cog, user_id), 4)
+    assert wait_until(lambda: len(cog.done) == 6, 10.0)
+
+    cpu_seconds = get_cpu_seconds()
+    time.sleep(2.0)
+    assert get_cpu_seconds() - cpu_seconds < 0.05
+
+# settings reloads replace the instances, the threads of the old instances exit
+def test_setup_stops_old_instances():
+    setup_instances(2)
+    cog = FakeCog(0.05)
+    queuehandler.dream_queue.process_dream(get_draw_object(cog, 0), 4)
+    assert wait_until(lambda: len(cog.done) == 1, 10.0)
+    old_instances = list(queuehandler.dream_queue.dream_instances)
+    old_threads = [dream_instance.dream_thread for dream_instance in old_instances if dream_instance.dream_thread.is_alive()]
+    assert old_threads
+
+    setup_instances(2)
+    assert all(dream_instance.stopped for dream_instance in old_instances)
+    assert wait_until(lambda: not any(thread.is_alive() for thread in old_threads), 5.0)
+
+    # the new instances still run dreams
+    queuehandler.dream_queue.process_dream(get_draw_object(cog, 1), 4)
+    assert wait_until(lambda: len(cog.done) == 2, 10.0)
+
+# dreams taken off the heap go back in order, except the ones removed while they were taken
+def test_heap_take_and_put_back():
+    cog = FakeCog(0.0)
+    queue_heap = queuehandler.DreamHeap()
+    draw_objects = [get_draw_object(cog, user_id) for user_id in range(5)]
+    for (index, draw_object) in enumerate(draw_objects):
+        queue_heap.push(draw_object, (index % 2,))
+    queue_heap.remove(draw_objects[0])
+
+    taken_entries = [queue_heap.take(), queue_heap.take()]
+    assert [entry[-1] for entry in taken_entries] == [draw_objects[2], draw_objects[4]]
+    assert len(queue_heap) == 4
+    queue_heap.remove(draw_objects[2])
+    queue_heap.put_back(taken_entries)
+    assert queue_heap.ordered() == [draw_objects[4], draw_objects[1], draw_objects[3]]
+
+# a dream that finishes early moves up the dreams after it on its own instance, without simulating the queue again
+def test_estimator_finish_shifts_only_its_instance():
+    cog = FakeCog(0.0)
+    draw_objects = [get_draw_object(cog, user_id) for user_id in range(4)]
+    now = time.time()
+    for (index, draw_object) in enumerate(draw_objects):
+        draw_object.eta_start = now + (index % 2) * 10.0 - 5.0
+        draw_object.eta_finish = now + (index % 2) * 10.0 + 5.0
+    dream_instances = [object(), object()]
+
+    estimator = queuehandler.QueueEstimator()
+    estimator.instance_dreams = {id(dream_instances[0]): draw_objects[:2], id(dream_instances[1]): draw_objects[2:]}
+    estimator.instance_free_time = {id(dream_instances[0]): now + 15.0, id(dream_instances[1]): now + 15.0}
+    estimator.dirty = False
+
+    estimator.finish(dream_instances[0], draw_objects[0])
+    assert estimator.dirty == False
+    assert abs(draw_objects[1].eta_finish - (now + 10.0)) < 0.5
+    assert abs(estimator.instance_free_time[id(dream_instances[0])] - (now + 10.0)) < 0.5
+    assert draw_objects[3].eta_finish == now + 15.0
+    assert estimator.instance_free_time[id(dream_instances[1])] == now + 15.0
+
+    # a dream the estimate does not know about needs a new simulation
+    estimator.finish(dream_instances[1], draw_objects[0])
+    assert estimator.dirty
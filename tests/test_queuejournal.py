@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+import time
+
+os.environ.setdefault('IMAGE_WORKERS', '0')
+
+from core import utility
+from core import settings
+from core import stablecog
+from core import queuejournal
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = f'user{user_id}'
+        self.discriminator = '0'
+
+class FakeChannel:
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+
+class FakeBot:
+    def __init__(self, cog):
+        self.cog = cog
+
+    def get_cog(self, name: str):
+        return self.cog if name == 'StableCog' else None
+
+    def get_channel(self, channel_id: int):
+        return FakeChannel(channel_id)
+
+    def get_user(self, user_id: int):
+        return FakeUser(user_id)
+
+# a stable cog that records the dreams it is asked to queue instead of sending them to a webui
+class FakeStableCog(stablecog.StableCog):
+    def __init__(self, journal: queuejournal.QueueJournal):
+        super().__init__(None)
+        self.journal = journal
+        self.dreams: list[tuple[utility.RestoredContext, dict]] = []
+        self.queue_objects: list[utility.DrawObject] = []
+
+    async def dream_handler(self, ctx: utility.RestoredContext, **kwargs):
+        self.dreams.append((ctx, kwargs))
+        queue_object = get_draw_object(self, ctx, kwargs['prompt'])
+        self.journal.add(queue_object)
+        self.queue_objects.append(queue_object)
+
+def get_draw_object(cog: stablecog.StableCog, ctx, prompt: str):
+    return utility.DrawObject(cog, ctx, prompt, '', 'model', 'model', 20, 512, 512, 7.0, 'Euler a', 1, 0.75, None, 1,
+        None, None, False, None, '', '', 1, None)
+
+def get_add_record(journal_id: int, prompt: str):
+    args = get_draw_object(None, None, prompt).get_args()
+    return {
+        'op': 'add',
+        'cog': 'StableCog',
+        'type': 'DrawObject',
+        'command': f'/dream prompt:{prompt}',
+        'channel_id': 100 + journal_id,
+        'user_id': 200 + journal_id,
+        'guild_id': 'private',
+        'args': args,
+        'time': time.time(),
+        'id': journal_id
+    }
+
+def get_journal(file_path: str):
+    journal = queuejournal.QueueJournal()
+    journal.file_path = file_path
+    journal.restore_interval = 0.01
+    journal.setup()
+    return journal
+
+def wait_for_writes(journal: queuejournal.QueueJournal):
+    end_time = time.time() + 5.0
+    while time.time() < end_time:
+        with journal.lock:
+            if journal.writing == False and not journal.lines:
+                return
+        time.sleep(0.01)
+
+# dreams with a done record are skipped, the others are queued again once and keep their record until they are done
+def test_restore_replays_pending_dreams_once(tmp_path):
+    file_path = str(tmp_path / 'queue-journal.jsonl')
+    with open(file_path, 'w') as f:
+        f.write(json.dumps(get_add_record(1, 'first')) + '\n')
+        f.write(json.dumps(get_add_record(2, 'second')) + '\n')
+        f.write(json.dumps(get_add_record(3, 'third')) + '\n')
+        f.write(json.dumps({'op': 'done', 'id': 2}) + '\n')
+        f.write('{"op": "add", "id": 4, ') # the last line of a crash
+
+    web_ui = utility.WebUI('http://webui0')
+    web_ui.online = True
+    settings.global_var.web_ui = [web_ui]
+
+    journal = get_journal(file_path)
+    cog = FakeStableCog(journal)
+    bot = FakeBot(cog)
+    asyncio.run(journal.restore(bot))
+    asyncio.run(journal.restore(bot))
+
+    assert [kwargs['prompt'] for (ctx, kwargs) in cog.dreams] == ['first', 'third']
+    assert [ctx.journal_id for (ctx, kwargs) in cog.dreams] == [1, 3]
+    assert [ctx.channel.id for (ctx, kwargs) in cog.dreams] == [101, 103]
+    assert cog.dreams[0][1] == get_add_record(1, 'first')['args']
+    assert [queue_object.journal_id for queue_object in cog.queue_objects] == [1, 3]
+    assert journal.next_id == 4
+
+    # restored dreams do not add new records, so a restart before they are done restores them once more
+    wait_for_writes(journal)
+    journal = get_journal(file_path)
+    assert [record['id'] for record in journal.restore_records] == [1, 3]
+
+    for queue_object in cog.queue_objects:
+        journal.complete(queue_object)
+    wait_for_writes(journal)
+    assert not get_journal(file_path).restore_records
@@ -0,0 +1,67 @@
+import io
+import os
+import zlib
+
+os.environ.setdefault('IMAGE_WORKERS', '0')
+
+from PIL import Image, PngImagePlugin
+
+from core import utility
+
+# get the type and data of each chunk in png data, checking their crcs
+def get_png_chunks(image_data: bytes):
+    assert image_data[:8] == utility.png_signature
+    chunks: list[tuple[bytes, bytes]] = []
+    position = 8
+    while position < len(image_data):
+        length = int.from_bytes(image_data[position:position + 4], 'big')
+        chunk_type = image_data[position + 4:position + 8]
+        chunk_data = image_data[position + 8:position + 8 + length]
+        crc = int.from_bytes(image_data[position + 8 + length:position + 12 + length], 'big')
+        assert crc == zlib.crc32(chunk_data, zlib.crc32(chunk_type))
+        chunks.append((chunk_type, chunk_data))
+        position += length + 12
+    assert position == len(image_data)
+    return chunks
+
+def get_chunk_data(chunk_types: list[bytes], chunks: list[tuple[bytes, bytes]]):
+    return [chunk_data for (chunk_type, chunk_data) in chunks if chunk_type in chunk_types]
+
+def get_png(**text: str):
+    image = Image.new('RGB', (64, 48))
+    image.putdata([(x * 4, y * 5, (x + y) % 256) for y in range(48) for x in range(64)])
+    metadata = PngImagePlugin.PngInfo()
+    for (keyword, value) in text.items():
+        metadata.add_text(keyword, value)
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', pnginfo=metadata)
+    return buffer.getvalue()
+
+# the text is added and replaced without encoding the image again
+def test_add_png_text_round_trip():
+    image_data = get_png(parameters='old parameters', Software='test')
+    image_data_new = utility.add_png_text(image_data, 'parameters', 'new parameters')
+    image_data_new = utility.add_png_text(image_data_new, 'Comment', 'café ✓')
+
+    image = Image.open(io.BytesIO(image_data_new))
+    image.load()
+    assert image.info['parameters'] == 'new parameters'
+    assert image.info['Software'] == 'test'
+    assert image.info['Comment'] == 'café ✓'
+    assert image.tobytes() == Image.open(io.BytesIO(image_data)).tobytes()
+
+    chunks = get_png_chunks(image_data)
+    chunks_new = get_png_chunks(image_data_new)
+    assert get_chunk_data([b'IHDR', b'IDAT', b'IEND'], chunks_new) == get_chunk_data([b'IHDR', b'IDAT', b'IEND'], chunks)
+    assert chunks_new[0][0] == b'IHDR' and chunks_new[-1][0] == b'IEND'
+    keywords = [chunk_data.split(b'\0')[0] for chunk_data in get_chunk_data([b'tEXt', b'iTXt', b'zTXt'], chunks_new)]
+    assert sorted(keywords) == [b'Comment', b'Software', b'parameters']
+
+# images in other formats are converted to png with the text
+def test_add_png_text_converts_other_formats():
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16), (10, 20, 30)).save(buffer, 'BMP')
+    image = Image.open(io.BytesIO(utility.add_png_text(buffer.getvalue(), 'parameters', 'prompt')))
+    assert image.format == 'PNG'
+    assert image.info['parameters'] == 'prompt'
+    assert image.getpixel((0, 0)) == (10, 20, 30)